@@ -0,0 +1,379 @@
+"""
+Benchmark the API's endpoints over an in-memory stand-in for Riak.
+
+Usage::
+
+    python benchmarks/bench_endpoints.py [--sizes 1000,10000] [--requests N]
+        [--concurrency N] [--latency SECONDS] [--faults SPECS] [--json]
+
+For each dataset size, contacts are loaded into a
+:class:`go_contacts.backends.memory.InMemoryRiakManager`, a
+:class:`go_contacts.server.ContactsApi` using it is served over HTTP on a
+local port and each scenario is run with ``--concurrency`` requests in
+flight. The throughput and the median and 99th percentile latencies of
+each scenario are reported.
+
+``--latency`` is either the number of seconds every Riak operation takes or
+a comma-separated list of ``operation=seconds`` pairs, e.g.
+``load=0.002,index_keys_page=0.005,real_search=0.02``.
+
+``--faults`` adds random latency and failures to Riak calls using a
+:class:`go_contacts.backends.faults.FaultInjectingRiakManager`. It is YAML
+(or the name of a YAML file) mapping operations to the parameters of a
+:class:`go_contacts.backends.faults.FaultSpec`, e.g.
+``{load: {latency: 0.002, jitter: 0.001, error_rate: 0.01}}``. Requests that
+fail or take longer than ``--timeout`` are counted as errors rather than
+stopping the benchmark.
+
+Loading a million contacts takes several minutes and a few GB of memory.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import urllib
+
+import treq
+import yaml
+
+from twisted.internet import defer, task
+from twisted.web.client import HTTPConnectionPool
+
+from go.vumitools.contact import ContactStore
+
+from go_contacts.backends.faults import FaultInjectingRiakManager
+from go_contacts.backends.memory import InMemoryRiakManager
+from go_contacts.server import ContactsApi
+
+from contact_data import (
+    make_contact_dict, make_group_dict, make_contact_model, make_group_model)
+
+
+OWNER = u"owner-1"
+STATIC_GROUP = make_group_dict(0, owner=OWNER)
+SMART_GROUP = make_group_dict(1, smart=True, owner=OWNER)
+
+SCENARIOS = (
+    'page', 'stream', 'get', 'address_query', 'static_group_page',
+    'smart_group_page')
+
+
+class BenchmarkContactsApi(ContactsApi):
+    """
+    A :class:`ContactsApi` that uses the given Riak manager.
+    """
+
+    def __init__(self, riak_manager, config_file):
+        self.riak_manager = riak_manager
+        ContactsApi.__init__(self, config_file)
+
+
+def parse_latency(value):
+    if '=' not in value:
+        return float(value)
+    latency = {}
+    for item in value.split(','):
+        name, _, seconds = item.partition('=')
+        latency[name.strip()] = float(seconds)
+    return latency
+
+
+def parse_faults(value):
+    if os.path.exists(value):
+        with open(value) as f:
+            return yaml.safe_load(f)
+    return yaml.safe_load(value)
+
+
+def load_contacts(manager, count, extras):
+    """
+    Load ``count`` contacts into ``manager``, all of them in the static group
+    and matching the smart group's query.
+    """
+    store = ContactStore(manager, OWNER)
+    for group_dict in (STATIC_GROUP, SMART_GROUP):
+        store.manager.put_object(make_group_model(store, group_dict))
+    rand = random.Random(0)
+    for i in xrange(count):
+        contact_dict = make_contact_dict(
+            i, extras=rand.randint(0, 2 * extras), groups=0, owner=OWNER)
+        contact_dict[u"groups"] = [STATIC_GROUP[u"key"]]
+        store.manager.put_object(make_contact_model(store, contact_dict))
+
+
+def make_api(manager, page_size, **config):
+    """
+    Return a :class:`BenchmarkContactsApi` using ``manager``, with extra
+    config from ``config``.
+    """
+    config.update({
+        "riak_manager": {"bucket_prefix": "bench."},
+        "max_contacts_per_page": page_size,
+        "max_groups_per_page": page_size,
+    })
+    config_dir = tempfile.mkdtemp()
+    try:
+        config_file = os.path.join(config_dir, "config.yaml")
+        with open(config_file, "w") as f:
+            yaml.safe_dump(config, f)
+        return BenchmarkContactsApi(manager, config_file)
+    finally:
+        shutil.rmtree(config_dir)
+
+
+def percentile(values, fraction):
+    """
+    Return the nearest-rank percentile of a sorted list of values.
+    """
+    index = max(0, int(round(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class EndpointBenchmark(object):
+    """
+    Runs the scenarios against an API server with a fixed dataset.
+    """
+
+    def __init__(self, reactor, size, args):
+        self.reactor = reactor
+        self.size = size
+        self.args = args
+        self.rand = random.Random(size)
+        self.base_url = None
+        self.pool = None
+        self.port = None
+
+    def start(self):
+        manager = InMemoryRiakManager(
+            bucket_prefix="bench.", latency=self.args.latency,
+            reactor=self.reactor)
+        load_start = time.time()
+        load_contacts(manager, self.size, self.args.extras)
+        self.load_time = time.time() - load_start
+        if self.args.faults:
+            manager = FaultInjectingRiakManager(
+                manager, self.args.faults, seed=self.size,
+                reactor=self.reactor)
+        self.port = self.reactor.listenTCP(
+            0, make_api(manager, self.args.page_size),
+            interface="127.0.0.1")
+        self.base_url = "http://127.0.0.1:%d" % (self.port.getHost().port,)
+        self.pool = HTTPConnectionPool(self.reactor, persistent=True)
+        self.pool.maxPersistentPerHost = self.args.concurrency
+
+    @defer.inlineCallbacks
+    def stop(self):
+        yield self.pool.closeCachedConnections()
+        yield self.port.stopListening()
+
+    def request(self, path):
+        """
+        Make a request, failing if it doesn't succeed within ``--timeout``
+        seconds.
+        """
+        d = self._request(path)
+        return d.addTimeout(self.args.timeout, self.reactor)
+
+    @defer.inlineCallbacks
+    def _request(self, path):
+        response = yield treq.get(
+            self.base_url + path, headers={"X-Owner-ID": [str(OWNER)]},
+            pool=self.pool)
+        body = yield treq.content(response)
+        if response.code != 200:
+            raise RuntimeError("GET %s returned %d: %s" % (
+                path, response.code, body[:200]))
+        defer.returnValue(body)
+
+    @defer.inlineCallbacks
+    def request_with_retries(self, path, attempts=10):
+        """
+        Make a request, retrying it if it fails because of injected faults.
+        """
+        for attempt in xrange(attempts - 1):
+            try:
+                body = yield self.request(path)
+            except Exception:
+                continue
+            defer.returnValue(body)
+        body = yield self.request(path)
+        defer.returnValue(body)
+
+    @defer.inlineCallbacks
+    def collect_page_paths(self, path, count):
+        """
+        Walk up to ``count`` pages of ``path``, returning the paths of the
+        pages.
+        """
+        page_paths = []
+        cursor = None
+        while len(page_paths) < count:
+            params = {"max_results": self.args.page_size}
+            if cursor is not None:
+                params["cursor"] = cursor
+            page_path = "%s?%s" % (path, urllib.urlencode(params))
+            page_paths.append(page_path)
+            body = yield self.request_with_retries(page_path)
+            cursor = json.loads(body)["cursor"]
+            if cursor is None:
+                break
+        defer.returnValue(page_paths)
+
+    def random_contact(self):
+        return make_contact_dict(self.rand.randrange(self.size))
+
+    @defer.inlineCallbacks
+    def scenario_paths(self, name):
+        requests = self.args.requests
+        if name == 'page':
+            paths = yield self.collect_page_paths("/contacts/", requests)
+        elif name == 'stream':
+            paths = ["/contacts/?stream=true"]
+            requests = self.args.stream_requests
+        elif name == 'get':
+            paths = [
+                "/contacts/%s" % (self.random_contact()[u"key"],)
+                for _ in xrange(requests)]
+        elif name == 'address_query':
+            paths = [
+                "/contacts/?%s" % (urllib.urlencode({
+                    "query": "msisdn=%s" % (
+                        self.random_contact()[u"msisdn"],)}),)
+                for _ in xrange(requests)]
+        elif name == 'static_group_page':
+            paths = yield self.collect_page_paths(
+                "/groups/%s/contacts" % (STATIC_GROUP[u"key"],), requests)
+        elif name == 'smart_group_page':
+            paths = yield self.collect_page_paths(
+                "/groups/%s/contacts" % (SMART_GROUP[u"key"],), requests)
+        # Repeat the paths we have until we have enough requests.
+        defer.returnValue([paths[i % len(paths)] for i in xrange(requests)])
+
+    @defer.inlineCallbacks
+    def run_scenario(self, name):
+        paths = yield self.scenario_paths(name)
+        latencies = []
+        errors = []
+        pending = iter(paths)
+
+        @defer.inlineCallbacks
+        def worker():
+            for path in pending:
+                start = time.time()
+                try:
+                    yield self.request(path)
+                except Exception:
+                    errors.append(path)
+                else:
+                    latencies.append(time.time() - start)
+
+        start = time.time()
+        yield defer.gatherResults([
+            worker() for _ in xrange(self.args.concurrency)],
+            consumeErrors=True)
+        elapsed = time.time() - start
+        if not latencies:
+            raise RuntimeError("Every %s request failed." % (name,))
+        latencies.sort()
+        defer.returnValue({
+            "requests": len(latencies),
+            "errors": len(errors),
+            "throughput": len(latencies) / elapsed,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1],
+        })
+
+    @defer.inlineCallbacks
+    def run(self):
+        self.start()
+        try:
+            results = {"load_time": self.load_time, "scenarios": {}}
+            for name in self.args.scenarios:
+                results["scenarios"][name] = yield self.run_scenario(name)
+        finally:
+            yield self.stop()
+        defer.returnValue(results)
+
+
+def report(results, out=sys.stdout):
+    for size, size_results in sorted(
+            results["sizes"].items(), key=lambda item: int(item[0])):
+        out.write("%s contacts (loaded in %.1f s):\n" % (
+            size, size_results["load_time"]))
+        for name in SCENARIOS:
+            timings = size_results["scenarios"].get(name)
+            if timings is None:
+                continue
+            out.write(
+                "  %-18s %9.1f req/s  p50 %9.3f ms  p99 %9.3f ms"
+                "  %d errors\n" % (
+                    name, timings["throughput"], timings["p50"] * 1000,
+                    timings["p99"] * 1000, timings["errors"]))
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    results = {
+        "label": args.label,
+        "settings": {
+            "requests": args.requests,
+            "stream_requests": args.stream_requests,
+            "concurrency": args.concurrency,
+            "page_size": args.page_size,
+            "extras": args.extras,
+            "latency": args.latency,
+            "faults": args.faults,
+        },
+        "sizes": {},
+    }
+    for size in args.sizes:
+        bench = EndpointBenchmark(reactor, size, args)
+        results["sizes"][str(size)] = yield bench.run()
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        report(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", default="1000,10000,100000",
+        type=lambda value: [int(size) for size in value.split(',')],
+        help="Comma-separated dataset sizes.")
+    parser.add_argument(
+        "--scenarios", default=",".join(SCENARIOS),
+        type=lambda value: value.split(','),
+        help="Comma-separated scenarios to run.")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--stream-requests", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--extras", type=int, default=5)
+    parser.add_argument("--latency", type=parse_latency, default=0)
+    parser.add_argument(
+        "--timeout", type=float, default=60,
+        help="Seconds after which a request is counted as an error.")
+    parser.add_argument(
+        "--faults", type=parse_faults,
+        help="Latency and error rates to inject into Riak calls, as YAML.")
+    parser.add_argument(
+        "--label", help="A label for the results, such as the version.")
+    parser.add_argument(
+        "--json", action="store_true", help="Write the results as JSON.")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario %r" % (name,))
+    task.react(run, [args])
+
+
+if __name__ == "__main__":
+    main()
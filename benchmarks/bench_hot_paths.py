@@ -0,0 +1,159 @@
+"""
+Micro-benchmarks for the functions called once per object in responses.
+
+Usage::
+
+    python benchmarks/bench_hot_paths.py [--repeat N] [--json]
+
+Each function is called repeatedly and the best of ``--repeat`` runs is
+reported as operations per second, together with the number of objects
+and bytes each call allocates for its result.
+
+Python 2 can't count every allocation, so only the objects making up the
+result are counted. Objects the result shares with the function's inputs,
+or with the result of another call (such as interned strings), aren't
+counted, while temporary objects freed before the function returns are
+missed. This is still what most optimizations of these functions change.
+"""
+
+import argparse
+import json
+import sys
+import timeit
+
+from go.vumitools.contact import ContactStore
+
+from go_contacts.backends.memory import InMemoryRiakManager
+from go_contacts.backends.riak import (
+    RiakContactsCollection, RiakContactsForGroupModel, contact_to_dict,
+    group_to_dict)
+from go_contacts.formats import get_json_encoder
+
+from contact_data import (
+    make_contact_dict, make_group_dict, make_contact_model, make_group_model)
+
+
+def _collect(obj, found):
+    """
+    Add ``obj`` and the objects in it to the dict ``found``, by id.
+    """
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in found:
+            continue
+        found[id(obj)] = obj
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+
+
+def count_allocations(func, inputs):
+    """
+    Return the number of objects and bytes allocated for the result of
+    ``func``, not counting objects shared with ``inputs`` or with the result
+    of another call.
+    """
+    shared = {}
+    for obj in inputs:
+        _collect(obj, shared)
+    result = func()
+    _collect(func(), shared)
+    found = {}
+    _collect(result, found)
+    allocated = [obj for key, obj in found.iteritems() if key not in shared]
+    return len(allocated), sum(sys.getsizeof(obj) for obj in allocated)
+
+
+def bench(func, number, repeat):
+    """
+    Return the best number of calls to ``func`` per second.
+    """
+    return number / min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def make_benchmarks(encoder):
+    store = ContactStore(InMemoryRiakManager(), u"owner-1")
+    contact = make_contact_model(store, make_contact_dict(0))
+    large_contact = make_contact_model(
+        store, make_contact_dict(1, extras=500))
+    group = make_group_model(store, make_group_dict(0, smart=True))
+    contact_data = dict(make_contact_dict(0))
+    for field in (u"key", u"$VERSION", u"user_account", u"created_at"):
+        del contact_data[field]
+    cfg_model = RiakContactsForGroupModel(None, 100)
+    static_cursor = cfg_model._encode_cursor(
+        cfg_model.STATIC_CURSOR, u"g2gCbQAAAAdvd25lci0xbQAAACA")
+    dynamic_cursor = cfg_model._encode_cursor(cfg_model.DYNAMIC_CURSOR, 1000)
+    dumps = get_json_encoder(encoder)
+    typical_dict = contact_to_dict(contact)
+    large_dict = contact_to_dict(large_contact)
+
+    contact_inputs = [contact.get_data()]
+    large_inputs = [large_contact.get_data()]
+    return [
+        ("contact_to_dict", lambda: contact_to_dict(contact), contact_inputs),
+        ("contact_to_dict_large_extras",
+         lambda: contact_to_dict(large_contact), large_inputs),
+        ("group_to_dict", lambda: group_to_dict(group), [group.get_data()]),
+        ("check_contact_fields",
+         lambda: RiakContactsCollection._check_contact_fields(contact_data),
+         [contact_data]),
+        ("encode_static_cursor", lambda: cfg_model._encode_cursor(
+            cfg_model.STATIC_CURSOR, u"g2gCbQAAAAdvd25lci0xbQAAACA"), []),
+        ("encode_dynamic_cursor", lambda: cfg_model._encode_cursor(
+            cfg_model.DYNAMIC_CURSOR, 1000), []),
+        ("decode_static_cursor",
+         lambda: cfg_model._decode_cursor(static_cursor), [static_cursor]),
+        ("decode_dynamic_cursor",
+         lambda: cfg_model._decode_cursor(dynamic_cursor), [dynamic_cursor]),
+        ("json_typical_contact", lambda: dumps(typical_dict),
+         [typical_dict]),
+        ("json_large_extras_contact", lambda: dumps(large_dict),
+         [large_dict]),
+    ]
+
+
+def run(number, repeat, encoder):
+    results = {}
+    for name, func, inputs in make_benchmarks(encoder):
+        # Large contacts are much slower, so run them fewer times.
+        calls = number // 100 if "large" in name else number
+        objects, size = count_allocations(func, inputs)
+        results[name] = {
+            "ops_per_sec": bench(func, calls, repeat),
+            "allocated_objects": objects,
+            "allocated_bytes": size,
+        }
+    return results
+
+
+def report(results, out=sys.stdout):
+    for name, result in sorted(results.items()):
+        out.write("  %-30s %12.0f ops/s  %5d objects  %8d bytes\n" % (
+            name, result["ops_per_sec"], result["allocated_objects"],
+            result["allocated_bytes"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--encoder", default="json",
+        help="The JSON encoder to use, see go_contacts.formats.")
+    parser.add_argument(
+        "--json", action="store_true", help="Write the results as JSON.")
+    args = parser.parse_args(argv)
+    results = run(args.number, args.repeat, args.encoder)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Compare the JSON encoders available for collection responses.
+
+Usage::
+
+    python benchmarks/bench_json_encoders.py [--contacts N] [--repeat N]
+
+Each installed encoder (see :func:`go_contacts.formats.get_json_encoder`) is
+used to encode a page of contacts, each contact in a stream and a single
+contact with many extras. The best of ``--repeat`` runs is reported.
+"""
+
+import argparse
+import json
+import sys
+import timeit
+
+from go_contacts.formats import JSON_ENCODERS, get_json_encoder
+
+from contact_data import make_contacts, make_contact_dict
+
+
+def bench(func, number, repeat):
+    """
+    Return the best time per call of ``func`` in seconds.
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def run(contact_count, repeat):
+    contacts = make_contacts(contact_count)
+    page = {u"cursor": u"abc", u"data": contacts}
+    large = make_contact_dict(0, extras=500)
+
+    results = {}
+    for name in sorted(JSON_ENCODERS):
+        try:
+            dumps = get_json_encoder(name)
+        except ValueError:
+            continue
+        results[name] = {
+            "page": bench(lambda: dumps(page), 10, repeat),
+            "stream": bench(
+                lambda: [dumps(c) for c in contacts], 10, repeat),
+            "large_extras": bench(lambda: dumps(large), 100, repeat),
+        }
+    return results
+
+
+def report(results, contact_count, out=sys.stdout):
+    baseline = results["json"]
+    out.write("Encoding %d contacts (best time per operation):\n" % (
+        contact_count,))
+    for name, timings in sorted(results.items()):
+        out.write("  %s\n" % (name,))
+        for op, seconds in sorted(timings.items()):
+            out.write("    %-14s %10.3f ms  (%.2fx stdlib)\n" % (
+                op, seconds * 1000, baseline[op] / seconds))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--contacts", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--json", action="store_true", help="Write the results as JSON.")
+    args = parser.parse_args(argv)
+    results = run(args.contacts, args.repeat)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        report(results, args.contacts)
+
+
+if __name__ == "__main__":
+    main()
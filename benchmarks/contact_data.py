@@ -0,0 +1,88 @@
+"""
+Realistic contact and group data for benchmarks.
+
+The dictionaries built here have the same shape as the output of
+:func:`go_contacts.backends.contacts.contact_to_dict` and
+:func:`go_contacts.backends.groups.group_to_dict`.
+"""
+
+import random
+
+
+def make_contact_dict(i, extras=5, groups=2, owner=u"owner-1"):
+    """
+    Build the dict for contact number ``i``. ``extras`` controls the number
+    of extra fields, which is usually what makes contacts large.
+    """
+    return {
+        u"$VERSION": 2,
+        u"key": u"%032x" % (i,),
+        u"user_account": owner,
+        u"created_at": u"2014-07-25 12:44:11.159151",
+        u"name": u"Name %d" % (i,),
+        u"surname": u"Surname %d" % (i,),
+        u"groups": [u"group-%d" % (g,) for g in range(groups)],
+        u"msisdn": u"+2771%07d" % (i,),
+        u"twitter_handle": None,
+        u"bbm_pin": None,
+        u"mxit_id": None,
+        u"dob": None,
+        u"facebook_id": None,
+        u"wechat_id": None,
+        u"email_address": u"contact-%d@example.com" % (i,),
+        u"gtalk_id": None,
+        u"extra": dict(
+            (u"field-%d" % (e,), u"value %d for contact %d" % (e, i))
+            for e in range(extras)),
+        u"subscription": {u"conversation-1": u"1"},
+    }
+
+
+def make_group_dict(i, smart=False, owner=u"owner-1"):
+    return {
+        u"$VERSION": None,
+        u"key": u"%032x" % (i,),
+        u"user_account": owner,
+        u"created_at": u"2014-07-25 12:44:11.159151",
+        u"name": u"Group %d" % (i,),
+        u"query": u"msisdn:\\+2771*" if smart else None,
+    }
+
+
+def make_contacts(count, extras=5, seed=0):
+    """
+    Build ``count`` contacts with a varying (but repeatable) number of extra
+    fields averaging ``extras``.
+    """
+    rand = random.Random(seed)
+    return [
+        make_contact_dict(i, extras=rand.randint(0, 2 * extras))
+        for i in xrange(count)]
+
+
+def make_contact_model(store, contact_dict):
+    """
+    Build an unsaved contact model from a dict built by
+    :func:`make_contact_dict`, using the
+    :class:`go.vumitools.contact.ContactStore` ``store``.
+    """
+    contact = store.contacts(
+        contact_dict[u"key"], user_account=contact_dict[u"user_account"],
+        name=contact_dict[u"name"], surname=contact_dict[u"surname"],
+        msisdn=contact_dict[u"msisdn"],
+        email_address=contact_dict[u"email_address"],
+        extra=contact_dict[u"extra"],
+        subscription=contact_dict[u"subscription"])
+    for group_key in contact_dict[u"groups"]:
+        contact.add_to_group(group_key)
+    return contact
+
+
+def make_group_model(store, group_dict):
+    """
+    Build an unsaved group model from a dict built by
+    :func:`make_group_dict`.
+    """
+    return store.groups(
+        group_dict[u"key"], name=group_dict[u"name"],
+        query=group_dict[u"query"], user_account=group_dict[u"user_account"])
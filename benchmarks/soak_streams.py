@@ -0,0 +1,322 @@
+"""
+Soak test for the memory and deferreds held by abandoned streams.
+
+Usage::
+
+    python benchmarks/soak_streams.py [--rounds N] [--streams N] [--json]
+
+Contacts and groups are loaded into a
+:class:`go_contacts.backends.memory.InMemoryRiakManager` and a
+:class:`go_contacts.server.ContactsApi` using it is served over HTTP on a
+local port, as they are by ``bench_endpoints.py``. Each round opens
+``--streams`` streams spread over the contacts, groups and contacts for
+group collections, reads a random part of each one and then drops the
+connection. Streams are also dropped after a random time of up to
+``--max-hold`` seconds, so that some are dropped while they are still being
+filled.
+
+After each round the API is given ``--settle`` seconds to notice the dropped
+connections and a garbage collection is run, then the process's RSS, the
+number of live :class:`go_api.queue.PausingDeferredQueue` and
+:class:`twisted.internet.defer.Deferred` objects and the number of fills
+that haven't stopped are recorded. The test fails if any of them has grown
+by more than the allowed amount since the end of the ``--warmup`` rounds.
+
+Riak latency may be given with ``--latency``, as for ``bench_endpoints.py``.
+"""
+
+import argparse
+import gc
+import json
+import random
+import resource
+import sys
+import time
+
+from twisted.internet import defer, task
+from twisted.internet.protocol import Protocol, ClientFactory
+from twisted.logger import (
+    globalLogBeginner, textFileLogObserver, FilteringLogObserver,
+    LogLevelFilterPredicate, LogLevel)
+
+from go_api.queue import PausingDeferredQueue
+
+from go.vumitools.contact import ContactStore
+
+from go_contacts.backends.memory import InMemoryRiakManager
+from go_contacts.backends.utils import _QueueFiller
+
+from bench_endpoints import (
+    OWNER, STATIC_GROUP, SMART_GROUP, load_contacts, make_api, parse_latency)
+from contact_data import make_group_dict, make_group_model
+
+
+STREAM_PATHS = (
+    "/contacts/?stream=true",
+    "/groups/?stream=true",
+    "/groups/%s/contacts?stream=true" % (STATIC_GROUP[u"key"],),
+    "/groups/%s/contacts?stream=true" % (SMART_GROUP[u"key"],),
+)
+
+MEASUREMENTS = ('rss_mb', 'queues', 'deferreds', 'pending_fills')
+
+
+class AbandonedStream(Protocol):
+    """
+    Requests a stream and drops the connection once ``read_bytes`` bytes of
+    the response have been received or ``hold`` seconds have passed,
+    whichever comes first.
+
+    ``done`` fires with the status line of the response, or ``None`` if the
+    connection was dropped before it was received.
+    """
+
+    def __init__(self, reactor, path, read_bytes, hold, done):
+        self.reactor = reactor
+        self.path = path
+        self.read_bytes = read_bytes
+        self.hold = hold
+        self.received = ""
+        self.done = done
+        self._abandon_call = None
+
+    def connectionMade(self):
+        self.transport.write((
+            "GET %s HTTP/1.1\r\n"
+            "Host: 127.0.0.1\r\n"
+            "X-Owner-ID: %s\r\n"
+            "Connection: close\r\n\r\n" % (self.path, OWNER)).encode("utf-8"))
+        if self.read_bytes == 0:
+            self.transport.abortConnection()
+        else:
+            self._abandon_call = self.reactor.callLater(
+                self.hold, self.transport.abortConnection)
+
+    def dataReceived(self, data):
+        self.received += data
+        if len(self.received) >= self.read_bytes:
+            self.transport.abortConnection()
+
+    def connectionLost(self, reason):
+        if self._abandon_call is not None and self._abandon_call.active():
+            self._abandon_call.cancel()
+        status = None
+        if "\r\n" in self.received:
+            status = self.received.split("\r\n", 1)[0]
+        self.done.callback(status)
+
+
+class AbandonedStreamFactory(ClientFactory):
+    noisy = False
+
+    def __init__(self, reactor, path, read_bytes, hold):
+        self.reactor = reactor
+        self.path = path
+        self.read_bytes = read_bytes
+        self.hold = hold
+        self.done = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        return AbandonedStream(
+            self.reactor, self.path, self.read_bytes, self.hold, self.done)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.done.errback(reason)
+
+
+def rss_mb():
+    """
+    Return the process's resident set size in MB. Where ``/proc`` isn't
+    available the peak RSS is returned instead.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / (1024.0 * 1024)
+    except IOError:
+        # ru_maxrss is in KB on Linux but in bytes on OS X.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            maxrss /= 1024
+        return maxrss / 1024.0
+
+
+def measure():
+    gc.collect()
+    counts = dict((name, 0) for name in MEASUREMENTS)
+    for obj in gc.get_objects():
+        if isinstance(obj, PausingDeferredQueue):
+            counts['queues'] += 1
+        elif isinstance(obj, defer.Deferred):
+            counts['deferreds'] += 1
+        elif isinstance(obj, _QueueFiller) and not obj.finished:
+            counts['pending_fills'] += 1
+    counts['rss_mb'] = rss_mb()
+    return counts
+
+
+class StreamSoak(object):
+    """
+    Repeatedly abandons streams and measures what is left behind.
+    """
+
+    def __init__(self, reactor, args):
+        self.reactor = reactor
+        self.args = args
+        self.rand = random.Random(0)
+        self.samples = []
+        self.statuses = {}
+
+    def start(self):
+        manager = InMemoryRiakManager(
+            bucket_prefix="bench.", latency=self.args.latency,
+            reactor=self.reactor)
+        load_contacts(manager, self.args.contacts, extras=5)
+        store = ContactStore(manager, OWNER)
+        for i in xrange(2, self.args.groups):
+            store.manager.put_object(make_group_model(
+                store, make_group_dict(i, smart=(i % 2 == 1), owner=OWNER)))
+        self.port = self.reactor.listenTCP(
+            0, make_api(manager, self.args.page_size), interface="127.0.0.1")
+
+    def stop(self):
+        return self.port.stopListening()
+
+    def abandon_stream(self):
+        factory = AbandonedStreamFactory(
+            self.reactor, self.rand.choice(STREAM_PATHS),
+            self.rand.randint(0, self.args.read_bytes),
+            self.rand.uniform(0, self.args.max_hold))
+        self.reactor.connectTCP(
+            "127.0.0.1", self.port.getHost().port, factory)
+        return factory.done.addCallback(self.record_status)
+
+    def record_status(self, status):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    @defer.inlineCallbacks
+    def run_round(self):
+        yield defer.gatherResults([
+            self.abandon_stream() for _ in xrange(self.args.streams)],
+            consumeErrors=True)
+        yield task.deferLater(self.reactor, self.args.settle, lambda: None)
+        self.samples.append(measure())
+
+    def check(self):
+        """
+        Return a list of the measurements that grew by more than allowed
+        after the warm-up rounds.
+        """
+        # The first sample is taken before the first round.
+        baseline = self.samples[self.args.warmup]
+        final = self.samples[-1]
+        limits = {
+            'rss_mb': self.args.max_rss_growth,
+            'queues': self.args.max_object_growth,
+            'deferreds': self.args.max_object_growth,
+            'pending_fills': self.args.max_object_growth,
+        }
+        failures = []
+        for name in MEASUREMENTS:
+            growth = final[name] - baseline[name]
+            if growth > limits[name]:
+                failures.append(
+                    "%s grew by %s (from %s to %s), more than %s" % (
+                        name, growth, baseline[name], final[name],
+                        limits[name]))
+        return failures
+
+    @defer.inlineCallbacks
+    def run(self, out):
+        self.start()
+        try:
+            self.samples.append(measure())
+            for i in xrange(self.args.rounds):
+                start = time.time()
+                yield self.run_round()
+                if not self.args.json:
+                    report_sample(out, i + 1, self.samples[-1],
+                                  time.time() - start)
+        finally:
+            yield self.stop()
+        defer.returnValue(self.check())
+
+
+def report_sample(out, round_number, sample, elapsed):
+    out.write(
+        "round %4d  %6.1f s  rss %7.1f MB  queues %5d  deferreds %6d  "
+        "pending fills %5d\n" % (
+            round_number, elapsed, sample['rss_mb'], sample['queues'],
+            sample['deferreds'], sample['pending_fills']))
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    soak = StreamSoak(reactor, args)
+    failures = yield soak.run(sys.stdout)
+    if args.json:
+        json.dump({
+            "samples": soak.samples,
+            "statuses": soak.statuses,
+            "failures": failures,
+        }, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        sys.stdout.write("Responses: %s\n" % (", ".join(
+            "%s: %d" % (status, count)
+            for status, count in sorted(soak.statuses.items())),))
+    if failures:
+        for failure in failures:
+            sys.stderr.write("FAIL: %s\n" % (failure,))
+        raise SystemExit(1)
+
+
+def start_logging():
+    """
+    Log warnings and errors to stderr. Until logging starts, Twisted keeps
+    every log event in memory, along with the objects they refer to.
+    """
+    predicate = LogLevelFilterPredicate(defaultLogLevel=LogLevel.warn)
+    globalLogBeginner.beginLoggingTo([
+        FilteringLogObserver(textFileLogObserver(sys.stderr), [predicate])],
+        redirectStandardIO=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--contacts", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument(
+        "--streams", type=int, default=20,
+        help="Streams opened at once in each round.")
+    parser.add_argument(
+        "--read-bytes", type=int, default=16384,
+        help="The most bytes read from a stream before it is dropped.")
+    parser.add_argument(
+        "--max-hold", type=float, default=0.5,
+        help="The most seconds a stream is held open before it is dropped.")
+    parser.add_argument(
+        "--settle", type=float, default=0.5,
+        help="Seconds to wait after each round before measuring.")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=parse_latency, default=0)
+    parser.add_argument(
+        "--max-rss-growth", type=float, default=20,
+        help="MB the RSS may grow by after the warm-up rounds.")
+    parser.add_argument(
+        "--max-object-growth", type=int, default=50,
+        help="Number of queues, deferreds or pending fills that may be "
+             "added after the warm-up rounds.")
+    parser.add_argument(
+        "--json", action="store_true", help="Write the results as JSON.")
+    args = parser.parse_args(argv)
+    if not 0 < args.warmup <= args.rounds:
+        parser.error("--warmup must be between 1 and --rounds")
+    start_logging()
+    task.react(run, [args])
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@
 Riak contacts backend and collection.
 """
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
 from zope.interface import implementer
 
 from vumi.persist.fields import ValidationError
@@ -38,21 +38,90 @@ def contact_to_dict(contact):
 
 
 class RiakContactsBackend(object):
-    def __init__(self, riak_manager, max_contacts_per_page):
+    """
+    :param int max_contacts_per_page:
+        Maximum number of contacts returned per page.
+    :param SingleFlight single_flight:
+        If given, identical concurrent reads from the collections share a
+        single Riak call.
+    :param SmartGroupMemberships memberships:
+        If given, it is told about every contact written through the
+        collections, and the written contacts are added to or removed from
+        the smart group memberships it keeps.
+    """
+
+    def __init__(self, riak_manager, max_contacts_per_page,
+                 single_flight=None, memberships=None):
         self.riak_manager = riak_manager
         self.max_contacts_per_page = max_contacts_per_page
+        self.single_flight = single_flight
+        self.memberships = memberships
 
-    def get_contact_collection(self, owner_id):
-        contact_store = ContactStore(self.riak_manager, owner_id)
+    def get_contact_collection(self, owner_id, riak_manager=None):
+        """
+        Return the contacts collection for ``owner_id``.
+
+        :param riak_manager:
+            The Riak manager to use for this collection. Defaults to the
+            backend's manager.
+        """
+        if riak_manager is None:
+            riak_manager = self.riak_manager
+        contact_store = ContactStore(riak_manager, owner_id)
         return RiakContactsCollection(
-            contact_store, self.max_contacts_per_page)
+            contact_store, self.max_contacts_per_page,
+            single_flight=self.single_flight, memberships=self.memberships)
 
 
 @implementer(ICollection)
 class RiakContactsCollection(object):
-    def __init__(self, contact_store, max_contacts_per_page):
+    def __init__(self, contact_store, max_contacts_per_page,
+                 single_flight=None, memberships=None):
         self.contact_store = contact_store
         self.max_contacts_per_page = max_contacts_per_page
+        self.single_flight = single_flight
+        self.memberships = memberships
+
+    def _coalesce(self, key, func, *args):
+        """
+        Call ``func``, sharing the call with any identical in-flight call for
+        the same owner if we have a :class:`SingleFlight`.
+        """
+        if self.single_flight is None:
+            return maybeDeferred(func, *args)
+        key = (key[0], self.contact_store.user_account_key) + key[1:]
+        return self.single_flight.run(key, func, *args)
+
+    def _forget(self, object_id=None):
+        """
+        Stop sharing in-flight reads that a change to a contact may affect.
+        Address lookups may be affected by any change.
+        """
+        if self.single_flight is None:
+            return
+        owner = self.contact_store.user_account_key
+        if object_id is not None:
+            self.single_flight.forget(('contact', owner, object_id))
+        self.single_flight.forget_prefix(('contact-addr', owner))
+
+    def _written(self, contact_key, contact=None):
+        """
+        Update the smart group memberships with a contact that was written,
+        or deleted if ``contact`` is ``None``, and note the change so that
+        the owner's memberships are refreshed.
+        """
+        if self.memberships is None:
+            return
+        owner = self.contact_store.user_account_key
+        data = None
+        if contact is not None:
+            # Riak Search indexes the stored data, which has no key field.
+            # ``get_data`` returns the Riak object's own dict, so it's copied
+            # before the key is removed.
+            data = dict(contact.get_data())
+            data.pop('key', None)
+        self.memberships.contact_written(owner, contact_key, data)
+        self.memberships.contacts_changed(owner)
 
     @staticmethod
     def _pick_fields(data, keys):
@@ -105,14 +174,19 @@ class RiakContactsCollection(object):
                 sorted(Contact.ADDRESS_FIELDS))
 
         value = normalize_addr(field, value)
+        contact = yield self._coalesce(
+            ('contact-addr', field, value), self._get_by_addr, field, value)
+        returnValue([contact])
+
+    @inlineCallbacks
+    def _get_by_addr(self, field, value):
         try:
             contact = yield self.contact_store.contact_for_addr_field(
                 field, value, create=False)
         except ContactNotFoundError:
             raise CollectionObjectNotFound(
                 'Contact with %s %s' % (field, value))
-
-        returnValue([contact_to_dict(contact)])
+        returnValue(contact_to_dict(contact))
 
     def stream(self, query):
         """
@@ -189,12 +263,15 @@ class RiakContactsCollection(object):
 
         returnValue((cursor, contact_list))
 
-    @inlineCallbacks
     def get(self, object_id):
         """
         Return a single object from the collection. May return a deferred
         instead of the object.
         """
+        return self._coalesce(('contact', object_id), self._get, object_id)
+
+    @inlineCallbacks
+    def _get(self, object_id):
         try:
             contact = yield self.contact_store.get_contact_by_key(object_id)
         except ContactNotFoundError:
@@ -216,6 +293,9 @@ class RiakContactsCollection(object):
             contact = yield self.contact_store.new_contact(**fields)
         except ValidationError, e:
             raise CollectionUsageError(str(e))
+        finally:
+            self._forget()
+        self._written(contact.key, contact)
         returnValue((contact.key, contact_to_dict(contact)))
 
     @inlineCallbacks
@@ -233,6 +313,9 @@ class RiakContactsCollection(object):
             raise CollectionObjectNotFound(object_id, "Contact")
         except ValidationError, e:
             raise CollectionUsageError(str(e))
+        finally:
+            self._forget(object_id)
+        self._written(object_id, contact)
         returnValue(contact_to_dict(contact))
 
     @inlineCallbacks
@@ -245,5 +328,9 @@ class RiakContactsCollection(object):
         except ContactNotFoundError:
             raise CollectionObjectNotFound(object_id, "Contact")
         contact_data = contact_to_dict(contact)
-        yield contact.delete()
+        try:
+            yield contact.delete()
+        finally:
+            self._forget(object_id)
+        self._written(object_id)
         returnValue(contact_data)
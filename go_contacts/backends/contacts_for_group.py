@@ -13,24 +13,60 @@ from .utils import _get_page_of_keys, _fill_queue, _get_smart_page_of_keys
 
 
 class ContactsForGroupBackend(object):
-    def __init__(self, riak_manager, max_contacts_per_page):
+    """
+    :param int max_contacts_per_page:
+        Maximum number of contacts returned per page.
+    :param SmartGroupMemberships memberships:
+        If given, the contacts matching smart group queries are read from
+        the memberships it keeps, rather than searched for on every page.
+    """
+
+    def __init__(self, riak_manager, max_contacts_per_page,
+                 memberships=None):
         self.riak_manager = riak_manager
         self.max_contacts_per_page = max_contacts_per_page
+        self.memberships = memberships
 
-    def get_model(self, owner_id):
-        contact_store = ContactStore(self.riak_manager, owner_id)
+    def get_model(self, owner_id, riak_manager=None):
+        """
+        Return the contacts for group model for ``owner_id``.
+
+        :param riak_manager:
+            The Riak manager to use for this model. Defaults to the backend's
+            manager.
+        """
+        if riak_manager is None:
+            riak_manager = self.riak_manager
+        contact_store = ContactStore(riak_manager, owner_id)
         return RiakContactsForGroupModel(
-            contact_store, self.max_contacts_per_page)
+            contact_store, self.max_contacts_per_page,
+            memberships=self.memberships)
 
 
 class RiakContactsForGroupModel(object):
+    """
+    If the model has a :class:`SmartGroupMemberships` and it keeps a fresh
+    membership for a smart group, the contacts matching the group's query
+    are read from the membership and ``membership_age`` is set to the number
+    of seconds since the membership was refreshed. Contacts written since
+    then may be missing or included wrongly. Otherwise they are searched for.
+
+    Pages read from a membership have their own cursors, so that a client
+    paging through a group keeps reading from the same source. If the
+    membership is dropped while a client is paging through it, the rest of
+    the pages are searched for and may repeat or skip contacts.
+    """
 
     DYNAMIC_CURSOR = 'dynamicgroup'
+    MEMBERSHIP_CURSOR = 'smartgroup'
     STATIC_CURSOR = 'staticgroup'
 
-    def __init__(self, contact_store, max_contacts_per_page):
+    def __init__(self, contact_store, max_contacts_per_page,
+                 memberships=None):
         self.contact_store = contact_store
         self.max_contacts_per_page = max_contacts_per_page
+        self.memberships = memberships
+        self.membership_age = None
 
     def _get_contact_dict(self, key):
         """
@@ -47,9 +83,9 @@ class RiakContactsForGroupModel(object):
         if cursor_type == self.STATIC_CURSOR:
             encoded_value = value if value is not None else ''
             encoded = self.STATIC_CURSOR + encoded_value
-        elif cursor_type == self.DYNAMIC_CURSOR:
+        elif cursor_type in (self.DYNAMIC_CURSOR, self.MEMBERSHIP_CURSOR):
             encoded_value = str(value) if value is not None else ''
-            encoded = self.DYNAMIC_CURSOR + encoded_value
+            encoded = cursor_type + encoded_value
         else:
             raise ValueError("Invalid cursor type %r" % (cursor_type,))
         return encoded.encode("rot13")
@@ -66,15 +102,32 @@ class RiakContactsForGroupModel(object):
             if not value:
                 value = None
             return self.STATIC_CURSOR, value
-        elif decoded.startswith(self.DYNAMIC_CURSOR):
-            value = decoded[len(self.DYNAMIC_CURSOR):]
-            if not value:
-                value = 0
-            else:
-                value = int(value)
-            return self.DYNAMIC_CURSOR, value
+        for cursor_type in (self.DYNAMIC_CURSOR, self.MEMBERSHIP_CURSOR):
+            if decoded.startswith(cursor_type):
+                value = decoded[len(cursor_type):]
+                if not value:
+                    value = 0
+                else:
+                    value = int(value)
+                return cursor_type, value
         raise ValueError("Invalid cursor %r" % (encoded_cursor,))
 
+    def _get_membership(self, group):
+        """
+        Return the fresh :class:`Membership` of the smart group ``group``
+        and record its age, or return ``None`` if the group's contacts must
+        be searched for.
+        """
+        memberships = self.memberships
+        if (memberships is None or group is None or
+                not group.is_smart_group()):
+            return None
+        membership = memberships.get(self.contact_store, group)
+        if membership is not None:
+            self.membership_age = membership.age(
+                memberships.reactor.seconds())
+        return membership
+
     @inlineCallbacks
     def stream(self, group_id, query):
         """
@@ -97,6 +150,7 @@ class RiakContactsForGroupModel(object):
         max_results = self.max_contacts_per_page
         model_proxy = self.contact_store.contacts
         group = yield self.contact_store.get_group(group_id)
+        membership = self._get_membership(group)
 
         def get_page(cursor):
             return _get_page_of_keys(
@@ -104,7 +158,9 @@ class RiakContactsForGroupModel(object):
                 field_name='groups')
 
         def get_page_smart(cursor):
-            if group and group.is_smart_group():
+            if membership is not None:
+                keys_d = succeed(membership.page(cursor or 0, max_results))
+            elif group and group.is_smart_group():
                 keys_d = _get_smart_page_of_keys(
                     model_proxy, max_results, cursor, group.query)
             else:
@@ -169,12 +225,23 @@ class RiakContactsForGroupModel(object):
             else:
                 cursor = self._encode_cursor(self.STATIC_CURSOR, cursor)
 
-        elif cursor_type == self.DYNAMIC_CURSOR:
+        elif cursor_type in (self.DYNAMIC_CURSOR, self.MEMBERSHIP_CURSOR):
             group = yield self.contact_store.get_group(group_id)
-            cursor, contact_keys = yield _get_smart_page_of_keys(
-                model_proxy, max_results, decoded_cursor, group.query)
+            membership = None
+            # Searches may order contacts differently, so clients already
+            # paging through search results keep doing so.
+            if cursor_type == self.MEMBERSHIP_CURSOR or decoded_cursor == 0:
+                membership = self._get_membership(group)
+            if membership is not None:
+                cursor, contact_keys = membership.page(
+                    decoded_cursor, max_results)
+                next_cursor_type = self.MEMBERSHIP_CURSOR
+            else:
+                cursor, contact_keys = yield _get_smart_page_of_keys(
+                    model_proxy, max_results, decoded_cursor, group.query)
+                next_cursor_type = self.DYNAMIC_CURSOR
             if cursor is not None:
-                cursor = self._encode_cursor(self.DYNAMIC_CURSOR, cursor)
+                cursor = self._encode_cursor(next_cursor_type, cursor)
 
         else:
             raise CollectionUsageError(
@@ -0,0 +1,173 @@
+"""
+Injection of latency and failures into Riak calls.
+
+:class:`FaultInjectingRiakManager` delays each Riak call by a random amount
+and fails a fraction of them, so that tests and benchmarks can see how the
+backends behave against a slow or unreliable Riak cluster without needing
+one.
+"""
+
+import random
+
+from twisted.internet.task import deferLater
+
+from vumi.persist.model import VumiRiakError
+
+from .wrapper import RiakManagerWrapper
+
+
+# The ways a delay may be drawn around an operation's latency.
+DISTRIBUTIONS = ('uniform', 'normal', 'exponential')
+
+# Names operations are also known by. Bunch loads share the spec for loads.
+OPERATION_ALIASES = {
+    'save': 'store',
+    'load_bunch': 'load',
+}
+
+# The fault spec key that applies to operations without their own spec.
+DEFAULT_OPERATION = '*'
+
+
+class InjectedFault(VumiRiakError):
+    """
+    Raised by Riak calls that were chosen to fail.
+    """
+
+
+class FaultSpec(object):
+    """
+    The latency and error rate of an operation.
+
+    :param float latency:
+        The mean number of seconds the operation takes.
+    :param float jitter:
+        How far the delay may be from ``latency``. For the ``uniform``
+        distribution this is the furthest the delay may be from
+        ``latency``, for the ``normal`` distribution it is the standard
+        deviation. It is ignored by the ``exponential`` distribution.
+    :param str distribution:
+        One of ``uniform``, ``normal`` or ``exponential``.
+    :param float error_rate:
+        The fraction of calls, between 0 and 1, that fail with
+        :class:`InjectedFault`.
+    """
+
+    def __init__(self, latency=0, jitter=0, distribution='uniform',
+                 error_rate=0):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(
+                "Unknown latency distribution %r, must be one of: %s" % (
+                    distribution, ", ".join(DISTRIBUTIONS)))
+        if latency < 0 or jitter < 0:
+            raise ValueError("Latency and jitter may not be negative.")
+        if not 0 <= error_rate <= 1:
+            raise ValueError("Error rate must be between 0 and 1.")
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.error_rate = error_rate
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build a spec from a dict of its parameters, or from a number of
+        seconds for a fixed latency. Specs are returned unchanged.
+        """
+        if isinstance(config, cls):
+            return config
+        if isinstance(config, (int, long, float)):
+            return cls(latency=config)
+        return cls(**config)
+
+    def delay(self, rand):
+        """
+        Return the number of seconds a call should take.
+        """
+        if self.distribution == 'exponential':
+            if self.latency == 0:
+                return 0
+            return rand.expovariate(1.0 / self.latency)
+        if self.distribution == 'normal':
+            delay = rand.gauss(self.latency, self.jitter)
+        else:
+            delay = rand.uniform(
+                self.latency - self.jitter, self.latency + self.jitter)
+        return max(0, delay)
+
+    def fails(self, rand):
+        """
+        Return ``True`` if a call should fail.
+        """
+        return self.error_rate > 0 and rand.random() < self.error_rate
+
+
+def parse_fault_specs(config):
+    """
+    Build a dict of :class:`FaultSpec` by operation name from a dict of
+    configs for :meth:`FaultSpec.from_config`.
+
+    ``save`` may be used for ``store``, the ``load`` spec also applies to
+    ``load_bunch`` calls and ``*`` gives the spec for operations without
+    their own.
+    """
+    specs = {}
+    for name, spec_config in config.iteritems():
+        name = OPERATION_ALIASES.get(name, name)
+        specs[name] = FaultSpec.from_config(spec_config)
+    return specs
+
+
+class FaultInjectingRiakManager(RiakManagerWrapper):
+    """
+    A Riak manager wrapper that delays Riak calls and makes some of them
+    fail, according to a :class:`FaultSpec` for each operation.
+
+    Failing calls fail after their delay without reaching the wrapped
+    manager. The number of calls and failures of each operation are kept in
+    ``calls`` and ``faults``.
+
+    :param manager:
+        The Riak manager to wrap.
+    :param dict specs:
+        :class:`FaultSpec`, or configs for :meth:`FaultSpec.from_config`, by
+        operation name (e.g. ``load``, ``store``, ``index_keys_page`` or
+        ``real_search``). See :func:`parse_fault_specs`.
+    :param int seed:
+        A seed for the random choices, so that runs can be repeated.
+    :param reactor:
+        The reactor to schedule delays with. Defaults to the global reactor.
+    """
+
+    def __init__(self, manager, specs, seed=None, reactor=None):
+        super(FaultInjectingRiakManager, self).__init__(manager)
+        if reactor is None:
+            from twisted.internet import reactor
+        self.specs = parse_fault_specs(specs)
+        self.rand = random.Random(seed)
+        self.reactor = reactor
+        self.calls = {}
+        self.faults = {}
+
+    def get_spec(self, name):
+        """
+        Return the :class:`FaultSpec` for an operation, or ``None`` if it
+        is left alone.
+        """
+        name = OPERATION_ALIASES.get(name, name)
+        return self.specs.get(name, self.specs.get(DEFAULT_OPERATION))
+
+    def wrap_call(self, name, func, *args, **kw):
+        spec = self.get_spec(name)
+        if spec is None:
+            return super(FaultInjectingRiakManager, self).wrap_call(
+                name, func, *args, **kw)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if spec.fails(self.rand):
+            self.faults[name] = self.faults.get(name, 0) + 1
+            func, args, kw = self._fail, (name,), {}
+        return deferLater(
+            self.reactor, spec.delay(self.rand), func, *args, **kw)
+
+    def _fail(self, name):
+        raise InjectedFault("Injected failure of Riak %s call." % (name,))
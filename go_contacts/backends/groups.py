@@ -37,21 +37,50 @@ def settable_group_fields(**fields):
 
 
 class RiakGroupsBackend(object):
-    def __init__(self, riak_manager, max_groups_per_page):
+    """
+    :param int max_groups_per_page:
+        Maximum number of groups returned per page.
+    :param SingleFlight single_flight:
+        If given, identical concurrent reads from the collections share a
+        single Riak call.
+    """
+
+    def __init__(self, riak_manager, max_groups_per_page, single_flight=None):
         self.riak_manager = riak_manager
         self.max_groups_per_page = max_groups_per_page
+        self.single_flight = single_flight
 
-    def get_group_collection(self, owner_id):
-        contact_store = ContactStore(self.riak_manager, owner_id)
-        return RiakGroupsCollection(contact_store, self.max_groups_per_page)
+    def get_group_collection(self, owner_id, riak_manager=None):
+        """
+        Return the groups collection for ``owner_id``.
+
+        :param riak_manager:
+            The Riak manager to use for this collection. Defaults to the
+            backend's manager.
+        """
+        if riak_manager is None:
+            riak_manager = self.riak_manager
+        contact_store = ContactStore(riak_manager, owner_id)
+        return RiakGroupsCollection(
+            contact_store, self.max_groups_per_page,
+            single_flight=self.single_flight)
 
 
 @implementer(ICollection)
 class RiakGroupsCollection(object):
 
-    def __init__(self, contact_store, max_groups_per_page):
+    def __init__(self, contact_store, max_groups_per_page,
+                 single_flight=None):
         self.contact_store = contact_store
         self.max_groups_per_page = max_groups_per_page
+        self.single_flight = single_flight
+
+    def _group_key(self, object_id):
+        return ('group', self.contact_store.user_account_key, object_id)
+
+    def _forget(self, object_id):
+        if self.single_flight is not None:
+            self.single_flight.forget(self._group_key(object_id))
 
     @classmethod
     def _pick_group_fields(cls, data):
@@ -158,12 +187,18 @@ class RiakGroupsCollection(object):
             group_list.append(group)
         returnValue((cursor, group_list))
 
-    @inlineCallbacks
     def get(self, object_id):
         """
         Return a single object from the collection. May return a deferred
         instead of the object.
         """
+        if self.single_flight is None:
+            return self._get(object_id)
+        return self.single_flight.run(
+            self._group_key(object_id), self._get, object_id)
+
+    @inlineCallbacks
+    def _get(self, object_id):
         group = yield self.contact_store.get_group(object_id)
         if not isinstance(group, ContactGroup):
             raise CollectionObjectNotFound(object_id, u'Group')
@@ -211,7 +246,10 @@ class RiakGroupsCollection(object):
                 setattr(group, field_name, field_value)
         except ValidationError, e:
             raise CollectionUsageError(str(e))
-        yield group.save()
+        try:
+            yield group.save()
+        finally:
+            self._forget(object_id)
         returnValue(group_to_dict(group))
 
     @inlineCallbacks
@@ -223,5 +261,8 @@ class RiakGroupsCollection(object):
         if not isinstance(group, ContactGroup):
             raise CollectionObjectNotFound(object_id, u'Group')
         group_data = group_to_dict(group)
-        yield group.delete()
+        try:
+            yield group.delete()
+        finally:
+            self._forget(object_id)
         returnValue(group_data)
@@ -0,0 +1,210 @@
+"""
+Accounting of the Riak operations made while handling requests.
+"""
+
+import time
+from collections import OrderedDict
+
+from twisted.python.failure import Failure
+
+from .wrapper import RiakManagerWrapper
+
+
+# The category each wrapped Riak operation is counted in. Map reduce jobs
+# are only used to find the members of smart groups, which is a search.
+OPERATION_CATEGORIES = {
+    'load': 'gets',
+    'load_bunch': 'gets',
+    'index_keys': 'index_queries',
+    'index_keys_page': 'index_queries',
+    'real_search': 'searches',
+    'run_map_reduce': 'searches',
+    'store': 'writes',
+    'delete': 'writes',
+}
+
+CATEGORIES = ('gets', 'index_queries', 'searches', 'writes')
+
+# The operations that fetch a page of keys, for static groups and
+# collections (``_get_page_of_keys``) and for smart groups
+# (``_get_smart_page_of_keys``).
+KEY_PAGE_OPERATIONS = ('index_keys_page', 'real_search')
+
+
+class RiakOperationStats(object):
+    """
+    Counts of Riak operations and the total time spent waiting for them.
+
+    ``time`` is the sum of the time each operation took, so it may be more
+    than the wall clock time if operations ran concurrently. ``objects`` is
+    the number of objects loaded and ``key_pages`` is the number of pages of
+    keys fetched.
+
+    The time taken by each of the first ``max_key_page_times`` pages of keys
+    is kept in ``key_page_times`` as a list of ``(name, duration)`` tuples.
+    """
+
+    def __init__(self, max_key_page_times=100):
+        self.counts = dict((category, 0) for category in CATEGORIES)
+        self.time = 0.0
+        self.objects = 0
+        self.key_pages = 0
+        self.max_key_page_times = max_key_page_times
+        self.key_page_times = []
+
+    def record(self, name, duration, objects=0):
+        """
+        Record a Riak operation.
+
+        :param str name:
+            The name of the operation, e.g. ``load``.
+        :param float duration:
+            The number of seconds the operation took.
+        :param int objects:
+            The number of objects the operation loaded.
+        """
+        self.counts[OPERATION_CATEGORIES[name]] += 1
+        self.time += duration
+        self.objects += objects
+        if name in KEY_PAGE_OPERATIONS:
+            self.key_pages += 1
+            if len(self.key_page_times) < self.max_key_page_times:
+                self.key_page_times.append((name, duration))
+
+    def add(self, other):
+        """
+        Add the counts and time from another :class:`RiakOperationStats`.
+        Key page times aren't added.
+        """
+        for category in CATEGORIES:
+            self.counts[category] += other.counts[category]
+        self.time += other.time
+        self.objects += other.objects
+        self.key_pages += other.key_pages
+
+    def as_dict(self):
+        stats = dict(self.counts)
+        stats['time'] = self.time
+        return stats
+
+
+def count_objects(name, result):
+    """
+    Return the number of objects loaded by an operation.
+    """
+    if isinstance(result, Failure):
+        return 0
+    if name == 'load':
+        return 0 if result is None else 1
+    if name == 'load_bunch':
+        return len([obj for obj in result if obj is not None])
+    return 0
+
+
+class InstrumentedRiakManager(RiakManagerWrapper):
+    """
+    A Riak manager wrapper that records every Riak operation in a
+    :class:`RiakOperationStats`.
+
+    :param manager:
+        The Riak manager to wrap.
+    :param RiakOperationStats stats:
+        The stats to record operations in.
+    :param clock:
+        A function returning the current time in seconds. Defaults to
+        :func:`time.time`.
+    """
+
+    def __init__(self, manager, stats, clock=time.time):
+        super(InstrumentedRiakManager, self).__init__(manager)
+        self.stats = stats
+        self.clock = clock
+
+    def wrap_call(self, name, func, *args, **kw):
+        start = self.clock()
+        d = super(InstrumentedRiakManager, self).wrap_call(
+            name, func, *args, **kw)
+
+        def record(result):
+            self.stats.record(
+                name, self.clock() - start, count_objects(name, result))
+            return result
+        return d.addBoth(record)
+
+
+class RiakStatsAggregator(object):
+    """
+    Totals of the Riak operations made by requests, by route and by route
+    and owner.
+
+    :param int max_owner_totals:
+        The maximum number of route and owner totals kept. The totals of the
+        least recently seen route and owner are dropped first. The route
+        totals include every request.
+    """
+
+    def __init__(self, max_owner_totals=10000):
+        self.max_owner_totals = max_owner_totals
+        self._route_totals = {}
+        self._totals = OrderedDict()
+
+    def record(self, route, owner_id, stats):
+        """
+        Add the stats for a request.
+
+        :param str route:
+            The route that handled the request, e.g. ``/contacts/:elem_id``.
+        :param str owner_id:
+            The owner the request was made for.
+        :param RiakOperationStats stats:
+            The Riak operations made by the request.
+        """
+        totals = self._route_totals.get(route)
+        if totals is None:
+            totals = self._route_totals[route] = _RouteTotals()
+        totals.add(stats)
+
+        key = (route, owner_id)
+        totals = self._totals.pop(key, None)
+        if totals is None:
+            totals = _RouteTotals()
+        self._totals[key] = totals
+        totals.add(stats)
+        while len(self._totals) > self.max_owner_totals:
+            self._totals.popitem(last=False)
+
+    def get_totals(self):
+        """
+        Return a list of dicts of the totals for each route and owner kept,
+        with ``route``, ``owner_id`` and ``requests`` keys as well as the
+        keys from :meth:`RiakOperationStats.as_dict`.
+        """
+        results = []
+        for (route, owner_id), totals in sorted(self._totals.iteritems()):
+            result = totals.stats.as_dict()
+            result.update({
+                'route': route,
+                'owner_id': owner_id,
+                'requests': totals.requests,
+            })
+            results.append(result)
+        return results
+
+    def get_route_totals(self):
+        """
+        Return a dict mapping each route to a :class:`RiakOperationStats`
+        with the totals for all owners.
+        """
+        return dict(
+            (route, totals.stats)
+            for route, totals in self._route_totals.iteritems())
+
+
+class _RouteTotals(object):
+    def __init__(self):
+        self.requests = 0
+        self.stats = RiakOperationStats()
+
+    def add(self, stats):
+        self.requests += 1
+        self.stats.add(stats)
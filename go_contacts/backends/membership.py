@@ -0,0 +1,405 @@
+"""
+Materialized membership of smart groups.
+
+Every page of a smart group's contacts would otherwise need a Riak Search
+query, and searches are the most expensive Riak operation we make.
+:class:`SmartGroupMemberships` keeps the keys of the contacts in each smart
+group that has been read recently, so that pages and streams of its contacts
+can be served from them. Requests for a group without fresh keys are served
+by searching as before, while the group's keys are searched for in the
+background. Kept keys are refreshed the same way once they are older than
+``max_age``. They may also be refreshed on a schedule and after contacts are
+written, so that requests rarely find them stale.
+
+Contacts written through the API are also matched against the queries of
+their owner's kept memberships as they are written, and added to or removed
+from them straight away. Queries are matched with
+:func:`go_contacts.backends.search.compile_query`, which doesn't analyze
+field values the way Riak Search does, so a membership may differ from a
+search for it until it is next refreshed.
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from go.vumitools.contact import ContactStore
+
+from .search import SearchQueryError, compile_query
+from .singleflight import SingleFlight
+
+
+class Membership(object):
+    """
+    The sorted keys of the contacts matching a smart group's query, as of
+    ``refreshed_at``.
+
+    :param unicode query:
+        The query the keys were searched for.
+    :param list keys:
+        The sorted contact keys, or ``None`` if there were too many to keep.
+    :param float refreshed_at:
+        When the search for the keys started, so that contacts written
+        after this time may be missing.
+    """
+
+    def __init__(self, query, keys, refreshed_at):
+        self.query = query
+        self.keys = keys
+        self.refreshed_at = refreshed_at
+        self._matcher = None
+
+    @property
+    def size(self):
+        """
+        The number of keys kept.
+        """
+        return len(self.keys) if self.keys is not None else 0
+
+    def age(self, now):
+        return max(0, now - self.refreshed_at)
+
+    def page(self, start, max_results):
+        """
+        Return ``(cursor, keys)`` for up to ``max_results`` keys from index
+        ``start``. The cursor is the index of the next page, or ``None`` if
+        this is the last page.
+        """
+        keys = self.keys[start:start + max_results]
+        cursor = start + len(keys)
+        if not keys or cursor >= len(self.keys):
+            cursor = None
+        return cursor, keys
+
+    def apply(self, key, data):
+        """
+        Add ``key`` to the keys if ``data`` matches the query and remove it
+        if not. ``data`` is the contact's Riak data, or ``None`` if the
+        contact was deleted.
+
+        :return:
+            Whether the keys changed.
+        :raises SearchQueryError:
+            If the query can't be matched against contact data.
+        """
+        if self.keys is None:
+            return False
+        if self._matcher is None:
+            self._matcher = compile_query(self.query)
+        matches = data is not None and self._matcher(data)
+        index = bisect_left(self.keys, key)
+        present = index < len(self.keys) and self.keys[index] == key
+        if matches and not present:
+            self.keys.insert(index, key)
+        elif present and not matches:
+            del self.keys[index]
+        else:
+            return False
+        return True
+
+
+class SmartGroupMemberships(object):
+    """
+    Keeps the :class:`Membership` of recently read smart groups.
+
+    :param riak_manager:
+        The Riak manager used to refresh memberships in the background.
+    :param float max_age:
+        The number of seconds a membership may be used for after it was
+        refreshed. Older memberships are refreshed before they are used.
+    :param float refresh_interval:
+        If given, the memberships read since the last refresh are refreshed
+        every ``refresh_interval`` seconds once :meth:`start` has been
+        called, and the others are dropped.
+    :param float write_refresh_delay:
+        If given, an owner's memberships are refreshed this many seconds
+        after one of their contacts is written. Writes made before the
+        refresh starts share it.
+    :param int max_groups:
+        The maximum number of memberships kept. The least recently read are
+        dropped first.
+    :param int max_keys:
+        The maximum number of keys kept across all memberships. The least
+        recently read memberships are dropped first, and the keys of a group
+        with more contacts than this aren't kept at all.
+    :param int search_page_size:
+        The number of keys fetched by each search when refreshing.
+    :param reactor:
+        The reactor to schedule refreshes with. Defaults to the global
+        reactor.
+    """
+
+    def __init__(self, riak_manager, max_age, refresh_interval=None,
+                 write_refresh_delay=None, max_groups=1000,
+                 max_keys=1000000, search_page_size=1000, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.riak_manager = riak_manager
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self.write_refresh_delay = write_refresh_delay
+        self.max_groups = max_groups
+        self.max_keys = max_keys
+        self.search_page_size = search_page_size
+        self.reactor = reactor
+        self.hits = 0
+        self.refreshes = 0
+        self.updates = 0
+        self._memberships = OrderedDict()
+        self._owner_keys = {}
+        self._total_keys = 0
+        self._search_starts = []
+        self._writes = []
+        self._read = set()
+        self._changed_owners = set()
+        self._write_refresh_call = None
+        self._refresh_loop = None
+        self._single_flight = SingleFlight()
+
+    def __len__(self):
+        return len(self._memberships)
+
+    def metrics(self):
+        """
+        Return a dict of counts. ``hits`` is the number of reads served from
+        a kept membership, ``refreshes`` is the number of searches made to
+        refresh memberships, ``updates`` is the number of times a written
+        contact was added to or removed from a membership, ``groups`` is the
+        number of memberships kept and ``keys`` is the number of keys kept.
+        """
+        return {
+            'hits': self.hits,
+            'refreshes': self.refreshes,
+            'updates': self.updates,
+            'groups': len(self),
+            'keys': self._total_keys,
+        }
+
+    def start(self):
+        """
+        Start refreshing memberships every ``refresh_interval`` seconds.
+        """
+        if self.refresh_interval is None or self._refresh_loop is not None:
+            return
+        self._refresh_loop = LoopingCall(self.refresh_read)
+        self._refresh_loop.clock = self.reactor
+        self._refresh_loop.start(self.refresh_interval, now=False)
+
+    def stop(self):
+        """
+        Stop refreshing memberships in the background.
+        """
+        if self._refresh_loop is not None:
+            self._refresh_loop.stop()
+            self._refresh_loop = None
+        if self._write_refresh_call is not None:
+            self._write_refresh_call.cancel()
+            self._write_refresh_call = None
+
+    def get(self, contact_store, group):
+        """
+        Return the :class:`Membership` of the smart group ``group`` if a
+        fresh one is kept, or ``None`` if the group's contacts must be
+        searched for. A missing or stale membership is refreshed in the
+        background, so that later reads may use it.
+
+        :param ContactStore contact_store:
+            The contact store of the group's owner.
+        """
+        key = (contact_store.user_account_key, group.key)
+        if self.refresh_interval is not None:
+            self._read.add(key)
+        membership = self._memberships.get(key)
+        if (membership is not None and membership.query == group.query and
+                membership.age(self.reactor.seconds()) <= self.max_age):
+            self._touch(key)
+            if membership.keys is None:
+                return None
+            self.hits += 1
+            return membership
+        self._refresh_in_background(key, group.query)
+        return None
+
+    def refresh(self, contact_store, group_key, query):
+        """
+        Search for the contacts matching ``query`` and keep them as the
+        membership of the group ``group_key``. Concurrent refreshes of the
+        same group share a single search.
+        """
+        key = (contact_store.user_account_key, group_key)
+        d = self._single_flight.run(
+            key + (query,), self._search, contact_store, query)
+        d.addCallback(self._refreshed, key)
+        return d
+
+    @inlineCallbacks
+    def _search(self, contact_store, query):
+        refreshed_at = self.reactor.seconds()
+        self.refreshes += 1
+        self._search_starts.append(refreshed_at)
+        try:
+            keys = set()
+            start = 0
+            while True:
+                page = yield contact_store.contacts.real_search(
+                    query, rows=self.search_page_size, start=start)
+                keys.update(page)
+                start += len(page)
+                if len(keys) > self.max_keys:
+                    keys = None
+                    break
+                if len(page) < self.search_page_size:
+                    break
+            if keys is not None:
+                keys = sorted(keys)
+            membership = Membership(query, keys, refreshed_at)
+            self._apply_writes_since(
+                contact_store.user_account_key, membership)
+        finally:
+            self._search_done(refreshed_at)
+        returnValue(membership)
+
+    def _apply_writes_since(self, owner_id, membership):
+        """
+        Apply the writes made since ``membership``'s search started, which
+        the search may have missed. If the query can't be matched against
+        contact data, they are left for the next refresh to find.
+        """
+        for written_at, write_owner_id, key, data in self._writes:
+            if (write_owner_id == owner_id and
+                    written_at >= membership.refreshed_at):
+                try:
+                    membership.apply(key, data)
+                except SearchQueryError:
+                    return
+
+    def _search_done(self, started_at):
+        """
+        Forget the start of a finished search, and the writes that no
+        search in progress started before.
+        """
+        self._search_starts.remove(started_at)
+        if not self._search_starts:
+            self._writes = []
+            return
+        oldest = min(self._search_starts)
+        self._writes = [
+            write for write in self._writes if write[0] >= oldest]
+
+    def _refreshed(self, membership, key):
+        current = self._memberships.get(key)
+        if (current is None or current.query != membership.query or
+                current.refreshed_at <= membership.refreshed_at):
+            self._keep(key, membership)
+        else:
+            self._touch(key)
+        self._evict()
+        return self._memberships.get(key)
+
+    def _keep(self, key, membership):
+        self._drop(key)
+        self._memberships[key] = membership
+        self._owner_keys.setdefault(key[0], set()).add(key)
+        self._total_keys += membership.size
+
+    def _drop(self, key):
+        membership = self._memberships.pop(key, None)
+        if membership is not None:
+            self._total_keys -= membership.size
+            owner_keys = self._owner_keys[key[0]]
+            owner_keys.discard(key)
+            if not owner_keys:
+                del self._owner_keys[key[0]]
+
+    def _evict(self):
+        """
+        Drop the least recently read memberships until no more than
+        ``max_groups`` memberships and ``max_keys`` keys are kept.
+        """
+        while (len(self._memberships) > self.max_groups or
+               self._total_keys > self.max_keys):
+            old_key = next(iter(self._memberships))
+            self._drop(old_key)
+            self._read.discard(old_key)
+
+    def _touch(self, key):
+        membership = self._memberships.pop(key)
+        self._memberships[key] = membership
+
+    def _refresh_in_background(self, key, query):
+        owner_id, group_key = key
+        contact_store = ContactStore(self.riak_manager, owner_id)
+        d = self.refresh(contact_store, group_key, query)
+        d.addErrback(self._refresh_failed, key)
+
+    def _refresh_failed(self, failure, key):
+        if key not in self._memberships:
+            self._read.discard(key)
+        log.err(
+            failure, "Failed to refresh membership of smart group %r for %r"
+            % (key[1], key[0]))
+
+    def _refresh_kept(self, keys):
+        for key in keys:
+            membership = self._memberships.get(key)
+            if membership is not None:
+                self._refresh_in_background(key, membership.query)
+
+    def refresh_read(self):
+        """
+        Refresh the memberships read since this was last called, and drop
+        the others.
+        """
+        read, self._read = self._read, set()
+        for key in self._memberships.keys():
+            if key not in read:
+                self._drop(key)
+        self._refresh_kept(read)
+
+    def contact_written(self, owner_id, contact_key, data):
+        """
+        Add the contact ``contact_key`` belonging to ``owner_id`` to the
+        owner's memberships whose queries match ``data``, and remove it from
+        the others. ``data`` is the contact's Riak data, or ``None`` if the
+        contact was deleted. Memberships whose queries can't be matched
+        against contact data are dropped, so that they are searched for
+        again when they are next read.
+        """
+        if self._search_starts:
+            self._writes.append(
+                (self.reactor.seconds(), owner_id, contact_key, data))
+        for key in list(self._owner_keys.get(owner_id, ())):
+            membership = self._memberships[key]
+            size = membership.size
+            try:
+                if membership.apply(contact_key, data):
+                    self.updates += 1
+            except SearchQueryError:
+                self._drop(key)
+                self._read.discard(key)
+            else:
+                self._total_keys += membership.size - size
+        self._evict()
+
+    def contacts_changed(self, owner_id):
+        """
+        Note that a contact belonging to ``owner_id`` was written, so that
+        the owner's memberships are refreshed after ``write_refresh_delay``
+        seconds.
+        """
+        if self.write_refresh_delay is None:
+            return
+        self._changed_owners.add(owner_id)
+        if self._write_refresh_call is None:
+            self._write_refresh_call = self.reactor.callLater(
+                self.write_refresh_delay, self._refresh_changed)
+
+    def _refresh_changed(self):
+        self._write_refresh_call = None
+        owners, self._changed_owners = self._changed_owners, set()
+        self._refresh_kept(
+            [key for owner_id in owners
+             for key in self._owner_keys.get(owner_id, ())])
@@ -0,0 +1,560 @@
+"""
+An in-memory stand-in for a Riak manager.
+
+:class:`InMemoryRiakManager` keeps objects in memory rather than in Riak, but
+otherwise behaves like :class:`vumi.persist.txriak_manager.TxRiakManager` for
+the operations the backends use: loading, storing and deleting objects,
+secondary index queries with pagination, Riak Search queries and simple map
+reduces over index, search or key inputs. Objects are JSON encoded when they
+are stored and decoded when they are loaded, as they are by Riak.
+
+Each kind of operation can be given a latency, so that the stand-in can be
+used to benchmark the API without a Riak cluster.
+"""
+
+import base64
+import json
+from bisect import bisect_left, bisect_right
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred, succeed)
+from twisted.internet.task import deferLater
+
+from vumi.persist.model import Manager, VumiRiakError
+
+from .search import compile_query
+
+
+# The operations that may be given a latency.
+OPERATIONS = (
+    'load', 'store', 'delete', 'index_keys', 'index_keys_page',
+    'real_search', 'run_map_reduce')
+
+
+class InMemoryRiakObject(object):
+    """
+    Stand-in for :class:`vumi.persist.txriak_manager.VumiTxRiakObject`.
+    """
+
+    def __init__(self, bucket, key):
+        self._bucket = bucket
+        self.key = key
+        self._data = None
+        self._content_type = "application/json"
+        self._indexes = set()
+        self._usermeta = {}
+
+    def get_key(self):
+        return self.key
+
+    def get_content_type(self):
+        return self._content_type
+
+    def set_content_type(self, content_type):
+        self._content_type = content_type
+
+    def get_data(self):
+        return self._data
+
+    def set_data(self, data):
+        self._data = data
+
+    def set_encoded_data(self, encoded_data):
+        self._data = json.loads(encoded_data)
+
+    def set_data_field(self, key, value):
+        self._data[key] = value
+
+    def delete_data_field(self, key):
+        del self._data[key]
+
+    def get_indexes(self):
+        return self._indexes
+
+    def set_indexes(self, indexes):
+        self._indexes = set(
+            (name, _index_value(name, value)) for name, value in indexes)
+
+    def add_index(self, index_name, index_value):
+        if not index_name.endswith(('_bin', '_int')):
+            raise VumiRiakError("Invalid index name %r" % (index_name,))
+        self._indexes.add((index_name, _index_value(index_name, index_value)))
+
+    def remove_index(self, index_name, index_value=None):
+        if index_value is None:
+            self._indexes = set(
+                (name, value) for name, value in self._indexes
+                if name != index_name)
+        else:
+            self._indexes.discard(
+                (index_name, _index_value(index_name, index_value)))
+
+    def get_user_metadata(self):
+        return self._usermeta
+
+    def set_user_metadata(self, usermeta):
+        self._usermeta = usermeta
+
+    def get_bucket(self):
+        return self._bucket
+
+
+def _index_value(index_name, value):
+    if index_name.endswith('_int'):
+        return int(value)
+    return value
+
+
+class InMemoryIndex(object):
+    """
+    The ``(value, key)`` entries of a secondary index, kept in a list that is
+    sorted when it's next queried after a change.
+    """
+
+    def __init__(self):
+        self._entries = set()
+        self._sorted = []
+
+    def add(self, value, key):
+        self._entries.add((value, key))
+        self._sorted = None
+
+    def remove(self, value, key):
+        self._entries.discard((value, key))
+        self._sorted = None
+
+    def sorted_entries(self):
+        if self._sorted is None:
+            self._sorted = sorted(self._entries)
+        return self._sorted
+
+    def query(self, start_value, end_value=None, max_results=None,
+              after=None):
+        """
+        Return up to ``max_results`` ``(value, key)`` entries with values
+        from ``start_value`` to ``end_value`` (or equal to ``start_value``
+        if there's no ``end_value``), starting after the entry ``after``.
+        """
+        if end_value is None:
+            end_value = start_value
+        entries = self.sorted_entries()
+        if after is None:
+            pos = bisect_left(entries, (start_value,))
+        else:
+            pos = bisect_right(entries, after)
+        results = []
+        while pos < len(entries):
+            if max_results is not None and len(results) >= max_results:
+                break
+            entry = entries[pos]
+            if entry[0] > end_value:
+                break
+            if entry[0] >= start_value:
+                results.append(entry)
+            pos += 1
+        return results
+
+
+class InMemoryRiakBucket(object):
+    """
+    The objects in a bucket, with their secondary indexes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.search_enabled = False
+        self._objects = {}
+        self._indexes = {'$bucket': InMemoryIndex()}
+        self._search_cache = {}
+
+    def __len__(self):
+        return len(self._objects)
+
+    def get(self, key):
+        """
+        Return the ``(content_type, encoded_data, indexes)`` stored for
+        ``key``, or ``None`` if there is nothing stored.
+        """
+        return self._objects.get(key)
+
+    def put(self, key, content_type, encoded_data, indexes):
+        self.remove(key)
+        indexes = frozenset(indexes)
+        self._objects[key] = (content_type, encoded_data, indexes)
+        self._indexes['$bucket'].add(self.name, key)
+        for name, value in indexes:
+            self._indexes.setdefault(name, InMemoryIndex()).add(value, key)
+        self._search_cache.clear()
+
+    def remove(self, key):
+        stored = self._objects.pop(key, None)
+        if stored is None:
+            return
+        self._indexes['$bucket'].remove(self.name, key)
+        for name, value in stored[2]:
+            self._indexes[name].remove(value, key)
+        self._search_cache.clear()
+
+    def clear(self):
+        for key in list(self._objects):
+            self.remove(key)
+
+    def get_index_page(self, index_name, start_value, end_value=None,
+                       return_terms=None, max_results=None, continuation=None):
+        """
+        Return an :class:`InMemoryIndexPage` of the results of an index
+        query.
+        """
+        after = None
+        if continuation is not None:
+            after = _decode_continuation(continuation)
+        index = self._indexes.get(index_name, InMemoryIndex())
+        entries = index.query(
+            _index_value(index_name, start_value),
+            _index_value(index_name, end_value)
+            if end_value is not None else None,
+            max_results=max_results, after=after)
+        continuation = None
+        if max_results is not None and len(entries) == max_results:
+            # Riak returns a continuation for every full page, even if
+            # there are no more results.
+            continuation = _encode_continuation(entries[-1])
+
+        def next_page(continuation):
+            return self.get_index_page(
+                index_name, start_value, end_value, return_terms=return_terms,
+                max_results=max_results, continuation=continuation)
+
+        if return_terms:
+            results = entries
+        else:
+            results = [key for _value, key in entries]
+        return InMemoryIndexPage(results, continuation, next_page)
+
+    def search(self, query):
+        """
+        Return the sorted keys of the objects whose data matches ``query``.
+        Results are cached until the bucket is next changed.
+        """
+        keys = self._search_cache.get(query)
+        if keys is None:
+            matcher = compile_query(query)
+            keys = self._search_cache[query] = sorted(
+                key for key, (_ct, encoded_data, _idx)
+                in self._objects.iteritems()
+                if matcher(json.loads(encoded_data)))
+        return keys
+
+
+def _encode_continuation(entry):
+    return base64.urlsafe_b64encode(json.dumps(entry))
+
+
+def _decode_continuation(continuation):
+    try:
+        value, key = json.loads(base64.urlsafe_b64decode(str(continuation)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise VumiRiakError("Invalid continuation %r" % (continuation,))
+    return (value, key)
+
+
+class InMemoryIndexPage(object):
+    """
+    Stand-in for :class:`vumi.persist.txriak_manager.VumiTxIndexPage`.
+    """
+
+    def __init__(self, results, continuation, get_next_page):
+        self._results = results
+        self.continuation = continuation
+        self._get_next_page = get_next_page
+
+    def __iter__(self):
+        return iter(self._results)
+
+    def __len__(self):
+        return len(self._results)
+
+    def __eq__(self, other):
+        return self._results == other
+
+    def has_next_page(self):
+        return self.continuation is not None
+
+    def next_page(self):
+        if not self.has_next_page():
+            return succeed(None)
+        return maybeDeferred(self._get_next_page, self.continuation)
+
+
+class InMemoryRiakClient(object):
+    """
+    Holds the buckets for an :class:`InMemoryRiakManager` and the managers
+    that share its data.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket(self, bucket_name):
+        bucket = self.buckets.get(bucket_name)
+        if bucket is None:
+            bucket = self.buckets[bucket_name] = InMemoryRiakBucket(
+                bucket_name)
+        return bucket
+
+    def purge_all(self, bucket_prefix):
+        for name, bucket in self.buckets.items():
+            if name.startswith(bucket_prefix):
+                bucket.clear()
+                bucket.search_enabled = False
+
+
+class InMemoryMapReduce(object):
+    """
+    Stand-in for :class:`riak.RiakMapReduce`.
+
+    Only the inputs of a map reduce are evaluated. It results in the keys of
+    the input objects that exist, or in their count if the map reduce has a
+    ``reduce_count_inputs`` phase. Other map and reduce phases are ignored.
+    """
+
+    COUNT_INPUTS = ["riak_kv_mapreduce", "reduce_count_inputs"]
+
+    def __init__(self, client):
+        self._client = client
+        self._inputs = []
+        self._count = False
+
+    def index(self, bucket_name, index_name, start_value, end_value=None):
+        bucket = self._client.bucket(bucket_name)
+        self._inputs.append(lambda: list(bucket.get_index_page(
+            index_name, start_value, end_value)))
+        return self
+
+    def search(self, bucket_name, query):
+        bucket = self._client.bucket(bucket_name)
+        self._inputs.append(lambda: bucket.search(query))
+        return self
+
+    def add_bucket_key_data(self, bucket_name, key, data):
+        bucket = self._client.bucket(bucket_name)
+        self._inputs.append(
+            lambda: [key] if bucket.get(key) is not None else [])
+        return self
+
+    def map(self, *args, **kw):
+        return self
+
+    def reduce(self, function=None, *args, **kw):
+        if function == self.COUNT_INPUTS:
+            self._count = True
+        return self
+
+    def filter_not_found(self):
+        return self
+
+    def run(self, timeout=None):
+        keys = []
+        for get_keys in self._inputs:
+            keys.extend(get_keys())
+        if self._count:
+            return [len(keys)]
+        return keys
+
+
+class InMemoryRiakManager(Manager):
+    """
+    A Riak manager that keeps objects in memory.
+
+    :param InMemoryRiakClient client:
+        The data to use. Managers that share a client share their data.
+        Defaults to a new, empty client.
+    :param latency:
+        Either the number of seconds every operation takes or a dict of
+        seconds per operation. The operation names are ``load``, ``store``,
+        ``delete``, ``index_keys``, ``index_keys_page``, ``real_search`` and
+        ``run_map_reduce``.
+    :param reactor:
+        The reactor to schedule delayed results on.
+    """
+
+    call_decorator = staticmethod(inlineCallbacks)
+
+    def __init__(self, client=None, bucket_prefix="", load_bunch_size=None,
+                 mapreduce_timeout=None, store_versions=None, parent=None,
+                 latency=None, reactor=None):
+        if client is None:
+            client = InMemoryRiakClient()
+        super(InMemoryRiakManager, self).__init__(
+            client, bucket_prefix, load_bunch_size=load_bunch_size,
+            mapreduce_timeout=mapreduce_timeout,
+            store_versions=store_versions, parent=parent)
+        if latency is None:
+            latency = {}
+        elif not isinstance(latency, dict):
+            latency = dict.fromkeys(OPERATIONS, latency)
+        self.latency = latency
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+    @classmethod
+    def from_config(cls, config, client=None):
+        """
+        Construct a manager from a dictionary of options. The options are
+        the same as for :class:`TxRiakManager`, except that options for
+        connecting to Riak are ignored and ``latency`` is accepted.
+
+        :param InMemoryRiakClient client:
+            The data to use. Defaults to a new, empty client.
+        """
+        config = config.copy()
+        return cls(
+            client=client,
+            bucket_prefix=config.pop('bucket_prefix'),
+            load_bunch_size=config.pop('load_bunch_size', None),
+            mapreduce_timeout=config.pop('mapreduce_timeout', None),
+            store_versions=config.pop('store_versions', None),
+            latency=config.pop('latency', None))
+
+    def sub_manager(self, sub_prefix):
+        return self.__class__(
+            self.client, self.bucket_prefix + sub_prefix,
+            load_bunch_size=self.load_bunch_size,
+            mapreduce_timeout=self.mapreduce_timeout,
+            store_versions=self.store_versions, parent=self,
+            latency=self.latency, reactor=self.reactor)
+
+    def close_manager(self):
+        return succeed(None)
+
+    def _call(self, name, func, *args, **kw):
+        """
+        Call ``func`` after the latency for the operation ``name``. Even
+        without a latency, the result is delivered in a later reactor
+        iteration, as it is by :class:`TxRiakManager`.
+        """
+        return deferLater(
+            self.reactor, self.latency.get(name, 0), func, *args, **kw)
+
+    def riak_bucket(self, bucket_name):
+        return self.client.bucket(bucket_name)
+
+    def riak_object(self, modelcls, key, result=None):
+        riak_object = InMemoryRiakObject(
+            self.bucket_for_modelcls(modelcls), key)
+        if result:
+            metadata = result['metadata']
+            indexes = metadata['index']
+            if hasattr(indexes, 'items'):
+                indexes = indexes.items()
+            riak_object.set_content_type(metadata['content-type'])
+            riak_object.set_indexes(indexes)
+            riak_object.set_encoded_data(result['data'])
+        else:
+            riak_object.set_data({'$VERSION': modelcls.VERSION})
+        return riak_object
+
+    def put_object(self, modelobj):
+        """
+        Store ``modelobj`` immediately, without any latency. This is for
+        loading fixtures quickly.
+        """
+        riak_object = self._reverse_migrate_riak_object(modelobj)
+        riak_object.get_bucket().put(
+            riak_object.key, riak_object.get_content_type(),
+            json.dumps(riak_object.get_data()), riak_object.get_indexes())
+        return modelobj
+
+    def store(self, modelobj):
+        return self._call('store', self.put_object, modelobj)
+
+    def delete(self, modelobj):
+        riak_object = modelobj._riak_object
+        d = self._call(
+            'delete', riak_object.get_bucket().remove, riak_object.key)
+        d.addCallback(lambda _: None)
+        return d
+
+    def _get(self, modelcls, key):
+        riak_object = self.riak_object(modelcls, key)
+        stored = riak_object.get_bucket().get(key)
+        if stored is None:
+            riak_object.set_data(None)
+            return riak_object
+        content_type, encoded_data, indexes = stored
+        riak_object.set_content_type(content_type)
+        riak_object.set_encoded_data(encoded_data)
+        riak_object.set_indexes(indexes)
+        return riak_object
+
+    @inlineCallbacks
+    def load(self, modelcls, key, result=None):
+        if result:
+            riak_object = self.riak_object(modelcls, key, result)
+        else:
+            riak_object = yield self._call('load', self._get, modelcls, key)
+        returnValue(self._migrate_riak_object(modelcls, key, riak_object))
+
+    def _load_multiple(self, modelcls, keys):
+        d = gatherResults([self.load(modelcls, key) for key in keys])
+        d.addCallback(lambda objs: [obj for obj in objs if obj is not None])
+        return d
+
+    def riak_map_reduce(self):
+        return InMemoryMapReduce(self.client)
+
+    def run_map_reduce(self, mapreduce, mapper_func=None, reducer_func=None):
+        def map_results(raw_results):
+            return gatherResults([
+                maybeDeferred(mapper_func, self, row) for row in raw_results])
+
+        d = self._call('run_map_reduce', mapreduce.run)
+        if mapper_func is not None:
+            d.addCallback(map_results)
+        if reducer_func is not None:
+            d.addCallback(lambda r: reducer_func(self, r))
+        return d
+
+    def should_quote_index_values(self):
+        return False
+
+    def index_keys(self, model, index_name, start_value, end_value=None,
+                   return_terms=None):
+        bucket = self.bucket_for_modelcls(model)
+        d = self._call(
+            'index_keys', bucket.get_index_page, index_name, start_value,
+            end_value, return_terms=return_terms)
+        d.addCallback(list)
+        return d
+
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        return_terms=None, max_results=None,
+                        continuation=None):
+        bucket = self.bucket_for_modelcls(model)
+        return self._call(
+            'index_keys_page', bucket.get_index_page, index_name,
+            start_value, end_value, return_terms=return_terms,
+            max_results=max_results, continuation=continuation)
+
+    def _search(self, modelcls, query, rows, start):
+        keys = self.bucket_for_modelcls(modelcls).search(query)
+        if start is not None:
+            return keys[start:start + rows]
+        return keys
+
+    def real_search(self, modelcls, query, rows=None, start=None):
+        rows = 1000 if rows is None else rows
+        return self._call('real_search', self._search, modelcls, query,
+                          rows, start)
+
+    def riak_enable_search(self, modelcls):
+        self.bucket_for_modelcls(modelcls).search_enabled = True
+        return succeed(None)
+
+    def riak_search_enabled(self, modelcls):
+        return succeed(self.bucket_for_modelcls(modelcls).search_enabled)
+
+    def purge_all(self):
+        self.client.purge_all(self.bucket_prefix)
+        return succeed(None)
@@ -0,0 +1,149 @@
+"""
+Scheduling of Riak calls in priority lanes.
+
+Interactive requests (fetching a single contact, looking a contact up by
+address) should not have to wait behind the hundreds of Riak calls made to
+fill a stream or a large page. The :class:`RiakScheduler` gives each kind of
+traffic its own concurrency budget and dispatches interactive calls first.
+"""
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+from .wrapper import RiakManagerWrapper
+
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+LANES = (INTERACTIVE, BULK)
+
+
+class RiakScheduler(object):
+    """
+    Limits the number of Riak calls in flight for each lane.
+
+    Interactive calls may use any idle bulk capacity as well as their own,
+    but bulk calls are limited to the bulk budget. Whenever a call finishes,
+    waiting interactive calls are started before waiting bulk calls.
+
+    :param int interactive_concurrency:
+        Number of concurrent calls reserved for interactive requests, or
+        ``None`` for no limit.
+    :param int bulk_concurrency:
+        Maximum number of concurrent calls for bulk requests, or ``None`` for
+        no limit.
+    """
+
+    def __init__(self, interactive_concurrency=None, bulk_concurrency=None):
+        self.limits = {
+            INTERACTIVE: interactive_concurrency,
+            BULK: bulk_concurrency,
+        }
+        # The number of calls using each lane's budget. Interactive calls
+        # borrowing bulk capacity are counted against the bulk budget.
+        self.active = dict((lane, 0) for lane in LANES)
+        self.dispatched = dict((lane, 0) for lane in LANES)
+        self._waiting = dict((lane, []) for lane in LANES)
+
+    def waiting(self, lane):
+        return len(self._waiting[lane])
+
+    def _has_capacity(self, budget):
+        limit = self.limits[budget]
+        return limit is None or self.active[budget] < limit
+
+    def _budget_for(self, lane):
+        """
+        Return the budget a call in ``lane`` may start in now, or ``None`` if
+        it has to wait.
+        """
+        if self._has_capacity(lane):
+            return lane
+        if lane == INTERACTIVE and self._has_capacity(BULK):
+            return BULK
+        return None
+
+    def run(self, lane, func, *args, **kw):
+        """
+        Call ``func`` once there is capacity for it in ``lane``.
+
+        :returns:
+            A deferred that fires with the result of ``func``. Cancelling it
+            removes a waiting call from the queue. A running call can't be
+            stopped (Riak calls run in threads), so it keeps its place in
+            the budget until it finishes and its result is discarded.
+        """
+        call = _ScheduledCall(lane, func, args, kw)
+        call.d = Deferred(canceller=lambda d: self._cancel(call))
+        budget = self._budget_for(lane)
+        if budget is None:
+            self._waiting[lane].append(call)
+        else:
+            self._start(call, budget)
+        return call.d
+
+    def _start(self, call, budget):
+        self.active[budget] += 1
+        self.dispatched[call.lane] += 1
+        call.running = maybeDeferred(call.func, *call.args, **call.kw)
+        call.running.addBoth(self._finished, call, budget)
+
+    def _finished(self, result, call, budget):
+        self.active[budget] -= 1
+        call.running = None
+        self._dispatch()
+        if not call.d.called:
+            if isinstance(result, Failure):
+                call.d.errback(result)
+            else:
+                call.d.callback(result)
+
+    def _cancel(self, call):
+        # Cancelling ``call.d`` errbacks it with CancelledError. A running
+        # call is left to finish so that its budget isn't freed early.
+        if call.running is None:
+            self._waiting[call.lane].remove(call)
+
+    def _dispatch(self):
+        for lane in LANES:
+            waiting = self._waiting[lane]
+            while waiting:
+                budget = self._budget_for(lane)
+                if budget is None:
+                    break
+                self._start(waiting.pop(0), budget)
+
+
+class _ScheduledCall(object):
+    def __init__(self, lane, func, args, kw):
+        self.lane = lane
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.d = None
+        self.running = None
+
+
+class ScheduledRiakManager(RiakManagerWrapper):
+    """
+    A Riak manager wrapper that runs every Riak call in one of a
+    :class:`RiakScheduler`'s lanes.
+
+    :param manager:
+        The Riak manager to wrap.
+    :param RiakScheduler scheduler:
+        The scheduler to run calls through.
+    :param str lane:
+        Either ``interactive`` or ``bulk``.
+    """
+
+    def __init__(self, manager, scheduler, lane):
+        super(ScheduledRiakManager, self).__init__(manager)
+        if lane not in LANES:
+            raise ValueError("Unknown lane %r, must be one of: %s" % (
+                lane, ", ".join(LANES)))
+        self.scheduler = scheduler
+        self.lane = lane
+
+    def wrap_call(self, name, func, *args, **kw):
+        return self.scheduler.run(self.lane, func, *args, **kw)
@@ -0,0 +1,276 @@
+"""
+Evaluation of Riak Search queries against object data.
+
+Only the subset of the Lucene query syntax that smart group queries use is
+supported:
+
+* ``field:value`` terms, where the value may be quoted with ``'`` or ``"``
+  and unquoted values may contain ``*`` and ``?`` wildcards and
+  backslash-escaped characters,
+* bare values, which match any field,
+* ``AND`` (or ``&&``) and ``OR`` (or ``||``), with adjacent clauses
+  combined with ``OR`` as in Riak Search and ``AND`` binding more tightly
+  than ``OR``,
+* required (``+``) and prohibited (``-`` or ``NOT``) clauses. As in Lucene,
+  an object matches a list of clauses if it matches every required clause,
+  none of the prohibited clauses and, if no clause is required, at least
+  one of the others. A list of only prohibited clauses matches every object
+  that none of them match, as a purely negative query does in Solr,
+* parentheses for grouping.
+
+Values are matched against whole field values case-insensitively, rather
+than against the tokens an analyzer would produce. A term matches a list
+field if it matches any item in the list.
+"""
+
+import re
+
+
+class SearchQueryError(ValueError):
+    """
+    Raised when a query can't be parsed.
+    """
+
+
+_OPERATORS = {
+    u'AND': u'AND', u'&&': u'AND',
+    u'OR': u'OR', u'||': u'OR',
+}
+
+# How a clause occurs in a list of clauses.
+_MUST, _SHOULD, _MUST_NOT = 'MUST', 'SHOULD', 'MUST_NOT'
+
+_SPECIAL = u' \t\r\n():"\''
+
+
+class _Tokenizer(object):
+    def __init__(self, query):
+        self.query = query
+        self.pos = 0
+
+    def error(self, message):
+        raise SearchQueryError(
+            "Invalid search query %r: %s" % (self.query, message))
+
+    def tokens(self):
+        """
+        Return a list of ``(kind, value)`` tuples, where ``kind`` is one of
+        ``(``, ``)``, ``op``, ``mod`` or ``term``. The value of a modifier is
+        ``_MUST`` or ``_MUST_NOT`` and the value of a term is a
+        ``(field, pattern)`` tuple.
+        """
+        tokens = []
+        while True:
+            self.skip_whitespace()
+            if self.pos >= len(self.query):
+                return tokens
+            char = self.query[self.pos]
+            if char in u'()':
+                self.pos += 1
+                tokens.append((char, None))
+            elif char == u'-' or char == u'+':
+                self.pos += 1
+                tokens.append(('mod', _MUST_NOT if char == u'-' else _MUST))
+            elif char in u'\'"':
+                tokens.append(('term', (None, self.read_quoted())))
+            else:
+                tokens.append(self.read_word())
+
+    def skip_whitespace(self):
+        while (self.pos < len(self.query) and
+               self.query[self.pos].isspace()):
+            self.pos += 1
+
+    def read_quoted(self):
+        quote = self.query[self.pos]
+        self.pos += 1
+        chars = []
+        while self.pos < len(self.query):
+            char = self.query[self.pos]
+            self.pos += 1
+            if char == u'\\' and self.pos < len(self.query):
+                chars.append(self.query[self.pos])
+                self.pos += 1
+            elif char == quote:
+                return re.escape(u''.join(chars))
+            else:
+                chars.append(char)
+        self.error("unterminated quote")
+
+    def read_bare(self):
+        """
+        Read an unquoted word, returning its raw text and its text as a
+        pattern with wildcards.
+        """
+        raw, pattern = [], []
+        while self.pos < len(self.query):
+            char = self.query[self.pos]
+            if char in _SPECIAL:
+                break
+            self.pos += 1
+            if char == u'\\' and self.pos < len(self.query):
+                char = self.query[self.pos]
+                self.pos += 1
+                raw.append(char)
+                pattern.append(re.escape(char))
+            elif char == u'*':
+                raw.append(char)
+                pattern.append(u'.*')
+            elif char == u'?':
+                raw.append(char)
+                pattern.append(u'.')
+            else:
+                raw.append(char)
+                pattern.append(re.escape(char))
+        if not raw:
+            self.error("unexpected %r" % (self.query[self.pos],))
+        return u''.join(raw), u''.join(pattern)
+
+    def read_word(self):
+        raw, pattern = self.read_bare()
+        if self.pos < len(self.query) and self.query[self.pos] == u':':
+            self.pos += 1
+            if self.pos >= len(self.query):
+                self.error("missing value for field %r" % (raw,))
+            if self.query[self.pos] in u'\'"':
+                return ('term', (raw, self.read_quoted()))
+            return ('term', (raw, self.read_bare()[1]))
+        if raw in _OPERATORS:
+            return ('op', _OPERATORS[raw])
+        if raw == u'NOT':
+            return ('mod', _MUST_NOT)
+        return ('term', (None, pattern))
+
+
+class _Parser(object):
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = tokenizer.tokens()
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            self.tokenizer.error("empty query")
+        matcher = self.parse_clauses()
+        if self.pos < len(self.tokens):
+            self.tokenizer.error("unexpected %r" % (self.peek()[0],))
+        return matcher
+
+    def parse_clauses(self):
+        """
+        Parse a list of clauses separated by ``OR`` or nothing at all.
+        """
+        clauses = [self.parse_and()]
+        while True:
+            kind, value = self.peek()
+            if kind == 'op' and value == u'OR':
+                self.next()
+            elif kind not in ('term', '(', 'mod'):
+                break
+            clauses.append(self.parse_and())
+        return _clauses_matcher(clauses)
+
+    def parse_and(self):
+        """
+        Parse clauses joined by ``AND`` into a single optional clause, or
+        return the clause if there is only one.
+        """
+        clauses = [self.parse_modified()]
+        while self.peek() == ('op', u'AND'):
+            self.next()
+            clauses.append(self.parse_modified())
+        if len(clauses) == 1:
+            return clauses[0]
+        # Every clause joined by AND is required, unless it is prohibited.
+        return (_SHOULD, _clauses_matcher(
+            [(_MUST_NOT if occur == _MUST_NOT else _MUST, matcher)
+             for occur, matcher in clauses]))
+
+    def parse_modified(self):
+        """
+        Parse a clause, returning ``(occur, matcher)``.
+        """
+        kind, value = self.peek()
+        if kind == 'mod':
+            self.next()
+            return (value, self.parse_primary())
+        return (_SHOULD, self.parse_primary())
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind == '(':
+            matcher = self.parse_clauses()
+            if self.next()[0] != ')':
+                self.tokenizer.error("missing ')'")
+            return matcher
+        if kind == 'term':
+            return _term_matcher(*value)
+        if kind is None:
+            self.tokenizer.error("unexpected end of query")
+        if kind == 'mod':
+            self.tokenizer.error("unexpected second modifier")
+        self.tokenizer.error("unexpected %r" % (value or kind,))
+
+
+def _clauses_matcher(clauses):
+    """
+    Return a matcher for a list of ``(occur, matcher)`` clauses.
+    """
+    if len(clauses) == 1 and clauses[0][0] == _SHOULD:
+        return clauses[0][1]
+    required = [m for occur, m in clauses if occur == _MUST]
+    optional = [m for occur, m in clauses if occur == _SHOULD]
+    prohibited = [m for occur, m in clauses if occur == _MUST_NOT]
+
+    def matcher(data):
+        if any(m(data) for m in prohibited):
+            return False
+        if required:
+            return all(m(data) for m in required)
+        if optional:
+            return any(m(data) for m in optional)
+        return True
+
+    return matcher
+
+
+def _iter_values(value):
+    if isinstance(value, (list, tuple)):
+        return value
+    return [value]
+
+
+def _term_matcher(field, pattern):
+    regex = re.compile(u'%s$' % (pattern,), re.IGNORECASE | re.UNICODE)
+
+    def value_matches(value):
+        return any(
+            item is not None and regex.match(unicode(item)) is not None
+            for item in _iter_values(value))
+
+    if field is None:
+        return lambda data: any(value_matches(v) for v in data.itervalues())
+    return lambda data: value_matches(data.get(field))
+
+
+def compile_query(query):
+    """
+    Compile a search query into a function that is called with an object's
+    data dict and returns whether the object matches the query.
+
+    :raises SearchQueryError:
+        If the query isn't valid or uses unsupported syntax.
+    """
+    if isinstance(query, str):
+        query = query.decode('utf-8')
+    return _Parser(_Tokenizer(query)).parse()
@@ -0,0 +1,136 @@
+"""
+Coalescing of identical concurrent reads.
+
+Bursts of requests for the same contact or group (e.g. when a campaign is
+sent) would otherwise each make the same Riak calls. A :class:`SingleFlight`
+lets concurrent callers asking for the same key share a single call.
+"""
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+
+class SingleFlight(object):
+    """
+    Shares the result of an in-flight call with any identical calls made
+    before it finishes.
+
+    Callers sharing a call all receive the same result object, so results
+    must be treated as read-only.
+
+    :param int max_waiters:
+        Maximum number of callers that may share a single call. Callers over
+        the limit make their own call. ``None`` means no limit.
+    """
+
+    def __init__(self, max_waiters=None):
+        self.max_waiters = max_waiters
+        self.calls = 0
+        self.coalesced = 0
+        self.overflowed = 0
+        self._flights = {}
+
+    @property
+    def in_flight(self):
+        return len(self._flights)
+
+    def metrics(self):
+        """
+        Return a dict of counts. ``calls`` is the number of calls made,
+        ``coalesced`` is the number of calls saved by sharing an in-flight
+        call and ``overflowed`` is the number of calls made because an
+        in-flight call already had ``max_waiters`` callers.
+        """
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'overflowed': self.overflowed,
+            'in_flight': self.in_flight,
+        }
+
+    def run(self, key, func, *args, **kw):
+        """
+        Call ``func`` unless a call for ``key`` is already in flight, in which
+        case wait for that call's result instead.
+
+        :param key:
+            A hashable key identifying the call. It must include everything
+            the result depends on, such as the owner.
+
+        :returns:
+            A deferred that fires with the result of the call. Cancelling it
+            stops waiting for the result. The underlying call is only
+            cancelled once nobody is waiting for it.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            if self.max_waiters is None or (
+                    len(flight.waiters) < self.max_waiters):
+                self.coalesced += 1
+                return flight.add_waiter()
+            self.overflowed += 1
+            return maybeDeferred(func, *args, **kw)
+
+        self.calls += 1
+        flight = _Flight(self, key)
+        self._flights[key] = flight
+        d = flight.add_waiter()
+        flight.start(func, args, kw)
+        return d
+
+    def forget(self, key):
+        """
+        Stop sharing the in-flight call for ``key``, if there is one. Calls
+        for ``key`` made afterwards won't share its result. This should be
+        called when the object a key refers to is modified, so that later
+        reads see the modification.
+        """
+        flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.forgotten = True
+
+    def forget_prefix(self, prefix):
+        """
+        :meth:`forget` every key that is a tuple starting with ``prefix``.
+        """
+        for key in self._flights.keys():
+            if isinstance(key, tuple) and key[:len(prefix)] == prefix:
+                self.forget(key)
+
+    def _landed(self, flight):
+        if not flight.forgotten:
+            del self._flights[flight.key]
+
+
+class _Flight(object):
+    def __init__(self, single_flight, key):
+        self.single_flight = single_flight
+        self.key = key
+        self.waiters = []
+        self.forgotten = False
+        self.d = None
+
+    def add_waiter(self):
+        waiter = Deferred(canceller=self._cancel_waiter)
+        self.waiters.append(waiter)
+        return waiter
+
+    def start(self, func, args, kw):
+        self.d = maybeDeferred(func, *args, **kw)
+        self.d.addBoth(self._landed)
+
+    def _landed(self, result):
+        self.single_flight._landed(self)
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    def _cancel_waiter(self, waiter):
+        self.waiters.remove(waiter)
+        if not self.waiters and self.d is not None and not self.d.called:
+            # Nobody wants the result any more.
+            self.single_flight.forget(self.key)
+            self.d.cancel()
@@ -4,11 +4,10 @@ Tests for riak contacts backend and collection.
 
 from datetime import datetime
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
 from zope.interface.verify import verifyObject
 
 from vumi.tests.helpers import VumiTestCase
-from vumi.tests.helpers import PersistenceHelper
 
 from go.vumitools.contact import ContactStore, ContactNotFoundError
 
@@ -18,12 +17,15 @@ from go_api.collections.errors import (
 
 from go_contacts.backends.riak import (
     RiakContactsBackend, RiakContactsCollection)
+from go_contacts.backends.membership import SmartGroupMemberships
+from go_contacts.backends.singleflight import SingleFlight
+from go_contacts.backends.wrapper import RiakManagerWrapper
+from go_contacts.tests.helpers import ContactsPersistenceHelper
 
 
 class TestRiakContactsBackend(VumiTestCase):
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
 
     @inlineCallbacks
     def mk_backend(self):
@@ -38,17 +40,28 @@ class TestRiakContactsBackend(VumiTestCase):
         self.assertEqual(collection.contact_store.user_account_key, "owner-1")
         self.assertTrue(isinstance(collection, RiakContactsCollection))
 
+    @inlineCallbacks
+    def test_get_contacts_collection_riak_manager(self):
+        backend = yield self.mk_backend()
+        manager = RiakManagerWrapper(backend.riak_manager)
+        collection = backend.get_contact_collection(
+            "owner-1", riak_manager=manager)
+        self.assertEqual(collection.contact_store.user_account_key, "owner-1")
+        self.assertTrue(
+            isinstance(collection.contact_store.manager, RiakManagerWrapper))
+
 
 class TestRiakContactsCollection(VumiTestCase):
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
 
     @inlineCallbacks
-    def mk_collection(self, owner_id):
+    def mk_collection(self, owner_id, single_flight=None, memberships=None):
         manager = yield self.persistence_helper.get_riak_manager()
         contact_store = ContactStore(manager, owner_id)
-        collection = RiakContactsCollection(contact_store, 10)
+        collection = RiakContactsCollection(
+            contact_store, 10, single_flight=single_flight,
+            memberships=memberships)
         returnValue(collection)
 
     EXPECTED_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
@@ -146,6 +159,156 @@ class TestRiakContactsCollection(VumiTestCase):
         err = yield self.failUnlessFailure(d, CollectionObjectNotFound)
         self.assertEqual(str(err), "Contact 'bad-contact-id' not found.")
 
+    @inlineCallbacks
+    def test_get_coalesced(self):
+        single_flight = SingleFlight()
+        collection = yield self.mk_collection(
+            "owner-1", single_flight=single_flight)
+        new_contact = yield collection.contact_store.new_contact(
+            name=u"Bob", msisdn=u"+12345")
+        contacts = yield gatherResults([
+            collection.get(new_contact.key),
+            collection.get(new_contact.key),
+        ])
+        self.assertEqual(contacts[0], contacts[1])
+        self.assertEqual(contacts[0][u'key'], new_contact.key)
+        self.assertEqual(single_flight.calls, 1)
+        self.assertEqual(single_flight.coalesced, 1)
+
+    @inlineCallbacks
+    def test_get_by_query_coalesced(self):
+        single_flight = SingleFlight()
+        collection = yield self.mk_collection(
+            "owner-1", single_flight=single_flight)
+        new_contact = yield collection.contact_store.new_contact(
+            name=u"Bob", msisdn=u"+12345")
+        pages = yield gatherResults([
+            collection.page(None, None, u"msisdn=+12345"),
+            collection.page(None, None, u"msisdn=+12345"),
+        ])
+        self.assertEqual(pages[0], pages[1])
+        self.assertEqual(pages[0][1][0][u'key'], new_contact.key)
+        self.assertEqual(single_flight.coalesced, 1)
+
+    @inlineCallbacks
+    def test_get_not_coalesced_across_owners(self):
+        single_flight = SingleFlight()
+        collection1 = yield self.mk_collection(
+            "owner-1", single_flight=single_flight)
+        collection2 = yield self.mk_collection(
+            "owner-2", single_flight=single_flight)
+        new_contact = yield collection1.contact_store.new_contact(
+            name=u"Bob", msisdn=u"+12345")
+        d1 = collection1.get(new_contact.key)
+        d2 = collection2.get(new_contact.key)
+        yield d1
+        yield self.failUnlessFailure(d2, CollectionObjectNotFound)
+        self.assertEqual(single_flight.coalesced, 0)
+
+    @inlineCallbacks
+    def test_update_not_coalesced_with_earlier_get(self):
+        single_flight = SingleFlight()
+        collection = yield self.mk_collection(
+            "owner-1", single_flight=single_flight)
+        new_contact = yield collection.contact_store.new_contact(
+            name=u"Bob", msisdn=u"+12345")
+        collection.get(new_contact.key)
+        yield collection.update(new_contact.key, {u"name": u"Alice"})
+        contact = yield collection.get(new_contact.key)
+        self.assertEqual(contact[u"name"], u"Alice")
+
+    @inlineCallbacks
+    def test_writes_update_smart_group_memberships(self):
+        manager = yield self.persistence_helper.get_riak_manager()
+        memberships = SmartGroupMemberships(manager, 60)
+        collection = yield self.mk_collection(
+            "owner-1", memberships=memberships)
+        contact_store = collection.contact_store
+        yield contact_store.contacts.enable_search()
+        group = yield contact_store.new_smart_group(u"Janes", u"name:Jane")
+        membership = yield memberships.refresh(
+            contact_store, group.key, group.query)
+        self.assertEqual(membership.keys, [])
+
+        key, _ = yield collection.create(
+            None, {u"name": u"Jane", u"msisdn": u"+12345"})
+        self.assertEqual(membership.keys, [key])
+        yield collection.update(key, {u"name": u"John"})
+        self.assertEqual(membership.keys, [])
+        yield collection.update(key, {u"name": u"Jane"})
+        self.assertEqual(membership.keys, [key])
+        yield collection.delete(key)
+        self.assertEqual(membership.keys, [])
+        self.assertEqual(memberships.refreshes, 1)
+        self.assertEqual(memberships.updates, 4)
+
+    @inlineCallbacks
+    def test_writes_update_negated_smart_group_memberships(self):
+        manager = yield self.persistence_helper.get_riak_manager()
+        memberships = SmartGroupMemberships(manager, 60)
+        collection = yield self.mk_collection(
+            "owner-1", memberships=memberships)
+        contact_store = collection.contact_store
+        yield contact_store.contacts.enable_search()
+        group = yield contact_store.new_smart_group(
+            u"Janes", u"+name:Jane -surname:Smith")
+        membership = yield memberships.refresh(
+            contact_store, group.key, group.query)
+
+        key, _ = yield collection.create(
+            None, {u"name": u"Jane", u"surname": u"Smith",
+                   u"msisdn": u"+12345"})
+        self.assertEqual(membership.keys, [])
+        yield collection.update(key, {u"surname": u"Doe"})
+        self.assertEqual(membership.keys, [key])
+        yield collection.update(key, {u"name": u"John"})
+        self.assertEqual(membership.keys, [])
+
+    @inlineCallbacks
+    def test_failed_writes_dont_change_smart_groups(self):
+        manager = yield self.persistence_helper.get_riak_manager()
+        memberships = SmartGroupMemberships(manager, 60)
+        changed = []
+        self.patch(memberships, 'contacts_changed', changed.append)
+        collection = yield self.mk_collection(
+            "owner-1", memberships=memberships)
+
+        yield self.assertFailure(
+            collection.create(None, {u"name": u"Jane"}),
+            CollectionUsageError)
+        yield self.assertFailure(
+            collection.update(u"missing", {u"name": u"Jane"}),
+            CollectionObjectNotFound)
+        self.assertEqual(changed, [])
+        key, _ = yield collection.create(
+            None, {u"name": u"Jane", u"msisdn": u"+12345"})
+        yield collection.update(key, {u"name": u"John"})
+        yield collection.delete(key)
+        self.assertEqual(changed, ["owner-1"] * 3)
+
+    @inlineCallbacks
+    def test_written_data_copied(self):
+        manager = yield self.persistence_helper.get_riak_manager()
+        memberships = SmartGroupMemberships(manager, 60)
+        written = []
+        self.patch(
+            memberships, 'contact_written',
+            lambda owner_id, key, data: written.append(data))
+        collection = yield self.mk_collection(
+            "owner-1", memberships=memberships)
+
+        key, _ = yield collection.create(
+            None, {u"name": u"Jane", u"msisdn": u"+12345"})
+        yield collection.update(key, {u"name": u"John"})
+        # Reading the contacts back puts the key into their Riak data, which
+        # mustn't show up in the data given to the memberships.
+        yield collection.get(key)
+        [created, updated] = written
+        self.assertFalse('key' in created)
+        self.assertEqual(created['name'], u"Jane")
+        self.assertFalse('key' in updated)
+        self.assertEqual(updated['name'], u"John")
+
     @inlineCallbacks
     def test_create(self):
         collection = yield self.mk_collection("owner-1")
@@ -5,7 +5,6 @@ Tests for riak contacts backend and collection.
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.tests.helpers import VumiTestCase
-from vumi.tests.helpers import PersistenceHelper
 
 from go_api.queue import PausingQueueCloseMarker
 from go.vumitools.contact import ContactStore
@@ -13,12 +12,14 @@ from go.vumitools.contact import ContactStore
 from go_contacts.backends.riak import (
     ContactsForGroupBackend, RiakContactsForGroupModel, group_to_dict,
     contact_to_dict)
+from go_contacts.backends.membership import SmartGroupMemberships
+from go_contacts.backends.wrapper import RiakManagerWrapper
+from go_contacts.tests.helpers import ContactsPersistenceHelper
 
 
 class TestRiakContactsForGroupBackend(VumiTestCase):
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
 
     @inlineCallbacks
     def mk_backend(self):
@@ -33,18 +34,27 @@ class TestRiakContactsForGroupBackend(VumiTestCase):
         self.assertEqual(collection.contact_store.user_account_key, "owner-1")
         self.assertTrue(isinstance(collection, RiakContactsForGroupModel))
 
+    @inlineCallbacks
+    def test_get_contacts_collection_riak_manager(self):
+        backend = yield self.mk_backend()
+        manager = RiakManagerWrapper(backend.riak_manager)
+        collection = backend.get_model("owner-1", riak_manager=manager)
+        self.assertEqual(collection.contact_store.user_account_key, "owner-1")
+        self.assertTrue(
+            isinstance(collection.contact_store.manager, RiakManagerWrapper))
+
 
 class TestRiakContactsForGroupModel(VumiTestCase):
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
 
     @inlineCallbacks
-    def mk_collection(self, owner_id):
+    def mk_collection(self, owner_id, memberships=None):
         manager = yield self.persistence_helper.get_riak_manager()
         contact_store = ContactStore(manager, owner_id)
         yield contact_store.contacts.enable_search()
-        collection = RiakContactsForGroupModel(contact_store, 10)
+        collection = RiakContactsForGroupModel(
+            contact_store, 10, memberships=memberships)
         returnValue(collection)
 
     @inlineCallbacks
@@ -196,3 +206,42 @@ class TestRiakContactsForGroupModel(VumiTestCase):
         self.assertTrue(contact2 in contacts)
         self.assertTrue(contact3 in contacts)
         self.assertFalse(contact4 in contacts)
+
+    @inlineCallbacks
+    def test_page_dynamic_group_from_membership(self):
+        manager = yield self.persistence_helper.get_riak_manager()
+        memberships = SmartGroupMemberships(manager, 60)
+        collection = yield self.mk_collection(
+            "owner-1", memberships=memberships)
+        group = yield self.create_group(
+            collection, name=u'Foo', query=u'name:Bar')
+        for msisdn in [u'+1', u'+2', u'+3']:
+            yield self.create_contact(collection, name=u'Bar', msisdn=msisdn)
+
+        # The membership isn't kept yet, so the first page is searched for.
+        cursor, _ = yield collection.page(group['key'], None, 1, None)
+        cursor, contacts = yield collection.page(group['key'], cursor, 1, None)
+        self.assertEqual(
+            collection._decode_cursor(cursor)[0], collection.DYNAMIC_CURSOR)
+        self.assertEqual(collection.membership_age, None)
+        yield memberships.refresh(
+            collection.contact_store, group['key'], group['query'])
+
+        # Clients paging through search results keep doing so.
+        cursor, data = yield collection.page(group['key'], cursor, 1, None)
+        self.assertEqual(
+            collection._decode_cursor(cursor)[0], collection.DYNAMIC_CURSOR)
+        self.assertEqual(collection.membership_age, None)
+
+        cursor, _ = yield collection.page(group['key'], None, 1, None)
+        keys = []
+        while cursor is not None:
+            cursor, data = yield collection.page(
+                group['key'], cursor, 1, None)
+            keys.extend(contact['key'] for contact in data)
+            if cursor is not None:
+                self.assertEqual(
+                    collection._decode_cursor(cursor)[0],
+                    collection.MEMBERSHIP_CURSOR)
+        self.assertEqual(len(set(keys)), 3)
+        self.assertNotEqual(collection.membership_age, None)
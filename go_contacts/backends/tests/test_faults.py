@@ -0,0 +1,148 @@
+"""
+Tests for go_contacts.backends.faults.
+"""
+
+import random
+
+from twisted.internet.defer import CancelledError
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from go.vumitools.contact import ContactStore
+
+from go_contacts.backends.faults import (
+    FaultInjectingRiakManager, FaultSpec, InjectedFault, parse_fault_specs)
+from go_contacts.backends.memory import InMemoryRiakManager
+
+
+class TestFaultSpec(VumiTestCase):
+    def test_uniform(self):
+        spec = FaultSpec(latency=1, jitter=0.5)
+        rand = random.Random(0)
+        delays = [spec.delay(rand) for _ in range(100)]
+        self.assertTrue(all(0.5 <= delay <= 1.5 for delay in delays))
+        self.assertNotEqual(len(set(delays)), 1)
+
+    def test_fixed(self):
+        spec = FaultSpec(latency=1)
+        self.assertEqual(spec.delay(random.Random(0)), 1)
+
+    def test_normal_never_negative(self):
+        spec = FaultSpec(latency=0.1, jitter=1, distribution='normal')
+        rand = random.Random(0)
+        self.assertTrue(all(spec.delay(rand) >= 0 for _ in range(100)))
+
+    def test_exponential(self):
+        spec = FaultSpec(latency=1, distribution='exponential')
+        rand = random.Random(0)
+        delays = [spec.delay(rand) for _ in range(1000)]
+        self.assertTrue(0.8 < sum(delays) / len(delays) < 1.2)
+        self.assertEqual(
+            FaultSpec(distribution='exponential').delay(rand), 0)
+
+    def test_fails(self):
+        rand = random.Random(0)
+        self.assertFalse(FaultSpec().fails(rand))
+        self.assertTrue(FaultSpec(error_rate=1).fails(rand))
+        fails = [FaultSpec(error_rate=0.25).fails(rand) for _ in range(1000)]
+        self.assertTrue(200 < fails.count(True) < 300)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, FaultSpec, distribution='pareto')
+        self.assertRaises(ValueError, FaultSpec, latency=-1)
+        self.assertRaises(ValueError, FaultSpec, error_rate=2)
+
+    def test_parse_fault_specs(self):
+        specs = parse_fault_specs({
+            'save': 0.5,
+            'load': {'latency': 0.1, 'error_rate': 0.5},
+            '*': FaultSpec(latency=2),
+        })
+        self.assertEqual(sorted(specs), ['*', 'load', 'store'])
+        self.assertEqual(specs['store'].latency, 0.5)
+        self.assertEqual(specs['load'].error_rate, 0.5)
+        self.assertEqual(specs['*'].latency, 2)
+        specs = parse_fault_specs({'load_bunch': 0.5})
+        self.assertEqual(specs.keys(), ['load'])
+
+
+class TestFaultInjectingRiakManager(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.manager = InMemoryRiakManager(
+            bucket_prefix="test.", reactor=self.clock)
+        self.store = ContactStore(self.manager, "owner-1")
+
+    def mk_store(self, specs):
+        self.faulty = FaultInjectingRiakManager(
+            self.manager, specs, seed=0, reactor=self.clock)
+        return ContactStore(self.faulty, "owner-1")
+
+    def new_contact(self, **fields):
+        d = self.store.new_contact(**fields)
+        self.clock.advance(0)
+        return self.successResultOf(d)
+
+    def test_latency(self):
+        contact = self.new_contact(msisdn=u"+1")
+        store = self.mk_store({'load': 0.5})
+        d = store.get_contact_by_key(contact.key)
+        self.clock.advance(0.4)
+        self.assertNoResult(d)
+        self.clock.advance(0.1)
+        self.assertEqual(self.successResultOf(d).msisdn, u"+1")
+        self.assertEqual(self.faulty.calls, {'load': 1})
+
+    def test_bunch_loads(self):
+        contact = self.new_contact(msisdn=u"+1")
+        store = self.mk_store({'load': {'latency': 0.5, 'error_rate': 1}})
+        [d] = store.contacts.load_all_bunches([contact.key])
+        self.clock.advance(0.5)
+        self.failureResultOf(d, InjectedFault)
+        self.assertEqual(self.faulty.calls, {'load_bunch': 1})
+        self.assertEqual(self.faulty.faults, {'load_bunch': 1})
+
+    def test_operations_without_spec(self):
+        store = self.mk_store({'load': 0.5})
+        d = store.contacts.index_keys('msisdn', u"+1")
+        self.clock.advance(0)
+        self.assertEqual(self.successResultOf(d), [])
+        self.assertEqual(self.faulty.calls, {})
+
+    def test_default_spec(self):
+        store = self.mk_store({'*': 0.5, 'save': 0.25})
+        d = store.new_contact(msisdn=u"+1")
+        self.clock.advance(0.25)
+        contact = self.successResultOf(d)
+        d = store.contacts.index_keys('msisdn', u"+1")
+        self.clock.advance(0.25)
+        self.assertNoResult(d)
+        self.clock.advance(0.25)
+        self.assertEqual(self.successResultOf(d), [contact.key])
+        self.assertEqual(self.faulty.calls, {'store': 1, 'index_keys': 1})
+
+    def test_errors(self):
+        store = self.mk_store({'save': {'latency': 0.5, 'error_rate': 1}})
+        d = store.new_contact(msisdn=u"+1")
+        self.clock.advance(0.5)
+        self.failureResultOf(d, InjectedFault)
+        self.assertEqual(self.faulty.faults, {'store': 1})
+        d = self.store.contacts.index_keys('msisdn', u"+1")
+        self.clock.advance(0)
+        self.assertEqual(self.successResultOf(d), [])
+
+    def test_sub_managers_share_counts(self):
+        store = self.mk_store({'index_keys_page': {'error_rate': 1}})
+        d = store.contacts.index_keys_page('msisdn', u"+1")
+        self.clock.advance(0)
+        self.failureResultOf(d, InjectedFault)
+        self.assertEqual(self.faulty.faults, {'index_keys_page': 1})
+
+    def test_cancel(self):
+        store = self.mk_store({'real_search': 1})
+        d = store.contacts.real_search(u"name:Jane")
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.clock.advance(1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
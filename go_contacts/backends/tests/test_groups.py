@@ -4,11 +4,10 @@ Tests for riak groups backend and collection.
 
 from datetime import datetime
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
 from zope.interface.verify import verifyObject
 
 from vumi.tests.helpers import VumiTestCase
-from vumi.tests.helpers import PersistenceHelper
 
 from go.vumitools.contact import ContactStore
 
@@ -18,12 +17,14 @@ from go_api.collections.errors import (
 
 from go_contacts.backends.riak import (
     RiakGroupsBackend, RiakGroupsCollection)
+from go_contacts.backends.singleflight import SingleFlight
+from go_contacts.backends.wrapper import RiakManagerWrapper
+from go_contacts.tests.helpers import ContactsPersistenceHelper
 
 
 class TestRiakGroupsBackend(VumiTestCase):
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
 
     @inlineCallbacks
     def mk_backend(self):
@@ -38,17 +39,27 @@ class TestRiakGroupsBackend(VumiTestCase):
         self.assertEqual(collection.contact_store.user_account_key, u'owner-1')
         self.assertTrue(isinstance(collection, RiakGroupsCollection))
 
+    @inlineCallbacks
+    def test_get_group_collection_riak_manager(self):
+        backend = yield self.mk_backend()
+        manager = RiakManagerWrapper(backend.riak_manager)
+        collection = backend.get_group_collection(
+            u'owner-1', riak_manager=manager)
+        self.assertEqual(collection.contact_store.user_account_key, u'owner-1')
+        self.assertTrue(
+            isinstance(collection.contact_store.manager, RiakManagerWrapper))
+
 
 class TestRiakGroupsCollection(VumiTestCase):
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
 
     @inlineCallbacks
-    def mk_collection(self, owner_id):
+    def mk_collection(self, owner_id, single_flight=None):
         manager = yield self.persistence_helper.get_riak_manager()
         contact_store = ContactStore(manager, owner_id)
-        collection = RiakGroupsCollection(contact_store, 10)
+        collection = RiakGroupsCollection(
+            contact_store, 10, single_flight=single_flight)
         returnValue(collection)
 
     EXPECTED_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
@@ -124,6 +135,31 @@ class TestRiakGroupsCollection(VumiTestCase):
                                          CollectionObjectNotFound)
         self.assertEqual(str(e), u"Group u'bad-key' not found.")
 
+    @inlineCallbacks
+    def test_get_coalesced(self):
+        single_flight = SingleFlight()
+        collection = yield self.mk_collection(
+            u'owner-1', single_flight=single_flight)
+        new_group = yield collection.contact_store.new_group(u'Bob')
+        groups = yield gatherResults([
+            collection.get(new_group.key),
+            collection.get(new_group.key),
+        ])
+        self.assertEqual(groups[0], groups[1])
+        self.assertEqual(groups[0][u'key'], new_group.key)
+        self.assertEqual(single_flight.coalesced, 1)
+
+    @inlineCallbacks
+    def test_update_not_coalesced_with_earlier_get(self):
+        single_flight = SingleFlight()
+        collection = yield self.mk_collection(
+            u'owner-1', single_flight=single_flight)
+        new_group = yield collection.contact_store.new_group(u'Bob')
+        collection.get(new_group.key)
+        yield collection.update(new_group.key, {u'name': u'Alice'})
+        group = yield collection.get(new_group.key)
+        self.assertEqual(group[u'name'], u'Alice')
+
     @inlineCallbacks
     def test_create_group(self):
         collection = yield self.mk_collection(u'owner-1')
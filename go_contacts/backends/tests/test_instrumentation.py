@@ -0,0 +1,192 @@
+"""
+Tests for go_contacts.backends.instrumentation.
+"""
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.backends.instrumentation import (
+    RiakOperationStats, InstrumentedRiakManager, RiakStatsAggregator)
+
+
+class TestRiakOperationStats(VumiTestCase):
+    def test_record(self):
+        stats = RiakOperationStats()
+        stats.record('load', 0.5)
+        stats.record('load_bunch', 0.25)
+        stats.record('index_keys_page', 0.125)
+        stats.record('real_search', 1.0)
+        stats.record('run_map_reduce', 1.0)
+        stats.record('delete', 0.125)
+        self.assertEqual(stats.as_dict(), {
+            'gets': 2,
+            'index_queries': 1,
+            'searches': 2,
+            'writes': 1,
+            'time': 3.0,
+        })
+
+    def test_objects_and_key_pages(self):
+        stats = RiakOperationStats(max_key_page_times=2)
+        stats.record('load', 0.5, objects=1)
+        stats.record('load_bunch', 0.5, objects=10)
+        stats.record('index_keys_page', 0.25)
+        stats.record('real_search', 0.125)
+        stats.record('index_keys_page', 0.5)
+        stats.record('index_keys', 0.5)
+        self.assertEqual(stats.objects, 11)
+        self.assertEqual(stats.key_pages, 3)
+        self.assertEqual(stats.key_page_times, [
+            ('index_keys_page', 0.25),
+            ('real_search', 0.125),
+        ])
+
+    def test_add(self):
+        stats = RiakOperationStats()
+        stats.record('load', 0.5)
+        other = RiakOperationStats()
+        other.record('store', 0.25)
+        stats.add(other)
+        self.assertEqual(stats.as_dict(), {
+            'gets': 1,
+            'index_queries': 0,
+            'searches': 0,
+            'writes': 1,
+            'time': 0.75,
+        })
+
+
+class DummyModel(object):
+    pass
+
+
+class DummyManager(object):
+    def __init__(self):
+        self.pending = []
+
+    def load(self, modelcls, key, result=None):
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+    def _load_bunch(self, modelcls, keys):
+        return succeed([DummyModel() if key else None for key in keys])
+
+    def store(self, modelobj):
+        return succeed(modelobj)
+
+    def index_keys(self, *args, **kw):
+        raise ValueError("Bad index")
+
+
+class TestInstrumentedRiakManager(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.manager = DummyManager()
+        self.stats = RiakOperationStats()
+        self.instrumented = InstrumentedRiakManager(
+            self.manager, self.stats, clock=self.clock.seconds)
+
+    def test_time_until_result(self):
+        d = self.instrumented.load(object, "key-1")
+        self.clock.advance(0.5)
+        self.assertEqual(self.stats.as_dict()['gets'], 0)
+        self.manager.pending[0].callback(None)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(self.stats.as_dict(), {
+            'gets': 1,
+            'index_queries': 0,
+            'searches': 0,
+            'writes': 0,
+            'time': 0.5,
+        })
+
+    def test_objects_counted(self):
+        d = self.instrumented.load(object, "key-1")
+        self.manager.pending[0].callback(DummyModel())
+        self.successResultOf(d)
+        d = self.instrumented.load(object, "key-2")
+        self.manager.pending[1].callback(None)
+        self.successResultOf(d)
+        self.manager.load_bunch_size = 2
+        [d1, d2] = list(self.instrumented.load_all_bunches(
+            object, ["key-1", None, "key-3"]))
+        self.assertEqual(len(self.successResultOf(d1)), 2)
+        self.assertEqual(len(self.successResultOf(d2)), 1)
+        self.assertEqual(self.stats.objects, 3)
+        self.assertEqual(self.stats.counts['gets'], 4)
+
+    def test_failures_recorded(self):
+        d = self.instrumented.index_keys(object, 'user_account', 'foo')
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(self.stats.counts['index_queries'], 1)
+
+    def test_nested_wrapper(self):
+        outer_stats = RiakOperationStats()
+        outer = InstrumentedRiakManager(self.instrumented, outer_stats)
+        obj = object()
+        self.assertEqual(self.successResultOf(outer.store(obj)), obj)
+        self.assertEqual(self.stats.counts['writes'], 1)
+        self.assertEqual(outer_stats.counts['writes'], 1)
+
+
+class TestRiakStatsAggregator(VumiTestCase):
+    def mk_stats(self, *names):
+        stats = RiakOperationStats()
+        for name in names:
+            stats.record(name, 0.5)
+        return stats
+
+    def test_no_requests(self):
+        self.assertEqual(RiakStatsAggregator().get_totals(), [])
+
+    def test_totals_by_route_and_owner(self):
+        aggregator = RiakStatsAggregator()
+        aggregator.record('/contacts/', 'owner-1', self.mk_stats('load'))
+        aggregator.record('/contacts/', 'owner-1', self.mk_stats('store'))
+        aggregator.record('/contacts/', 'owner-2', self.mk_stats())
+        aggregator.record(
+            '/groups/:elem_id', 'owner-1', self.mk_stats('real_search'))
+        self.assertEqual(aggregator.get_totals(), [
+            {'route': '/contacts/', 'owner_id': 'owner-1', 'requests': 2,
+             'gets': 1, 'index_queries': 0, 'searches': 0, 'writes': 1,
+             'time': 1.0},
+            {'route': '/contacts/', 'owner_id': 'owner-2', 'requests': 1,
+             'gets': 0, 'index_queries': 0, 'searches': 0, 'writes': 0,
+             'time': 0.0},
+            {'route': '/groups/:elem_id', 'owner_id': 'owner-1',
+             'requests': 1, 'gets': 0, 'index_queries': 0, 'searches': 1,
+             'writes': 0, 'time': 0.5},
+        ])
+
+    def test_route_totals(self):
+        aggregator = RiakStatsAggregator()
+        aggregator.record('/contacts/', 'owner-1', self.mk_stats('load'))
+        aggregator.record('/contacts/', 'owner-2', self.mk_stats('store'))
+        aggregator.record(
+            '/groups/:elem_id', 'owner-1', self.mk_stats('real_search'))
+        totals = dict(
+            (route, stats.as_dict())
+            for route, stats in aggregator.get_route_totals().iteritems())
+        self.assertEqual(totals, {
+            '/contacts/': {
+                'gets': 1, 'index_queries': 0, 'searches': 0, 'writes': 1,
+                'time': 1.0},
+            '/groups/:elem_id': {
+                'gets': 0, 'index_queries': 0, 'searches': 1, 'writes': 0,
+                'time': 0.5},
+        })
+
+    def test_max_owner_totals(self):
+        aggregator = RiakStatsAggregator(max_owner_totals=2)
+        aggregator.record('/contacts/', 'owner-1', self.mk_stats('load'))
+        aggregator.record('/contacts/', 'owner-2', self.mk_stats('load'))
+        aggregator.record('/contacts/', 'owner-1', self.mk_stats('load'))
+        aggregator.record('/contacts/', 'owner-3', self.mk_stats('load'))
+        self.assertEqual(
+            [(t['owner_id'], t['requests']) for t in aggregator.get_totals()],
+            [('owner-1', 2), ('owner-3', 1)])
+        [stats] = aggregator.get_route_totals().values()
+        self.assertEqual(stats.counts['gets'], 4)
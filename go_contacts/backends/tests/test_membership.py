@@ -0,0 +1,380 @@
+"""
+Tests for go_contacts.backends.membership.
+"""
+
+from twisted.internet.defer import fail
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from go.vumitools.contact import ContactStore
+
+from go_contacts.backends.membership import Membership, SmartGroupMemberships
+from go_contacts.backends.memory import InMemoryRiakManager
+from go_contacts.backends.search import SearchQueryError
+
+
+class TestMembership(VumiTestCase):
+    def test_page(self):
+        membership = Membership(u"name:Jane", [u"a", u"b", u"c"], 0)
+        self.assertEqual(membership.page(0, 2), (2, [u"a", u"b"]))
+        self.assertEqual(membership.page(2, 2), (None, [u"c"]))
+        self.assertEqual(membership.page(0, 3), (None, [u"a", u"b", u"c"]))
+        self.assertEqual(membership.page(5, 2), (None, []))
+
+    def test_apply(self):
+        membership = Membership(u"name:Jane", [u"a", u"c"], 0)
+        self.assertTrue(membership.apply(u"b", {u"name": u"Jane"}))
+        self.assertEqual(membership.keys, [u"a", u"b", u"c"])
+        self.assertFalse(membership.apply(u"b", {u"name": u"Jane"}))
+        self.assertTrue(membership.apply(u"a", {u"name": u"John"}))
+        self.assertEqual(membership.keys, [u"b", u"c"])
+        self.assertFalse(membership.apply(u"d", {u"name": u"John"}))
+        self.assertTrue(membership.apply(u"c", None))
+        self.assertEqual(membership.keys, [u"b"])
+
+    def test_apply_prohibited_and_required(self):
+        membership = Membership(u"+name:Jane -surname:Smith", [], 0)
+        self.assertTrue(
+            membership.apply(u"a", {u"name": u"Jane", u"surname": u"Doe"}))
+        self.assertFalse(
+            membership.apply(u"b", {u"name": u"Jane", u"surname": u"Smith"}))
+        self.assertFalse(
+            membership.apply(u"c", {u"name": u"John", u"surname": u"Doe"}))
+        self.assertTrue(
+            membership.apply(u"a", {u"name": u"Jane", u"surname": u"Smith"}))
+        self.assertEqual(membership.keys, [])
+
+    def test_apply_invalid_query(self):
+        membership = Membership(u"name:", [], 0)
+        self.assertRaises(
+            SearchQueryError, membership.apply, u"a", {u"name": u"Jane"})
+
+    def test_age(self):
+        membership = Membership(u"name:Jane", [], 10)
+        self.assertEqual(membership.age(15), 5)
+        self.assertEqual(membership.age(5), 0)
+
+
+class TestSmartGroupMemberships(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.manager = InMemoryRiakManager(
+            bucket_prefix="test.", reactor=self.clock)
+        self.store = self.get_store("owner-1")
+
+    def get_store(self, owner_id):
+        store = ContactStore(self.manager, owner_id)
+        self.result(store.contacts.enable_search())
+        return store
+
+    def result(self, d):
+        self.clock.advance(0)
+        return self.successResultOf(d)
+
+    def mk_memberships(self, **kw):
+        kw.setdefault('reactor', self.clock)
+        memberships = SmartGroupMemberships(self.manager, 10, **kw)
+        self.add_cleanup(memberships.stop)
+        return memberships
+
+    def new_contact(self, store=None, **fields):
+        if store is None:
+            store = self.store
+        fields.setdefault('msisdn', u"+12345")
+        return self.result(store.new_contact(**fields))
+
+    def new_group(self, query, store=None):
+        if store is None:
+            store = self.store
+        return self.result(store.new_smart_group(u"Group", query))
+
+    def get(self, memberships, group, store=None):
+        if store is None:
+            store = self.store
+        return memberships.get(store, group)
+
+    def warm(self, memberships, group, store=None):
+        """
+        Read a group whose membership isn't kept yet, let the background
+        refresh finish and return the kept membership.
+        """
+        self.assertEqual(self.get(memberships, group, store), None)
+        self.clock.advance(0)
+        return self.get(memberships, group, store)
+
+    def test_get(self):
+        contacts = [self.new_contact(name=u"Jane") for _ in range(3)]
+        self.new_contact(name=u"John")
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships()
+        self.assertEqual(self.get(memberships, group), None)
+        self.assertEqual(memberships.refreshes, 1)
+        self.clock.advance(0)
+        membership = self.get(memberships, group)
+        self.assertEqual(
+            membership.keys, sorted(contact.key for contact in contacts))
+        self.assertEqual(membership.refreshed_at, 0)
+        self.assertIdentical(self.get(memberships, group), membership)
+        self.assertEqual(memberships.metrics(), {
+            'hits': 2, 'refreshes': 1, 'updates': 0, 'groups': 1, 'keys': 3,
+        })
+
+    def test_search_pages(self):
+        contacts = [self.new_contact(name=u"Jane") for _ in range(5)]
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships(search_page_size=2)
+        self.assertEqual(
+            self.warm(memberships, group).keys,
+            sorted(contact.key for contact in contacts))
+
+    def test_refreshed_when_too_old(self):
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships()
+        self.assertEqual(self.warm(memberships, group).keys, [])
+        contact = self.new_contact(name=u"Jane")
+        self.clock.advance(10)
+        self.assertEqual(self.get(memberships, group).keys, [])
+        self.clock.advance(1)
+        membership = self.warm(memberships, group)
+        self.assertEqual(membership.keys, [contact.key])
+        self.assertEqual(membership.refreshed_at, 11)
+        self.assertEqual(memberships.refreshes, 2)
+
+    def test_refreshed_when_query_changes(self):
+        jane = self.new_contact(name=u"Jane")
+        john = self.new_contact(name=u"John")
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships()
+        self.assertEqual(self.warm(memberships, group).keys, [jane.key])
+        group.query = u"name:John"
+        self.assertEqual(self.warm(memberships, group).keys, [john.key])
+
+    def test_owners_kept_apart(self):
+        other_store = self.get_store("owner-2")
+        contact = self.new_contact(name=u"Jane")
+        other_contact = self.new_contact(other_store, name=u"Jane")
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships()
+        self.assertEqual(self.warm(memberships, group).keys, [contact.key])
+        self.assertEqual(
+            self.warm(memberships, group, other_store).keys,
+            [other_contact.key])
+
+    def test_concurrent_refreshes_shared(self):
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships()
+        self.manager.latency = {'real_search': 1}
+        self.assertEqual(self.get(memberships, group), None)
+        self.assertEqual(self.get(memberships, group), None)
+        self.clock.advance(1)
+        self.assertEqual(memberships.refreshes, 1)
+        self.assertEqual(self.get(memberships, group).keys, [])
+
+    def test_max_groups(self):
+        groups = [self.new_group(u"name:Jane") for _ in range(3)]
+        memberships = self.mk_memberships(max_groups=2)
+        for group in groups:
+            self.warm(memberships, group)
+        self.assertNotEqual(self.get(memberships, groups[1]), None)
+        self.warm(memberships, groups[0])
+        self.assertEqual(len(memberships), 2)
+        self.assertEqual(memberships.refreshes, 4)
+        self.assertEqual(self.get(memberships, groups[2]), None)
+
+    def test_max_keys(self):
+        for _ in range(3):
+            self.new_contact(name=u"Jane")
+        for _ in range(2):
+            self.new_contact(name=u"John")
+        janes = self.new_group(u"name:Jane")
+        johns = self.new_group(u"name:John")
+        memberships = self.mk_memberships(max_keys=4)
+        self.warm(memberships, janes)
+        self.warm(memberships, johns)
+        self.assertEqual(len(memberships), 1)
+        self.assertEqual(memberships.metrics()['keys'], 2)
+        self.assertEqual(self.get(memberships, janes), None)
+
+    def test_too_many_keys(self):
+        for _ in range(3):
+            self.new_contact(name=u"Jane")
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships(max_keys=2, search_page_size=1)
+        self.assertEqual(self.warm(memberships, group), None)
+        self.assertEqual(self.get(memberships, group), None)
+        self.assertEqual(memberships.refreshes, 1)
+        self.assertEqual(memberships.metrics()['keys'], 0)
+        self.clock.advance(11)
+        self.assertEqual(self.get(memberships, group), None)
+        self.assertEqual(memberships.refreshes, 2)
+
+    def test_refresh_interval(self):
+        read_group = self.new_group(u"name:Jane")
+        unread_group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships(refresh_interval=5)
+        memberships.start()
+        self.warm(memberships, read_group)
+        self.warm(memberships, unread_group)
+        contact = self.new_contact(name=u"Jane")
+
+        # Both groups were read before the first refresh.
+        self.clock.advance(5)
+        self.assertEqual(memberships.refreshes, 4)
+        self.get(memberships, read_group)
+        self.clock.advance(5)
+        self.assertEqual(memberships.refreshes, 5)
+        self.assertEqual(len(memberships), 1)
+        membership = self.get(memberships, read_group)
+        self.assertEqual(membership.keys, [contact.key])
+        self.assertEqual(membership.refreshed_at, 10)
+
+        memberships.stop()
+        self.clock.advance(5)
+        self.assertEqual(memberships.refreshes, 5)
+
+    def test_reads_only_recorded_with_refresh_interval(self):
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships()
+        self.warm(memberships, group)
+        self.assertEqual(memberships._read, set())
+        memberships = self.mk_memberships(refresh_interval=5)
+        self.warm(memberships, group)
+        self.assertEqual(memberships._read, set([("owner-1", group.key)]))
+
+    def test_failed_refresh_not_recorded_as_read(self):
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships(refresh_interval=5)
+        self.patch(
+            memberships, '_search',
+            lambda store, query: fail(ValueError("Search failed")))
+        self.assertEqual(self.get(memberships, group), None)
+        self.assertEqual(memberships._read, set())
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(err.getErrorMessage(), "Search failed")
+
+    def test_contacts_changed(self):
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships(write_refresh_delay=1)
+        self.warm(memberships, group)
+        contact = self.new_contact(name=u"Jane")
+        memberships.contacts_changed("owner-1")
+        memberships.contacts_changed("owner-1")
+        memberships.contacts_changed("owner-2")
+        self.clock.advance(1)
+        self.assertEqual(memberships.refreshes, 2)
+        membership = self.get(memberships, group)
+        self.assertEqual(membership.keys, [contact.key])
+        self.assertEqual(membership.refreshed_at, 1)
+
+    def test_contacts_changed_without_delay(self):
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships()
+        self.warm(memberships, group)
+        memberships.contacts_changed("owner-1")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def contact_data(self, contact):
+        data = contact.get_data()
+        data.pop('key')
+        return data
+
+    def test_contact_written(self):
+        jane = self.new_contact(name=u"Jane")
+        group = self.new_group(u"name:Jane")
+        other_store = self.get_store("owner-2")
+        other_group = self.new_group(u"name:Jane", other_store)
+        memberships = self.mk_memberships()
+        self.warm(memberships, group)
+        self.warm(memberships, other_group, other_store)
+
+        john = self.new_contact(name=u"John")
+        memberships.contact_written(
+            "owner-1", john.key, self.contact_data(john))
+        self.assertEqual(self.get(memberships, group).keys, [jane.key])
+
+        john.name = u"Jane"
+        memberships.contact_written(
+            "owner-1", john.key, self.contact_data(john))
+        memberships.contact_written("owner-1", jane.key, None)
+        self.assertEqual(self.get(memberships, group).keys, [john.key])
+        self.assertEqual(
+            self.get(memberships, other_group, other_store).keys, [])
+        self.assertEqual(memberships.updates, 2)
+        self.assertEqual(memberships.refreshes, 2)
+        self.assertEqual(memberships.metrics()['keys'], 1)
+
+    def test_contact_written_invalid_query(self):
+        memberships = self.mk_memberships()
+        memberships._refreshed(Membership(u"name:", [], 0), ("owner-1", "g"))
+        memberships.contact_written("owner-1", u"a", {u"name": u"Jane"})
+        self.assertEqual(len(memberships), 0)
+
+    def test_contact_written_during_search(self):
+        jane = self.new_contact(name=u"Jane")
+        group = self.new_group(u"name:Jane")
+        memberships = self.mk_memberships()
+        self.manager.latency = {'real_search': 1}
+        self.assertEqual(self.get(memberships, group), None)
+        self.clock.advance(0.5)
+
+        # The search may miss writes made while it is in progress.
+        john = self.new_contact(name=u"Jane")
+        memberships.contact_written(
+            "owner-1", john.key, self.contact_data(john))
+        memberships.contact_written("owner-1", jane.key, None)
+        self.clock.advance(0.5)
+        self.assertEqual(self.get(memberships, group).keys, [john.key])
+        self.assertEqual(memberships._writes, [])
+
+    def test_contact_written_prohibited_and_required(self):
+        groups = dict(
+            (query, self.new_group(query)) for query in [
+                u"name:Jane -surname:Smith",
+                u"name:Jane NOT surname:Smith",
+                u"+name:Jane surname:Doe",
+                u"-surname:Smith",
+            ])
+        memberships = self.mk_memberships()
+        for group in groups.values():
+            self.warm(memberships, group)
+
+        def assert_keys(query, keys):
+            self.assertEqual(
+                self.get(memberships, groups[query]).keys, keys,
+                "Unexpected keys for %r" % (query,))
+
+        memberships.contact_written(
+            "owner-1", u"a", {u"name": u"Jane", u"surname": u"Smith"})
+        memberships.contact_written(
+            "owner-1", u"b", {u"name": u"Jane", u"surname": u"Doe"})
+        memberships.contact_written(
+            "owner-1", u"c", {u"name": u"John", u"surname": u"Doe"})
+        assert_keys(u"name:Jane -surname:Smith", [u"b"])
+        assert_keys(u"name:Jane NOT surname:Smith", [u"b"])
+        assert_keys(u"+name:Jane surname:Doe", [u"a", u"b"])
+        assert_keys(u"-surname:Smith", [u"b", u"c"])
+
+        memberships.contact_written(
+            "owner-1", u"b", {u"name": u"Jane", u"surname": u"Smith"})
+        memberships.contact_written("owner-1", u"a", None)
+        assert_keys(u"name:Jane -surname:Smith", [])
+        assert_keys(u"name:Jane NOT surname:Smith", [])
+        assert_keys(u"+name:Jane surname:Doe", [u"b"])
+        assert_keys(u"-surname:Smith", [u"c"])
+
+    def test_owner_index(self):
+        group = self.new_group(u"name:Jane")
+        other_store = self.get_store("owner-2")
+        other_group = self.new_group(u"name:Jane", other_store)
+        memberships = self.mk_memberships(max_groups=1)
+        self.warm(memberships, group)
+        self.assertEqual(memberships._owner_keys, {
+            "owner-1": set([("owner-1", group.key)]),
+        })
+        self.warm(memberships, other_group, other_store)
+        self.assertEqual(memberships._owner_keys, {
+            "owner-2": set([("owner-2", other_group.key)]),
+        })
+        memberships.contact_written("owner-1", u"a", {u"name": u"Jane"})
+        self.assertEqual(memberships.updates, 0)
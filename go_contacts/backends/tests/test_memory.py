@@ -0,0 +1,209 @@
+"""
+Tests for go_contacts.backends.memory.
+"""
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.persist.model import VumiRiakError
+from vumi.tests.helpers import VumiTestCase
+
+from go.vumitools.contact import ContactStore, ContactNotFoundError
+
+from go_contacts.backends.memory import InMemoryRiakManager
+
+
+class TestInMemoryRiakManager(VumiTestCase):
+    def setUp(self):
+        self.manager = InMemoryRiakManager(bucket_prefix="test.")
+        self.store = ContactStore(self.manager, "owner-1")
+
+    @inlineCallbacks
+    def test_store_and_load(self):
+        contact = yield self.store.new_contact(
+            msisdn=u"+12345", name=u"Jane", extra={u"city": u"Cape Town"})
+        loaded = yield self.store.get_contact_by_key(contact.key)
+        self.assertEqual(loaded.msisdn, u"+12345")
+        self.assertEqual(loaded.extra[u"city"], u"Cape Town")
+        self.assertEqual(loaded.get_data(), contact.get_data())
+
+    @inlineCallbacks
+    def test_loaded_data_is_a_copy(self):
+        contact = yield self.store.new_contact(msisdn=u"+12345")
+        contact.name = u"Changed"
+        loaded = yield self.store.get_contact_by_key(contact.key)
+        self.assertEqual(loaded.name, None)
+
+    @inlineCallbacks
+    def test_load_missing(self):
+        yield self.assertFailure(
+            self.store.get_contact_by_key("missing"), ContactNotFoundError)
+
+    @inlineCallbacks
+    def test_delete(self):
+        contact = yield self.store.new_contact(msisdn=u"+12345")
+        yield contact.delete()
+        yield self.assertFailure(
+            self.store.get_contact_by_key(contact.key), ContactNotFoundError)
+        keys = yield self.store.contacts.index_keys('msisdn', u"+12345")
+        self.assertEqual(keys, [])
+
+    @inlineCallbacks
+    def test_index_keys(self):
+        contact = yield self.store.new_contact(msisdn=u"+12345")
+        yield self.store.new_contact(msisdn=u"+54321")
+        keys = yield self.store.contacts.index_keys('msisdn', u"+12345")
+        self.assertEqual(keys, [contact.key])
+        contact.msisdn = u"+11111"
+        yield contact.save()
+        keys = yield self.store.contacts.index_keys('msisdn', u"+12345")
+        self.assertEqual(keys, [])
+
+    @inlineCallbacks
+    def test_index_keys_range(self):
+        for msisdn in [u"+3", u"+1", u"+2"]:
+            yield self.store.new_contact(msisdn=msisdn)
+        terms = yield self.store.contacts.index_keys(
+            'msisdn', u"+1", u"+2", return_terms=True)
+        self.assertEqual([term for term, _key in terms], [u"+1", u"+2"])
+
+    @inlineCallbacks
+    def test_index_keys_page(self):
+        keys = []
+        for i in range(5):
+            contact = yield self.store.new_contact(msisdn=u"+%d" % (i,))
+            keys.append(contact.key)
+        page = yield self.store.contacts.index_keys_page(
+            'user_account', "owner-1", max_results=2)
+        pages = [list(page)]
+        while page.has_next_page():
+            page = yield self.store.contacts.index_keys_page(
+                'user_account', "owner-1", max_results=2,
+                continuation=page.continuation)
+            pages.append(list(page))
+        self.assertEqual([len(p) for p in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []), sorted(keys))
+
+    @inlineCallbacks
+    def test_index_keys_page_full_last_page(self):
+        yield self.store.new_contact(msisdn=u"+1")
+        page = yield self.store.contacts.index_keys_page(
+            'user_account', "owner-1", max_results=1)
+        self.assertTrue(page.has_next_page())
+        page = yield page.next_page()
+        self.assertEqual(list(page), [])
+        self.assertFalse(page.has_next_page())
+
+    @inlineCallbacks
+    def test_index_keys_page_invalid_continuation(self):
+        yield self.assertFailure(
+            self.store.contacts.index_keys_page(
+                'user_account', "owner-1", max_results=1,
+                continuation="bad"),
+            VumiRiakError)
+
+    @inlineCallbacks
+    def test_all_keys(self):
+        contact = yield self.store.new_contact(msisdn=u"+1")
+        group = yield self.store.new_group(u"group")
+        keys = yield self.store.contacts.all_keys()
+        self.assertEqual(keys, [contact.key])
+        keys = yield self.store.groups.all_keys()
+        self.assertEqual(keys, [group.key])
+
+    @inlineCallbacks
+    def test_groups(self):
+        group = yield self.store.new_group(u"group")
+        contact = yield self.store.new_contact(
+            msisdn=u"+1", groups=[group.key])
+        yield self.store.new_contact(msisdn=u"+2")
+        page = yield self.store.contacts.index_keys_page(
+            'groups', group.key, max_results=10)
+        self.assertEqual(list(page), [contact.key])
+
+    @inlineCallbacks
+    def test_real_search(self):
+        keys = []
+        for i in range(5):
+            contact = yield self.store.new_contact(msisdn=u"+2771%d" % (i,))
+            keys.append(contact.key)
+        yield self.store.new_contact(msisdn=u"+2782")
+        found = yield self.store.contacts.real_search(u"msisdn:\\+2771*")
+        self.assertEqual(found, sorted(keys))
+        found = yield self.store.contacts.real_search(
+            u"msisdn:\\+2771*", rows=2, start=2)
+        self.assertEqual(found, sorted(keys)[2:4])
+
+    @inlineCallbacks
+    def test_real_search_sees_changes(self):
+        yield self.store.contacts.real_search(u"name:Jane")
+        contact = yield self.store.new_contact(msisdn=u"+1", name=u"Jane")
+        found = yield self.store.contacts.real_search(u"name:Jane")
+        self.assertEqual(found, [contact.key])
+
+    @inlineCallbacks
+    def test_map_reduce(self):
+        contact = yield self.store.new_contact(msisdn=u"+1", name=u"Jane")
+        yield self.store.new_contact(msisdn=u"+2", name=u"John")
+        keys = yield self.store.contacts.search(name=u"Jane").get_keys()
+        self.assertEqual(keys, [contact.key])
+        count = yield self.store.contacts.index_lookup(
+            'user_account', "owner-1").get_count()
+        self.assertEqual(count, 2)
+
+    @inlineCallbacks
+    def test_sub_managers_share_data(self):
+        contact = yield self.store.new_contact(msisdn=u"+1")
+        other_store = ContactStore(self.manager, "owner-1")
+        loaded = yield other_store.get_contact_by_key(contact.key)
+        self.assertEqual(loaded.msisdn, u"+1")
+        owner_2_store = ContactStore(self.manager, "owner-2")
+        keys = yield owner_2_store.contacts.all_keys()
+        self.assertEqual(keys, [])
+
+    @inlineCallbacks
+    def test_purge_all(self):
+        yield self.store.new_contact(msisdn=u"+1")
+        yield self.manager.purge_all()
+        keys = yield self.store.contacts.all_keys()
+        self.assertEqual(keys, [])
+
+    def test_latency(self):
+        clock = Clock()
+        manager = InMemoryRiakManager(
+            bucket_prefix="test.", reactor=clock,
+            latency={'store': 0.5, 'load': 0.25})
+        store = ContactStore(manager, "owner-1")
+        d = store.new_contact(msisdn=u"+1")
+        self.assertNoResult(d)
+        clock.advance(0.5)
+        contact = self.successResultOf(d)
+        d = store.get_contact_by_key(contact.key)
+        clock.advance(0.2)
+        self.assertNoResult(d)
+        clock.advance(0.05)
+        self.assertEqual(self.successResultOf(d).msisdn, u"+1")
+        d = store.contacts.index_keys('msisdn', u"+1")
+        self.assertNoResult(d)
+        clock.advance(0)
+        self.assertEqual(self.successResultOf(d), [contact.key])
+
+    def test_latency_for_all_operations(self):
+        clock = Clock()
+        manager = InMemoryRiakManager(reactor=clock, latency=0.5)
+        store = ContactStore(manager, "owner-1")
+        d = store.contacts.index_keys('msisdn', u"+1")
+        self.assertNoResult(d)
+        clock.advance(0.5)
+        self.assertEqual(self.successResultOf(d), [])
+
+    def test_from_config(self):
+        manager = InMemoryRiakManager.from_config({
+            'bucket_prefix': "test.",
+            'load_bunch_size': 10,
+            'host': "localhost",
+            'latency': {'load': 0.5},
+        })
+        self.assertEqual(manager.bucket_prefix, "test.")
+        self.assertEqual(manager.load_bunch_size, 10)
+        self.assertEqual(manager.latency, {'load': 0.5})
@@ -0,0 +1,168 @@
+"""
+Tests for go_contacts.backends.scheduler.
+"""
+
+from twisted.internet.defer import Deferred, CancelledError, succeed
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.backends.scheduler import (
+    RiakScheduler, ScheduledRiakManager, INTERACTIVE, BULK)
+
+
+class TestRiakScheduler(VumiTestCase):
+    def setUp(self):
+        self.started = []
+
+    def call(self, name):
+        d = Deferred()
+        self.started.append((name, d))
+        return d
+
+    def finish(self, name, result=None):
+        for i, (started_name, d) in enumerate(self.started):
+            if started_name == name:
+                del self.started[i]
+                d.callback(result)
+                return
+        self.fail("%r not started" % (name,))
+
+    def started_names(self):
+        return [name for name, _ in self.started]
+
+    def test_unlimited(self):
+        scheduler = RiakScheduler()
+        for i in range(5):
+            scheduler.run(BULK, self.call, "bulk-%d" % i)
+        self.assertEqual(len(self.started), 5)
+        self.assertEqual(scheduler.active, {INTERACTIVE: 0, BULK: 5})
+
+    def test_result(self):
+        scheduler = RiakScheduler(bulk_concurrency=1)
+        d = scheduler.run(BULK, lambda x: succeed(x * 2), 21)
+        self.assertEqual(self.successResultOf(d), 42)
+        self.assertEqual(scheduler.active, {INTERACTIVE: 0, BULK: 0})
+
+    def test_failure(self):
+        scheduler = RiakScheduler(bulk_concurrency=1)
+        d = scheduler.run(BULK, lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        self.assertEqual(scheduler.active, {INTERACTIVE: 0, BULK: 0})
+
+    def test_bulk_limit(self):
+        scheduler = RiakScheduler(bulk_concurrency=2)
+        ds = [scheduler.run(BULK, self.call, "bulk-%d" % i)
+              for i in range(3)]
+        self.assertEqual(self.started_names(), ["bulk-0", "bulk-1"])
+        self.assertEqual(scheduler.waiting(BULK), 1)
+        self.finish("bulk-0", "result")
+        self.assertEqual(self.successResultOf(ds[0]), "result")
+        self.assertEqual(self.started_names(), ["bulk-1", "bulk-2"])
+        self.assertEqual(scheduler.waiting(BULK), 0)
+
+    def test_interactive_not_blocked_by_bulk(self):
+        scheduler = RiakScheduler(
+            interactive_concurrency=1, bulk_concurrency=1)
+        scheduler.run(BULK, self.call, "bulk-0")
+        scheduler.run(BULK, self.call, "bulk-1")
+        scheduler.run(INTERACTIVE, self.call, "interactive-0")
+        self.assertEqual(self.started_names(), ["bulk-0", "interactive-0"])
+
+    def test_interactive_borrows_idle_bulk_capacity(self):
+        scheduler = RiakScheduler(
+            interactive_concurrency=1, bulk_concurrency=1)
+        scheduler.run(INTERACTIVE, self.call, "interactive-0")
+        scheduler.run(INTERACTIVE, self.call, "interactive-1")
+        scheduler.run(INTERACTIVE, self.call, "interactive-2")
+        self.assertEqual(
+            self.started_names(), ["interactive-0", "interactive-1"])
+        self.assertEqual(scheduler.active, {INTERACTIVE: 1, BULK: 1})
+        # Bulk calls have to wait for their budget to be free.
+        scheduler.run(BULK, self.call, "bulk-0")
+        self.assertEqual(scheduler.waiting(BULK), 1)
+
+    def test_interactive_dispatched_first(self):
+        scheduler = RiakScheduler(
+            interactive_concurrency=1, bulk_concurrency=1)
+        scheduler.run(INTERACTIVE, self.call, "interactive-0")
+        scheduler.run(BULK, self.call, "bulk-0")
+        scheduler.run(BULK, self.call, "bulk-1")
+        scheduler.run(INTERACTIVE, self.call, "interactive-1")
+        scheduler.run(INTERACTIVE, self.call, "interactive-2")
+        # A bulk slot frees up and the waiting interactive call gets it.
+        self.finish("bulk-0")
+        self.assertEqual(
+            self.started_names(), ["interactive-0", "interactive-1"])
+        self.finish("interactive-0")
+        self.assertEqual(
+            self.started_names(), ["interactive-1", "interactive-2"])
+        self.assertEqual(scheduler.waiting(BULK), 1)
+        self.finish("interactive-1")
+        self.finish("interactive-2")
+        self.assertEqual(self.started_names(), ["bulk-1"])
+        self.assertEqual(scheduler.dispatched, {INTERACTIVE: 3, BULK: 2})
+
+    def test_cancel_waiting(self):
+        scheduler = RiakScheduler(bulk_concurrency=1)
+        scheduler.run(BULK, self.call, "bulk-0")
+        d = scheduler.run(BULK, self.call, "bulk-1")
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(scheduler.waiting(BULK), 0)
+        self.finish("bulk-0")
+        self.assertEqual(self.started, [])
+
+    def test_cancel_running(self):
+        scheduler = RiakScheduler(bulk_concurrency=1)
+        d = scheduler.run(BULK, self.call, "bulk-0")
+        d1 = scheduler.run(BULK, self.call, "bulk-1")
+        [(_, running)] = self.started
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        # The running call can't be stopped, so it keeps its slot.
+        self.assertFalse(running.called)
+        self.assertEqual(self.started_names(), ["bulk-0"])
+        self.assertEqual(scheduler.active, {INTERACTIVE: 0, BULK: 1})
+        self.assertEqual(scheduler.waiting(BULK), 1)
+        self.finish("bulk-0", "ignored")
+        self.assertEqual(self.started_names(), ["bulk-1"])
+        self.assertEqual(scheduler.active, {INTERACTIVE: 0, BULK: 1})
+        self.finish("bulk-1", "result")
+        self.assertEqual(self.successResultOf(d1), "result")
+        self.assertEqual(scheduler.active, {INTERACTIVE: 0, BULK: 0})
+
+    def test_cancel_running_failure(self):
+        scheduler = RiakScheduler(bulk_concurrency=1)
+        d = scheduler.run(BULK, self.call, "bulk-0")
+        [(_, running)] = self.started
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        running.errback(ZeroDivisionError())
+        self.assertEqual(scheduler.active, {INTERACTIVE: 0, BULK: 0})
+
+
+class DummyManager(object):
+    def __init__(self):
+        self.loads = []
+
+    def load(self, modelcls, key, result=None):
+        self.loads.append(key)
+        return Deferred()
+
+
+class TestScheduledRiakManager(VumiTestCase):
+    def test_invalid_lane(self):
+        err = self.assertRaises(
+            ValueError, ScheduledRiakManager, DummyManager(), RiakScheduler(),
+            "foo")
+        self.assertEqual(
+            str(err), "Unknown lane 'foo', must be one of: interactive, bulk")
+
+    def test_calls_are_scheduled(self):
+        manager = DummyManager()
+        scheduler = RiakScheduler(bulk_concurrency=1)
+        scheduled = ScheduledRiakManager(manager, scheduler, BULK)
+        scheduled.load(object, "key-1")
+        scheduled.load(object, "key-2")
+        self.assertEqual(manager.loads, ["key-1"])
+        self.assertEqual(scheduler.waiting(BULK), 1)
@@ -0,0 +1,101 @@
+"""
+Tests for go_contacts.backends.search.
+"""
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.backends.search import compile_query, SearchQueryError
+
+
+class TestCompileQuery(VumiTestCase):
+    contact = {
+        u"name": u"Jane",
+        u"surname": u"Doe",
+        u"msisdn": u"+27831234567",
+        u"groups": [u"group-1", u"group-2"],
+        u"extras-city": u"Cape Town",
+        u"twitter_handle": None,
+    }
+
+    def assert_matches(self, query, expected=True):
+        self.assertEqual(compile_query(query)(self.contact), expected)
+
+    def test_field_value(self):
+        self.assert_matches(u"name:Jane")
+        self.assert_matches(u"name:jane")
+        self.assert_matches(u"name:Jan", False)
+        self.assert_matches(u"missing:Jane", False)
+        self.assert_matches(u"twitter_handle:None", False)
+
+    def test_wildcards(self):
+        self.assert_matches(u"msisdn:\\+2783*")
+        self.assert_matches(u"msisdn:+2784*", False)
+        self.assert_matches(u"name:J?ne")
+        self.assert_matches(u"extras-city:cape*")
+
+    def test_quoted(self):
+        self.assert_matches(u"extras-city:'Cape Town'")
+        self.assert_matches(u'extras-city:"Cape Town"')
+        self.assert_matches(u"name:'Jan*'", False)
+        self.assert_matches(u"name:'J\\'ane'", False)
+
+    def test_list_field(self):
+        self.assert_matches(u"groups:group-2")
+        self.assert_matches(u"groups:group-3", False)
+
+    def test_bare_value(self):
+        self.assert_matches(u"Doe")
+        self.assert_matches(u"Smith", False)
+
+    def test_operators(self):
+        self.assert_matches(u"name:Jane AND surname:Doe")
+        self.assert_matches(u"name:Jane && surname:Smith", False)
+        self.assert_matches(u"name:John OR surname:Doe")
+        self.assert_matches(u"name:John || surname:Smith", False)
+        self.assert_matches(u"name:John surname:Doe")
+        self.assert_matches(u"name:Jane AND NOT surname:Doe", False)
+        self.assert_matches(u"name:Jane AND -surname:Smith")
+
+    def test_prohibited_clauses(self):
+        self.assert_matches(u"name:Jane NOT surname:Doe", False)
+        self.assert_matches(u"name:Jane NOT surname:Smith")
+        self.assert_matches(u"name:John NOT surname:Smith", False)
+        self.assert_matches(u"name:Jane -surname:Doe", False)
+        self.assert_matches(u"name:John -surname:Smith", False)
+        self.assert_matches(u"name:John OR NOT surname:Doe", False)
+        self.assert_matches(u"-surname:Doe name:Jane", False)
+        self.assert_matches(u"name:Jane (-surname:Doe)", True)
+
+    def test_only_prohibited_clauses(self):
+        self.assert_matches(u"-surname:Smith")
+        self.assert_matches(u"NOT surname:Doe", False)
+        self.assert_matches(u"-name:John -surname:Smith")
+        self.assert_matches(u"-name:John -surname:Doe", False)
+
+    def test_required_clauses(self):
+        self.assert_matches(u"+name:John surname:Doe", False)
+        self.assert_matches(u"+name:Jane surname:Smith")
+        self.assert_matches(u"+name:Jane +surname:Smith", False)
+        self.assert_matches(u"+name:Jane -surname:Doe", False)
+        self.assert_matches(u"name:John +(surname:Smith OR groups:group-1)")
+
+    def test_prohibited_clauses_with_and(self):
+        self.assert_matches(u"name:Jane AND NOT surname:Smith")
+        self.assert_matches(u"NOT surname:Smith AND name:Jane")
+        self.assert_matches(u"NOT surname:Doe AND name:Jane", False)
+        self.assert_matches(
+            u"name:John AND NOT surname:Doe OR name:Jane")
+
+    def test_precedence(self):
+        self.assert_matches(u"name:John AND surname:Smith OR name:Jane")
+        self.assert_matches(
+            u"name:John AND (surname:Smith OR name:Jane)", False)
+
+    def test_bytes(self):
+        self.assert_matches("name:Jane")
+
+    def test_invalid(self):
+        for query in [u"", u"name:", u"(name:Jane", u"name:Jane)",
+                      u"name:'Jane", u"name:Jane AND", u"AND name:Jane",
+                      u"NOT", u"name:Jane -", u"NOT -name:Jane"]:
+            self.assertRaises(SearchQueryError, compile_query, query)
@@ -0,0 +1,121 @@
+"""
+Tests for go_contacts.backends.singleflight.
+"""
+
+from twisted.internet.defer import Deferred, CancelledError, succeed
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.backends.singleflight import SingleFlight
+
+
+class TestSingleFlight(VumiTestCase):
+    def setUp(self):
+        self.calls = []
+
+    def call(self, name):
+        d = Deferred(canceller=lambda d: self.cancelled.append(name))
+        self.calls.append((name, d))
+        return d
+
+    def test_single_call(self):
+        sf = SingleFlight()
+        d = sf.run("key", lambda: succeed("result"))
+        self.assertEqual(self.successResultOf(d), "result")
+        self.assertEqual(sf.metrics(), {
+            'calls': 1, 'coalesced': 0, 'overflowed': 0, 'in_flight': 0})
+
+    def test_coalesce(self):
+        sf = SingleFlight()
+        d1 = sf.run("key", self.call, "first")
+        d2 = sf.run("key", self.call, "second")
+        self.assertEqual([name for name, _ in self.calls], ["first"])
+        self.assertEqual(sf.in_flight, 1)
+        self.calls[0][1].callback("result")
+        self.assertEqual(self.successResultOf(d1), "result")
+        self.assertEqual(self.successResultOf(d2), "result")
+        self.assertEqual(sf.metrics(), {
+            'calls': 1, 'coalesced': 1, 'overflowed': 0, 'in_flight': 0})
+
+    def test_different_keys(self):
+        sf = SingleFlight()
+        sf.run("key-1", self.call, "first")
+        sf.run("key-2", self.call, "second")
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(sf.in_flight, 2)
+
+    def test_failure_shared(self):
+        sf = SingleFlight()
+        d1 = sf.run("key", self.call, "first")
+        d2 = sf.run("key", self.call, "second")
+        self.calls[0][1].errback(ValueError("oops"))
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+        self.assertEqual(sf.in_flight, 0)
+
+    def test_new_call_after_landing(self):
+        sf = SingleFlight()
+        sf.run("key", self.call, "first")
+        self.calls[0][1].callback("result")
+        d = sf.run("key", self.call, "second")
+        self.assertEqual(len(self.calls), 2)
+        self.assertNoResult(d)
+
+    def test_max_waiters(self):
+        sf = SingleFlight(max_waiters=2)
+        sf.run("key", self.call, "first")
+        sf.run("key", self.call, "second")
+        d3 = sf.run("key", self.call, "third")
+        self.assertEqual(
+            [name for name, _ in self.calls], ["first", "third"])
+        self.calls[1][1].callback("third result")
+        self.assertEqual(self.successResultOf(d3), "third result")
+        self.assertEqual(sf.metrics(), {
+            'calls': 1, 'coalesced': 1, 'overflowed': 1, 'in_flight': 1})
+
+    def test_forget(self):
+        sf = SingleFlight()
+        d1 = sf.run("key", self.call, "first")
+        sf.forget("key")
+        d2 = sf.run("key", self.call, "second")
+        self.assertEqual(len(self.calls), 2)
+        self.calls[0][1].callback("old")
+        self.assertEqual(self.successResultOf(d1), "old")
+        # The first call landing doesn't remove the second call's flight.
+        self.assertEqual(sf.in_flight, 1)
+        d3 = sf.run("key", self.call, "third")
+        self.calls[1][1].callback("new")
+        self.assertEqual(self.successResultOf(d2), "new")
+        self.assertEqual(self.successResultOf(d3), "new")
+
+    def test_forget_prefix(self):
+        sf = SingleFlight()
+        sf.run(("addr", "owner-1", "msisdn", "+1"), self.call, "a")
+        sf.run(("addr", "owner-1", "msisdn", "+2"), self.call, "b")
+        sf.run(("addr", "owner-2", "msisdn", "+1"), self.call, "c")
+        sf.run("other", self.call, "d")
+        sf.forget_prefix(("addr", "owner-1"))
+        self.assertEqual(sf.in_flight, 2)
+
+    def test_cancel_waiter(self):
+        self.cancelled = []
+        sf = SingleFlight()
+        d1 = sf.run("key", self.call, "first")
+        d2 = sf.run("key", self.call, "second")
+        d1.cancel()
+        self.failureResultOf(d1, CancelledError)
+        self.assertEqual(self.cancelled, [])
+        self.calls[0][1].callback("result")
+        self.assertEqual(self.successResultOf(d2), "result")
+
+    def test_cancel_all_waiters(self):
+        self.cancelled = []
+        sf = SingleFlight()
+        d1 = sf.run("key", self.call, "first")
+        d2 = sf.run("key", self.call, "second")
+        d1.cancel()
+        d2.cancel()
+        self.failureResultOf(d1, CancelledError)
+        self.failureResultOf(d2, CancelledError)
+        self.assertEqual(self.cancelled, ["first"])
+        self.assertEqual(sf.in_flight, 0)
@@ -0,0 +1,60 @@
+"""
+Tests for go_contacts.backends.tracing.
+"""
+
+from twisted.internet.defer import succeed
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.backends.tracing import TracingRiakManager
+from go_contacts.tracing import Tracer, InMemoryExporter, TracedModel
+
+
+class DummyManager(object):
+    def index_keys_page(self, *args, **kw):
+        return succeed(["key-1"])
+
+    def real_search(self, *args, **kw):
+        raise ValueError("Bad query")
+
+
+class DummyCollection(object):
+    def __init__(self, manager):
+        self.manager = manager
+
+    def page(self, cursor, max_results, query):
+        return self.manager.index_keys_page("groups", "group-1")
+
+
+class TestTracingRiakManager(VumiTestCase):
+    def setUp(self):
+        self.exporter = InMemoryExporter()
+        self.root = Tracer(self.exporter).start_trace("GET")
+        self.manager = TracingRiakManager(DummyManager(), self.root.trace)
+
+    def finish_trace(self):
+        self.root.finish()
+        [spans] = self.exporter.traces
+        return dict((span['name'], span) for span in spans)
+
+    def test_riak_call(self):
+        d = self.manager.index_keys_page("groups", "group-1")
+        self.assertEqual(self.successResultOf(d), ["key-1"])
+        spans = self.finish_trace()
+        self.assertEqual(
+            spans["riak.index_keys_page"]["parent_id"], self.root.span_id)
+
+    def test_riak_call_error(self):
+        self.failureResultOf(self.manager.real_search("foo"), ValueError)
+        spans = self.finish_trace()
+        self.assertEqual(
+            spans["riak.real_search"]["attributes"], {'error': "Bad query"})
+
+    def test_parent_is_model_method(self):
+        model = TracedModel(DummyCollection(self.manager), self.root)
+        self.successResultOf(model.page(None, 5, None))
+        spans = self.finish_trace()
+        self.assertEqual(
+            spans["riak.index_keys_page"]["parent_id"],
+            spans["page"]["span_id"])
+        self.assertEqual(spans["page"]["parent_id"], self.root.span_id)
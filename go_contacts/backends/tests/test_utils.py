@@ -0,0 +1,125 @@
+"""
+Tests for backend utilities.
+"""
+
+from twisted.internet.defer import (
+    Deferred, CancelledError, inlineCallbacks, succeed)
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_api.queue import PausingDeferredQueue, PausingQueueCloseMarker
+
+from go_contacts.backends.utils import _fill_queue
+
+
+class TestFillQueue(VumiTestCase):
+    def setUp(self):
+        self.pages = {
+            None: ("page-2", ["a", "b"]),
+            "page-2": (None, ["c"]),
+        }
+        self.page_requests = []
+        self.dict_requests = {}
+
+    def get_page(self, cursor):
+        self.page_requests.append(cursor)
+        return succeed(self.pages[cursor])
+
+    def get_dict(self, key):
+        return succeed({u"key": key})
+
+    def get_dict_pending(self, key):
+        d = Deferred()
+        self.dict_requests[key] = d
+        return d
+
+    @inlineCallbacks
+    def test_fill_queue(self):
+        q = PausingDeferredQueue(backlog=1, size=10)
+        yield _fill_queue(q, self.get_page, self.get_dict)
+        self.assertEqual([item[u"key"] for item in q.pending[:3]],
+                         ["a", "b", "c"])
+        self.assertTrue(isinstance(q.pending[3], PausingQueueCloseMarker))
+        self.assertEqual(self.page_requests, [None, "page-2"])
+
+    @inlineCallbacks
+    def test_fill_queue_no_close(self):
+        q = PausingDeferredQueue(backlog=1, size=10)
+        yield _fill_queue(q, self.get_page, self.get_dict, close_queue=False)
+        self.assertEqual([item[u"key"] for item in q.pending],
+                         ["a", "b", "c"])
+
+    def test_cancel_abandons_in_flight_fetch(self):
+        q = PausingDeferredQueue(backlog=1, size=10)
+        fill_d = _fill_queue(q, self.get_page, self.get_dict_pending)
+        self.assertEqual(self.dict_requests.keys(), ["a"])
+        fetch_d = self.dict_requests["a"]
+
+        fill_d.cancel()
+        self.failureResultOf(fill_d, CancelledError)
+        # The in-flight fetch was cancelled and its result is ignored.
+        self.assertTrue(fetch_d.called)
+        self.assertEqual(self.dict_requests.keys(), ["a"])
+        self.assertEqual(q.pending, [])
+
+    def test_cancel_abandons_prefetched_page(self):
+        q = PausingDeferredQueue(backlog=1, size=10)
+        next_page = Deferred()
+
+        def get_page(cursor):
+            self.page_requests.append(cursor)
+            if cursor is None:
+                return succeed(("page-2", ["a"]))
+            return next_page
+
+        fill_d = _fill_queue(q, get_page, self.get_dict_pending)
+        self.assertEqual(self.page_requests, [None, "page-2"])
+        fill_d.cancel()
+        self.failureResultOf(fill_d, CancelledError)
+        self.assertTrue(next_page.called)
+        self.assertTrue(self.dict_requests["a"].called)
+
+    def test_cancel_while_queue_full(self):
+        q = PausingDeferredQueue(backlog=1, size=1)
+        fill_d = _fill_queue(q, self.get_page, self.get_dict)
+        # The queue is full, so the fill is waiting for space.
+        self.assertEqual(q.pending, [{u"key": "a"}])
+        self.assertFalse(fill_d.called)
+
+        fill_d.cancel()
+        self.failureResultOf(fill_d, CancelledError)
+        # Reading from the queue doesn't restart the fill.
+        self.assertEqual(self.successResultOf(q.get()), {u"key": "a"})
+        self.assertEqual(q.pending, [])
+        self.assertEqual(self.page_requests, [None, "page-2"])
+
+    def test_cancel_chained_fill(self):
+        q = PausingDeferredQueue(backlog=1, size=10)
+        second_fills = []
+
+        def second_fill(_):
+            second_fills.append(True)
+            return _fill_queue(q, self.get_page, self.get_dict_pending)
+
+        q.fill_d = _fill_queue(q, self.get_page, self.get_dict)
+        q.fill_d.addCallback(second_fill)
+        self.assertEqual(second_fills, [True])
+        fetch_d = self.dict_requests["a"]
+
+        q.fill_d.cancel()
+        self.failureResultOf(q.fill_d, CancelledError)
+        self.assertTrue(fetch_d.called)
+
+    def test_cancel_before_chained_fill(self):
+        q = PausingDeferredQueue(backlog=1, size=10)
+        second_fills = []
+
+        def second_fill(_):
+            second_fills.append(True)
+            return _fill_queue(q, self.get_page, self.get_dict)
+
+        q.fill_d = _fill_queue(q, self.get_page, self.get_dict_pending)
+        q.fill_d.addCallback(second_fill)
+        q.fill_d.cancel()
+        self.failureResultOf(q.fill_d, CancelledError)
+        self.assertEqual(second_fills, [])
@@ -0,0 +1,84 @@
+"""
+Tests for go_contacts.backends.wrapper.
+"""
+
+from twisted.internet.defer import inlineCallbacks, maybeDeferred
+
+from vumi.tests.helpers import VumiTestCase
+
+from go.vumitools.contact import ContactStore
+
+from go_contacts.backends.wrapper import RiakManagerWrapper
+from go_contacts.tests.helpers import ContactsPersistenceHelper
+
+
+class RecordingManagerWrapper(RiakManagerWrapper):
+    def __init__(self, manager, calls):
+        super(RecordingManagerWrapper, self).__init__(manager)
+        self.calls = calls
+
+    def wrap_call(self, name, func, *args, **kw):
+        self.calls.append(name)
+        return maybeDeferred(func, *args, **kw)
+
+
+class TestRiakManagerWrapper(VumiTestCase):
+    def setUp(self):
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
+
+    @inlineCallbacks
+    def mk_store(self, owner_id="owner-1"):
+        manager = yield self.persistence_helper.get_riak_manager()
+        self.calls = []
+        self.wrapper = RecordingManagerWrapper(manager, self.calls)
+        self.store = ContactStore(self.wrapper, owner_id)
+        self.unwrapped_store = ContactStore(manager, owner_id)
+
+    @inlineCallbacks
+    def test_sub_manager_is_wrapped(self):
+        yield self.mk_store()
+        self.assertTrue(isinstance(self.store.manager, RiakManagerWrapper))
+        self.assertEqual(self.store.manager.calls, self.calls)
+        self.assertEqual(
+            self.store.manager.bucket_prefix,
+            self.unwrapped_store.manager.bucket_prefix)
+
+    @inlineCallbacks
+    def test_new_contact(self):
+        yield self.mk_store()
+        contact = yield self.store.new_contact(msisdn=u"+12345")
+        self.assertEqual(self.calls, ["store"])
+        loaded = yield self.unwrapped_store.get_contact_by_key(contact.key)
+        self.assertEqual(loaded.msisdn, u"+12345")
+
+    @inlineCallbacks
+    def test_loaded_objects_are_wrapped(self):
+        yield self.mk_store()
+        contact = yield self.unwrapped_store.new_contact(msisdn=u"+12345")
+        loaded = yield self.store.get_contact_by_key(contact.key)
+        self.assertEqual(self.calls, ["load"])
+        self.assertTrue(loaded.manager is self.store.manager)
+        loaded.name = u"Foo"
+        yield loaded.save()
+        yield loaded.delete()
+        self.assertEqual(self.calls, ["load", "store", "delete"])
+
+    @inlineCallbacks
+    def test_index_keys_page(self):
+        yield self.mk_store()
+        contact = yield self.unwrapped_store.new_contact(msisdn=u"+12345")
+        keys = yield self.store.contacts.index_keys_page(
+            'user_account', "owner-1", max_results=10)
+        self.assertEqual(list(keys), [contact.key])
+        self.assertEqual(self.calls, ["index_keys_page"])
+
+    @inlineCallbacks
+    def test_load_all_bunches(self):
+        yield self.mk_store()
+        contact = yield self.unwrapped_store.new_contact(msisdn=u"+12345")
+        [bunch] = list(
+            self.store.contacts.load_all_bunches([contact.key]))
+        [loaded] = yield bunch
+        self.assertEqual(loaded.key, contact.key)
+        self.assertTrue(loaded.manager is self.store.manager)
+        self.assertEqual(self.calls, ["load_bunch"])
@@ -0,0 +1,29 @@
+"""
+Tracing of the Riak calls made while handling requests.
+"""
+
+from .wrapper import RiakManagerWrapper
+
+
+class TracingRiakManager(RiakManagerWrapper):
+    """
+    A Riak manager wrapper that records every Riak call as a span.
+
+    Each call's span is a child of the trace's current span, i.e. the span
+    of the collection method that made the call.
+
+    :param manager:
+        The Riak manager to wrap.
+    :param go_contacts.tracing.Trace trace:
+        The trace to record spans in.
+    """
+
+    def __init__(self, manager, trace):
+        super(TracingRiakManager, self).__init__(manager)
+        self.trace = trace
+
+    def wrap_call(self, name, func, *args, **kw):
+        span = self.trace.current.child('riak.%s' % (name,))
+        d = super(TracingRiakManager, self).wrap_call(
+            name, func, *args, **kw)
+        return d.addBoth(span.finish_with)
@@ -1,7 +1,9 @@
 from vumi.persist.model import VumiRiakError
 from go_api.collections.errors import CollectionUsageError
 from go_api.queue import PausingQueueCloseMarker
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, CancelledError)
+from twisted.python.failure import Failure
 
 
 @inlineCallbacks
@@ -20,25 +22,101 @@ def _get_page_of_keys(
     returnValue((cursor, contact_keys))
 
 
-@inlineCallbacks
-def _fill_queue(q, get_page, get_dict, close_queue=True):
-    keys_deferred = get_page(None)
+def _ignore_cancelled(failure):
+    failure.trap(CancelledError)
+
+
+class _QueueFiller(object):
+    """
+    Fills a queue with objects, fetching the next page of keys while the
+    objects for the current page are fetched.
+
+    The deferred returned by :meth:`start` may be cancelled (e.g. when the
+    client of a stream disconnects) to stop the fill. Any in-flight fetches
+    are abandoned and no further pages are requested.
+
+    ``finished`` is set once the fill has stopped, whether it completed,
+    failed or was cancelled.
+    """
+
+    def __init__(self, q, get_page, get_dict, close_queue):
+        self.q = q
+        self.get_page = get_page
+        self.get_dict = get_dict
+        self.close_queue = close_queue
+        self.cancelled = False
+        self.finished = False
+        self._in_flight = set()
+
+    def start(self):
+        d = Deferred(canceller=self._cancel)
+        self._fill().addBoth(self._finished, d)
+        return d
+
+    def _finished(self, result, d):
+        self.finished = True
+        # If we were cancelled, ``d`` has already been errbacked with
+        # CancelledError and anything that happens afterwards is ignored.
+        if not self.cancelled:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
 
-    while True:
-        cursor, keys = yield keys_deferred
-        if cursor is not None:
-            # Get the next page of keys while we fetch the objects
-            keys_deferred = get_page(cursor)
+    def _cancel(self, d):
+        self.cancelled = True
+        for in_flight_d in list(self._in_flight):
+            # The fill loop sees the cancellation flag instead of the error.
+            in_flight_d.addErrback(_ignore_cancelled)
+            in_flight_d.cancel()
 
-        for key in keys:
-            obj = yield get_dict(key)
-            yield q.put(obj)
+    def _track(self, d):
+        self._in_flight.add(d)
 
-        if cursor is None:
-            break
+        def untrack(result):
+            self._in_flight.discard(d)
+            return result
+        d.addBoth(untrack)
+        return d
+
+    @inlineCallbacks
+    def _fill(self):
+        keys_deferred = self._track(self.get_page(None))
+
+        while not self.cancelled:
+            page = yield keys_deferred
+            if self.cancelled:
+                break
+            cursor, keys = page
+            if cursor is not None:
+                # Get the next page of keys while we fetch the objects
+                keys_deferred = self._track(self.get_page(cursor))
+
+            for key in keys:
+                obj = yield self._track(self.get_dict(key))
+                if self.cancelled:
+                    break
+                yield self._track(self.q.put(obj))
+                if self.cancelled:
+                    break
+
+            if cursor is None:
+                break
+
+        if self.close_queue and not self.cancelled:
+            self.q.put(PausingQueueCloseMarker())
+
+
+def _fill_queue(q, get_page, get_dict, close_queue=True):
+    """
+    Fill ``q`` with the objects returned by ``get_dict`` for each key in the
+    pages returned by ``get_page``.
 
-    if close_queue:
-        q.put(PausingQueueCloseMarker())
+    :returns:
+        A deferred that fires once the queue has been filled. Cancelling it
+        stops the fill and abandons any in-flight fetches.
+    """
+    return _QueueFiller(q, get_page, get_dict, close_queue).start()
 
 
 @inlineCallbacks
@@ -0,0 +1,144 @@
+"""
+Base class for Riak managers that wrap another Riak manager.
+"""
+
+from twisted.internet.defer import maybeDeferred
+
+from vumi.persist.model import ModelProxy, VumiMapReduce
+
+
+class RiakManagerWrapper(object):
+    """
+    Wraps a :class:`vumi.persist.txriak_manager.TxRiakManager` so that every
+    call that touches Riak goes through :meth:`wrap_call`.
+
+    Model proxies, sub-managers and model objects loaded through the wrapper
+    refer back to the wrapper rather than the wrapped manager, so the calls
+    made by a :class:`go.vumitools.contact.ContactStore` built on the wrapper
+    (and by the contacts and groups it returns) are all wrapped. Everything
+    else is passed straight through to the wrapped manager.
+
+    :param manager:
+        The Riak manager to wrap.
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._manager, name)
+
+    def wrap_call(self, name, func, *args, **kw):
+        """
+        Call ``func``, a method of the wrapped manager that touches Riak.
+        Subclasses override this to add behaviour around Riak calls.
+
+        :param str name:
+            The name of the operation, e.g. ``load`` or ``index_keys_page``.
+
+        :returns:
+            A deferred that fires with the result of ``func``.
+        """
+        return maybeDeferred(func, *args, **kw)
+
+    def wrap_manager(self, manager):
+        """
+        Return a wrapper like this one around a different manager.
+        """
+        wrapper = object.__new__(type(self))
+        wrapper.__dict__.update(self.__dict__)
+        wrapper._manager = manager
+        return wrapper
+
+    def _adopt(self, modelobj):
+        if modelobj is not None:
+            modelobj.manager = self
+        return modelobj
+
+    def _adopt_all(self, modelobjs):
+        return [self._adopt(modelobj) for modelobj in modelobjs]
+
+    def proxy(self, modelcls):
+        return ModelProxy(self, modelcls)
+
+    def sub_manager(self, sub_prefix):
+        return self.wrap_manager(self._manager.sub_manager(sub_prefix))
+
+    # Methods that touch the network.
+
+    def load(self, modelcls, key, result=None):
+        if result is not None:
+            # We already have the data, so there's no Riak call to wrap.
+            d = self._manager.load(modelcls, key, result)
+        else:
+            d = self.wrap_call('load', self._manager.load, modelcls, key)
+        return d.addCallback(self._adopt)
+
+    def load_all_bunches(self, modelcls, keys):
+        bunch_size = self._manager.load_bunch_size
+        while keys:
+            batch_keys = keys[:bunch_size]
+            keys = keys[bunch_size:]
+            yield self._load_bunch(modelcls, batch_keys)
+
+    def _load_bunch(self, modelcls, keys):
+        d = self.wrap_call(
+            'load_bunch', self._manager._load_bunch, modelcls, keys)
+        return d.addCallback(self._adopt_all)
+
+    def store(self, modelobj):
+        return self.wrap_call('store', self._manager.store, modelobj)
+
+    def delete(self, modelobj):
+        return self.wrap_call('delete', self._manager.delete, modelobj)
+
+    def index_keys(self, *args, **kw):
+        return self.wrap_call(
+            'index_keys', self._manager.index_keys, *args, **kw)
+
+    def index_keys_page(self, *args, **kw):
+        return self.wrap_call(
+            'index_keys_page', self._manager.index_keys_page, *args, **kw)
+
+    def real_search(self, *args, **kw):
+        return self.wrap_call(
+            'real_search', self._manager.real_search, *args, **kw)
+
+    def run_map_reduce(self, mapreduce, mapper_func=None, reducer_func=None):
+        # The wrapped manager passes itself to these functions, but anything
+        # they load should belong to us.
+        if mapper_func is not None:
+            mapper = mapper_func
+
+            def mapper_func(mgr, obj):
+                return mapper(self, obj)
+        if reducer_func is not None:
+            reducer = reducer_func
+
+            def reducer_func(mgr, results):
+                return reducer(self, results)
+        return self.wrap_call(
+            'run_map_reduce', self._manager.run_map_reduce, mapreduce,
+            mapper_func, reducer_func)
+
+    # Map reduce constructors, so that the map reduce runs through us.
+
+    def mr_from_field(self, *args, **kw):
+        return VumiMapReduce.from_field(self, *args, **kw)
+
+    def mr_from_index(self, *args, **kw):
+        return VumiMapReduce.from_index(self, *args, **kw)
+
+    def mr_from_search(self, *args, **kw):
+        return VumiMapReduce.from_search(self, *args, **kw)
+
+    def mr_from_index_match(self, *args, **kw):
+        return VumiMapReduce.from_index_match(self, *args, **kw)
+
+    def mr_from_field_match(self, *args, **kw):
+        return VumiMapReduce.from_field_match(self, *args, **kw)
+
+    def mr_from_keys(self, *args, **kw):
+        return VumiMapReduce.from_keys(self, *args, **kw)
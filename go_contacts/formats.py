@@ -0,0 +1,196 @@
+"""
+Request and response body formats for the contacts API.
+
+JSON is always available. msgpack is available if the optional ``msgpack``
+package is installed and is negotiated using the ``Accept`` and
+``Content-Type`` request headers.
+
+The JSON encoder used for responses is chosen when the application starts (see
+:func:`get_json_encoder`). Decoding request bodies always uses the stdlib.
+"""
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _stdlib_json_encoder():
+    return json.dumps
+
+
+def _simplejson_encoder():
+    import simplejson
+    return simplejson.dumps
+
+
+def _ujson_encoder():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return dumps
+
+
+JSON_ENCODERS = {
+    'json': _stdlib_json_encoder,
+    'simplejson': _simplejson_encoder,
+    'ujson': _ujson_encoder,
+}
+
+# Encoders to try, fastest first, when the ``auto`` encoder is requested. The
+# stdlib encoder already has C speedups, so simplejson is only used if it is
+# asked for explicitly.
+AUTO_JSON_ENCODERS = ('ujson', 'json')
+
+
+def get_json_encoder(name):
+    """
+    Return a ``dumps`` function for the named JSON encoder.
+
+    :param str name:
+        One of ``json`` (the stdlib encoder), ``simplejson``, ``ujson`` or
+        ``auto``, which picks the fastest installed encoder.
+
+    Raises :class:`ValueError` if the encoder is unknown or not installed.
+    """
+    if name == 'auto':
+        for encoder_name in AUTO_JSON_ENCODERS:
+            try:
+                return JSON_ENCODERS[encoder_name]()
+            except ImportError:
+                continue
+    if name not in JSON_ENCODERS:
+        raise ValueError("Unknown JSON encoder %r, must be one of: %s" % (
+            name, ", ".join(sorted(JSON_ENCODERS.keys() + ['auto']))))
+    try:
+        return JSON_ENCODERS[name]()
+    except ImportError:
+        raise ValueError("JSON encoder %r is not installed" % (name,))
+
+
+class JsonFormat(object):
+    """
+    Newline separated JSON, the default format.
+
+    :param dumps:
+        The function used to encode objects. Defaults to :func:`json.dumps`.
+    """
+
+    name = 'json'
+    content_type = 'application/json'
+    header = 'application/json; charset=utf-8'
+
+    def __init__(self, dumps=None):
+        self.dumps = dumps if dumps is not None else json.dumps
+
+    def encode(self, obj):
+        return self.dumps(obj)
+
+    def encode_stream_item(self, obj):
+        return self.encode(obj) + "\n"
+
+    def decode(self, data):
+        """
+        Decode a request body. Raises :class:`ValueError` if the body is not
+        valid.
+        """
+        return json.loads(data)
+
+
+class MsgpackFormat(object):
+    """
+    msgpack, a compact binary format. msgpack values are self-delimiting, so
+    streamed objects are simply concatenated.
+    """
+
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+    header = 'application/x-msgpack'
+    aliases = ('application/msgpack',)
+
+    def encode(self, obj):
+        # Contact keys and other identifiers are often byte strings, so we
+        # pack all strings as msgpack strings rather than binary.
+        return msgpack.packb(obj, use_bin_type=False)
+
+    def encode_stream_item(self, obj):
+        return self.encode(obj)
+
+    def decode(self, data):
+        """
+        Decode a request body. Raises :class:`ValueError` if the body is not
+        valid.
+        """
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except ValueError:
+            raise
+        except Exception as e:
+            # Different msgpack versions raise different exceptions for
+            # malformed data.
+            raise ValueError(str(e))
+
+
+def default_formats(json_dumps=None):
+    """
+    Return the formats available in this environment. The first format is the
+    default.
+
+    :param json_dumps:
+        The function used to encode JSON. Defaults to :func:`json.dumps`.
+    """
+    formats = [JsonFormat(json_dumps)]
+    if msgpack is not None:
+        formats.append(MsgpackFormat())
+    return formats
+
+
+def _media_type(value):
+    return value.split(';', 1)[0].strip().lower()
+
+
+def format_for_content_type(formats, content_type):
+    """
+    Return the format for a request ``Content-Type`` or ``None`` if the
+    content type is not supported. A missing content type is treated as the
+    default format.
+    """
+    if not content_type:
+        return formats[0]
+    media_type = _media_type(content_type)
+    for fmt in formats:
+        if media_type == fmt.content_type:
+            return fmt
+        if media_type in getattr(fmt, 'aliases', ()):
+            return fmt
+    return None
+
+
+def negotiate_format(formats, accept):
+    """
+    Return the most preferred format listed in an ``Accept`` header, falling
+    back to the default format if none of the listed types is supported.
+    """
+    if not accept:
+        return formats[0]
+    candidates = []
+    for position, item in enumerate(accept.split(',')):
+        params = item.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, position, _media_type(params[0])))
+    for _, _, media_type in sorted(candidates):
+        fmt = format_for_content_type(formats, media_type)
+        if fmt is not None:
+            return fmt
+    return formats[0]
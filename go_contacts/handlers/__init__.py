@@ -1,3 +1,7 @@
+from collection import CollectionHandler, ElementHandler
 from contacts_for_group import ContactsForGroupHandler
+from metrics import MetricsHandler
 
-__all__ = [ContactsForGroupHandler]
+__all__ = [
+    CollectionHandler, ElementHandler, ContactsForGroupHandler,
+    MetricsHandler]
@@ -0,0 +1,418 @@
+"""
+Shared behaviour for the contacts API handlers.
+"""
+
+import json
+
+from cyclone.web import HTTPError
+
+from twisted.internet.defer import inlineCallbacks, CancelledError
+from twisted.python import log
+
+from go_api.queue import PausingQueueCloseMarker
+
+from go_contacts.formats import (
+    default_formats, format_for_content_type, negotiate_format)
+from go_contacts.limits import StreamLimitExceeded
+
+
+class ContactsHandlerMixin(object):
+    """
+    Mixin for :class:`go_api.cyclone.handlers.BaseHandler` subclasses that
+    negotiates the request and response body formats.
+
+    The available formats are taken from the application's ``formats``
+    attribute if it has one.
+
+    If the client disconnects while a stream is being written, the queue's
+    ``fill_d`` is cancelled so that the collection stops fetching objects
+    that nobody will read.
+
+    Handlers that set ``supports_streaming`` take a slot from the
+    application's ``stream_limiter`` (if it has one) before starting a
+    stream, and respond with ``429 Too Many Requests`` if none is available.
+    The owner is taken from the handler's ``owner_id`` attribute. Requests
+    whose client disconnects while waiting for a slot are recorded with a
+    ``499`` status.
+
+    If the model factory stored a
+    :class:`go_contacts.backends.instrumentation.RiakOperationStats` on the
+    handler as ``riak_stats``, the Riak operations made for the request are
+    added to the application's ``riak_stats`` aggregator when the request
+    finishes, and are written out as ``X-Riak-*`` response headers if the
+    application's ``riak_stats_headers`` is set.
+
+    Finished requests and the streams being written are recorded in the
+    application's ``metrics`` (a
+    :class:`go_contacts.metrics.ContactsApiMetrics`) if it has one.
+
+    Requests that take longer than the application's
+    ``slow_request_threshold`` (if it has one) are logged along with the Riak
+    operations they made.
+
+    Requests with an ``X-Profile-Token`` header are profiled by the
+    application's ``profiler`` (a
+    :class:`go_contacts.profiling.RequestProfiler`) if it has one and the
+    token is valid. The name of the profile is returned in the ``X-Profile``
+    response header.
+
+    Requests are traced by the application's ``tracer`` (a
+    :class:`go_contacts.tracing.Tracer`) if it has one. The trace id is taken
+    from the ``X-Trace-Id`` request header (and the parent span id from
+    ``X-Parent-Span-Id``) if given, and returned in the ``X-Trace-Id``
+    response header. The root span is stored as ``trace_span``.
+    """
+
+    supports_streaming = False
+
+    # The backend methods called for requests other than GETs.
+    backend_methods = {
+        'POST': 'create',
+        'PUT': 'update',
+        'DELETE': 'delete',
+    }
+
+    _stream_queue = None
+    _stream_get = None
+    _stream_cancelled = False
+    _stream_slot = None
+
+    owner_id = None
+    route_name = None
+    riak_stats = None
+    _profile = None
+    trace_span = None
+
+    @inlineCallbacks
+    def prepare(self):
+        self.start_profile()
+        self.start_trace()
+        yield super(ContactsHandlerMixin, self).prepare()
+        limiter = getattr(self.application, 'stream_limiter', None)
+        if limiter is not None and self.is_stream_request():
+            yield self.acquire_stream_slot(limiter)
+
+    def is_stream_request(self):
+        return (
+            self.supports_streaming and self.request.method == 'GET' and
+            self.get_argument('stream', default='false') == 'true')
+
+    def is_bulk_request(self, bulk_page_size):
+        """
+        Return ``True`` if this request reads a large number of objects, i.e.
+        it is a stream or a page of more than ``bulk_page_size`` objects.
+        Pages requested without ``max_results`` are as large as the
+        collection allows, so they are always bulk requests.
+        """
+        if not self.supports_streaming or self.request.method != 'GET':
+            return False
+        if self.is_stream_request():
+            return True
+        if self.get_argument('query', default=None) is not None:
+            # Queries look up a single contact by address.
+            return False
+        max_results = self.get_argument('max_results', default=None)
+        if max_results is None:
+            return True
+        try:
+            return int(max_results) > bulk_page_size
+        except ValueError:
+            return False
+
+    @inlineCallbacks
+    def acquire_stream_slot(self, limiter):
+        d = limiter.acquire(self.owner_id)
+        # ``on_connection_close`` is only hooked up once ``prepare`` has
+        # finished, so we need to notice the client going away ourselves.
+        self.notifyFinish().addBoth(self._cancel_slot_wait, d)
+        try:
+            self._stream_slot = yield d
+        except StreamLimitExceeded as e:
+            self.reject_stream(e)
+        except CancelledError:
+            # There's nobody left to respond to, but finishing stops the
+            # request from being handled. The stream is cancelled before it
+            # started, so no response is finished, and the status is only
+            # recorded so that abandoned streams aren't counted as served.
+            self._stream_cancelled = True
+            self.set_status(499, reason="Client Closed Request")
+            self.finish()
+
+    def _cancel_slot_wait(self, result, d):
+        if not d.called:
+            d.cancel()
+        return result
+
+    def reject_stream(self, err):
+        """
+        Respond with ``429 Too Many Requests`` and a ``Retry-After`` header.
+
+        :param StreamLimitExceeded err:
+            The reason the stream was rejected.
+        """
+        self.set_status(429, reason="Too Many Requests")
+        self.set_header('Retry-After', str(err.retry_after))
+        self.write_error(429, exception=err)
+
+    def release_stream_slot(self):
+        if self._stream_slot is not None:
+            self._stream_slot.release()
+
+    def start_profile(self):
+        profiler = getattr(self.application, 'profiler', None)
+        token = self.request.headers.get('X-Profile-Token')
+        if profiler is None or token is None:
+            return
+        self._profile = profiler.start(
+            token, "%s %s" % (self.request.method, self.request.path))
+
+    def start_trace(self):
+        tracer = getattr(self.application, 'tracer', None)
+        if tracer is None:
+            return
+        self.trace_span = tracer.start_trace(
+            "%s %s" % (self.request.method, self.request.path),
+            trace_id=self.request.headers.get('X-Trace-Id'),
+            parent_id=self.request.headers.get('X-Parent-Span-Id'))
+
+    def finish_trace(self):
+        if self.trace_span is not None:
+            self.trace_span.finish(
+                route=self.route_name, owner_id=self.owner_id,
+                status=self.get_status())
+
+    def stop_profile(self):
+        if self._profile is not None:
+            self._profile.stop()
+
+    def finish(self, *args, **kw):
+        if self._stream_cancelled:
+            # The client disconnected, so there's no response to finish.
+            # This may be called while cyclone is still handling the closed
+            # connection, and finishing the request then would fire its
+            # finish callback a second time. The request is still recorded.
+            self._finished = True
+            self.on_finish()
+            return
+        if not self._headers_written:
+            if (self.riak_stats is not None and
+                    getattr(self.application, 'riak_stats_headers', False)):
+                self.set_riak_stats_headers()
+            if self._profile is not None:
+                self.set_header('X-Profile', self._profile.name)
+            if self.trace_span is not None:
+                self.set_header('X-Trace-Id', self.trace_span.trace.trace_id)
+        return super(ContactsHandlerMixin, self).finish(*args, **kw)
+
+    def set_riak_stats_headers(self):
+        counts = self.riak_stats.counts
+        self.set_header('X-Riak-Gets', str(counts['gets']))
+        self.set_header('X-Riak-Index-Queries', str(counts['index_queries']))
+        self.set_header('X-Riak-Searches', str(counts['searches']))
+        self.set_header('X-Riak-Writes', str(counts['writes']))
+        self.set_header('X-Riak-Time', '%.6f' % (self.riak_stats.time,))
+
+    def record_riak_stats(self):
+        aggregator = getattr(self.application, 'riak_stats', None)
+        if aggregator is not None and self.riak_stats is not None:
+            aggregator.record(self.route_name, self.owner_id, self.riak_stats)
+
+    def get_backend_method(self):
+        """
+        Return the name of the backend method the request calls.
+        """
+        method = self.request.method
+        if method == 'GET':
+            if not self.supports_streaming:
+                return 'get'
+            if self.is_stream_request():
+                return 'stream'
+            return 'page'
+        return self.backend_methods.get(method, method.lower())
+
+    def get_metrics(self):
+        return getattr(self.application, 'metrics', None)
+
+    def record_metrics(self):
+        metrics = self.get_metrics()
+        if metrics is not None and self.route_name is not None:
+            metrics.record_request(
+                self.route_name, self.get_backend_method(), self.get_status(),
+                self.request.request_time())
+
+    def get_slow_request_record(self):
+        """
+        Return a dict describing a slow request, for logging.
+        """
+        record = {
+            'route': self.route_name,
+            'owner_id': self.owner_id,
+            'method': self.get_backend_method(),
+            'status': self.get_status(),
+            'duration': self.request.request_time(),
+            'cursor': self.get_argument('cursor', default=None),
+            'max_results': self.get_argument('max_results', default=None),
+        }
+        stats = self.riak_stats
+        if stats is not None:
+            record.update({
+                'riak': stats.as_dict(),
+                'objects': stats.objects,
+                'key_pages': stats.key_pages,
+                'key_page_times': [
+                    {'operation': name, 'time': duration}
+                    for name, duration in stats.key_page_times],
+            })
+        return record
+
+    def log_slow_request(self):
+        threshold = getattr(self.application, 'slow_request_threshold', None)
+        if threshold is None or self.request.request_time() < threshold:
+            return
+        record = self.get_slow_request_record()
+        log.msg(
+            "Slow request: %s" % (json.dumps(record, sort_keys=True),),
+            slow_request=record)
+
+    def on_finish(self):
+        self.stop_profile()
+        super(ContactsHandlerMixin, self).on_finish()
+        self.release_stream_slot()
+        self.record_riak_stats()
+        self.record_metrics()
+        self.log_slow_request()
+        self.finish_trace()
+
+    def get_formats(self):
+        formats = getattr(self.application, 'formats', None)
+        if not formats:
+            formats = default_formats()
+        return formats
+
+    @property
+    def response_format(self):
+        if getattr(self, '_response_format', None) is None:
+            self._response_format = negotiate_format(
+                self.get_formats(), self.request.headers.get('Accept'))
+        return self._response_format
+
+    def set_format_header(self):
+        self.set_header('Content-Type', self.response_format.header)
+
+    def write_object(self, obj):
+        """
+        Write a serializable object out in the negotiated format.
+
+        :param dict obj:
+            Serializable object to write out.
+        """
+        self.set_format_header()
+        self.write(self.response_format.encode(obj))
+
+    @inlineCallbacks
+    def write_objects(self, objs):
+        """
+        Write out a list of serializable objects as a stream in the negotiated
+        format.
+
+        :param list objs:
+            List of dictionaries to write out.
+        """
+        self.set_format_header()
+        for obj_deferred in objs:
+            obj = yield obj_deferred
+            if obj is None:
+                continue
+            self.write(self.response_format.encode_stream_item(obj))
+
+    def write_page(self, result):
+        """
+        Write out a list of serializable objects into one page with a pointer
+        to the next page.
+
+        :param unicode result[0]:
+            Pointer to set to get the next page
+        :param list result[1]:
+            List of dictionaries to write out.
+        """
+        cursor, data = result
+        page = {
+            'cursor': cursor,
+            'data': data,
+        }
+        self.set_format_header()
+        self.write(self.response_format.encode(page))
+
+    @inlineCallbacks
+    def write_queue(self, q):
+        self._stream_queue = q
+        self.set_format_header()
+        metrics = self.get_metrics()
+        if metrics is not None:
+            metrics.stream_started(q)
+        try:
+            yield self._write_queue_items(q)
+        finally:
+            if metrics is not None:
+                metrics.stream_finished(q)
+
+    @inlineCallbacks
+    def _write_queue_items(self, q):
+        while not self._stream_cancelled:
+            self._stream_get = q.get()
+            try:
+                obj = yield self._stream_get
+            except CancelledError:
+                if self._stream_cancelled:
+                    break
+                raise
+            if obj is None:
+                continue
+            if isinstance(obj, PausingQueueCloseMarker):
+                break
+            self.write(self.response_format.encode_stream_item(obj))
+
+    def on_connection_close(self, *args, **kw):
+        super(ContactsHandlerMixin, self).on_connection_close(*args, **kw)
+        self.cancel_stream()
+        self.release_stream_slot()
+        self.stop_profile()
+        self.finish_trace()
+
+    def cancel_stream(self):
+        """
+        Stop writing the current stream and stop the collection filling its
+        queue. Does nothing if the stream has already been written.
+        """
+        q = self._stream_queue
+        if q is None or self._stream_cancelled:
+            return
+        self._stream_cancelled = True
+        fill_d = getattr(q, 'fill_d', None)
+        if fill_d is not None:
+            # This does nothing if the fill has finished, but we can't check
+            # ``fill_d.called`` because it may be waiting on a chained fill.
+            fill_d.addErrback(lambda f: f.trap(CancelledError))
+            fill_d.cancel()
+        if self._stream_get is not None and not self._stream_get.called:
+            self._stream_get.cancel()
+
+    def parse_json(self, data):
+        """
+        Decode a request body in the format given by its ``Content-Type``.
+        Bodies with an unrecognised content type are treated as JSON, as they
+        always have been.
+
+        The name is kept for compatibility with the base handlers, which call
+        it for every request body.
+        """
+        formats = self.get_formats()
+        fmt = format_for_content_type(
+            formats, self.request.headers.get('Content-Type'))
+        if fmt is None:
+            fmt = formats[0]
+        try:
+            return fmt.decode(data)
+        except ValueError as e:
+            raise HTTPError(400, reason="Invalid %s: %s" % (
+                fmt.name.upper(), e))
@@ -0,0 +1,32 @@
+"""
+Collection and element handlers for the contacts API.
+"""
+
+from go_api.cyclone import handlers
+
+from .base import ContactsHandlerMixin
+
+
+class CollectionHandler(ContactsHandlerMixin, handlers.CollectionHandler):
+    """
+    Handler for operations on a collection as a whole.
+
+    Methods supported:
+
+    * ``GET /`` - return a list of items in the collection.
+    * ``POST /`` - add an item to the collection.
+    """
+
+    supports_streaming = True
+
+
+class ElementHandler(ContactsHandlerMixin, handlers.ElementHandler):
+    """
+    Handler for operations on an element within a collection.
+
+    Methods supported:
+
+    * ``GET /:elem_id`` - retrieve an element.
+    * ``PUT /:elem_id`` - update an element.
+    * ``DELETE /:elem_id`` - delete an element.
+    """
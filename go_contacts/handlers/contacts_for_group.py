@@ -6,23 +6,31 @@ from go_api.collections.errors import (
 
 from twisted.internet.defer import maybeDeferred
 
+from .base import ContactsHandlerMixin
 
-class ContactsForGroupHandler(BaseHandler):
+
+class ContactsForGroupHandler(ContactsHandlerMixin, BaseHandler):
     """
     Handler for getting all contacts for a group
 
     Methods supported:
 
     * ``GET /:group_id/contacts`` - retrieve all contacts of a group.
+
+    If a smart group's contacts were read from a kept membership, the
+    number of seconds since it was refreshed is returned in the
+    ``X-Smart-Group-Age`` response header.
     """
     route_suffix = ":group_id/contacts"
     model_alias = "collection"
+    supports_streaming = True
 
     def get(self, group_id):
         query = self.get_argument('query', default=None)
         stream = self.get_argument('stream', default='false')
         if stream == 'true':
             d = maybeDeferred(self.collection.stream, group_id, query)
+            d.addCallback(self.set_membership_age_header)
             d.addCallback(self.write_queue)
         else:
             cursor = self.get_argument('cursor', default=None)
@@ -34,6 +42,7 @@ class ContactsForGroupHandler(BaseHandler):
             d = maybeDeferred(
                 self.collection.page, group_id, cursor=cursor,
                 max_results=max_results, query=query)
+            d.addCallback(self.set_membership_age_header)
             d.addCallback(self.write_page)
         d.addErrback(self.catch_err, 404, CollectionObjectNotFound)
         d.addErrback(self.catch_err, 400, CollectionUsageError)
@@ -41,3 +50,9 @@ class ContactsForGroupHandler(BaseHandler):
             self.raise_err, 500,
             "Failed to retrieve contacts for group %r." % group_id)
         return d
+
+    def set_membership_age_header(self, result):
+        age = getattr(self.collection, 'membership_age', None)
+        if age is not None:
+            self.set_header('X-Smart-Group-Age', '%.3f' % (age,))
+        return result
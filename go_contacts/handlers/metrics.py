@@ -0,0 +1,25 @@
+"""
+Handler for exporting the contacts API's metrics.
+"""
+
+from cyclone.web import RequestHandler
+
+from go_contacts.metrics import CONTENT_TYPE
+
+
+class MetricsHandler(RequestHandler):
+    """
+    Handler for the metrics endpoint.
+
+    Methods supported:
+
+    * ``GET /metrics/`` - return the metrics in the Prometheus text format.
+    """
+    suppress_request_log = True
+
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self, *args, **kw):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(self.registry.render())
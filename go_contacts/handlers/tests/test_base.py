@@ -0,0 +1,565 @@
+"""
+Tests for the shared contacts API handler behaviour.
+"""
+
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.protocol import ClientCreator, Protocol
+
+from cyclone.web import Application
+
+from go_api.cyclone.helpers import AppHelper, HandlerHelper
+from go_api.collections.inmemory import InMemoryCollection
+from go_api.queue import PausingDeferredQueue, PausingQueueCloseMarker
+from vumi.tests.helpers import VumiTestCase
+from vumi.tests.utils import LogCatcher
+
+from go_contacts.backends.instrumentation import (
+    RiakOperationStats, RiakStatsAggregator)
+from go_contacts.handlers import CollectionHandler, ElementHandler
+from go_contacts.limits import StreamLimiter
+from go_contacts.metrics import ContactsApiMetrics
+from go_contacts.profiling import RequestProfiler
+from go_contacts.tracing import Tracer, InMemoryExporter, TracedModel
+
+
+class TestContactsHandlerMixin(VumiTestCase):
+    def setUp(self):
+        self.collection = InMemoryCollection()
+        self.handler_helper = HandlerHelper(
+            CollectionHandler,
+            handler_kwargs={'model_factory': lambda req: self.collection})
+
+    def mk_queue(self):
+        q = PausingDeferredQueue(backlog=1, size=2)
+        self.fill_cancelled = []
+        q.fill_d = Deferred(canceller=self.fill_cancelled.append)
+        return q
+
+    def written(self, handler):
+        return "".join(handler._write_buffer)
+
+    @inlineCallbacks
+    def test_write_queue(self):
+        handler = self.handler_helper.mk_handler()
+        q = self.mk_queue()
+        d = handler.write_queue(q)
+        yield q.put({u"a": 1})
+        yield q.put(PausingQueueCloseMarker())
+        q.fill_d.callback(None)
+        yield d
+        self.assertEqual(self.written(handler), '{"a": 1}\n')
+        self.assertEqual(self.fill_cancelled, [])
+
+    @inlineCallbacks
+    def test_connection_close_cancels_stream(self):
+        handler = self.handler_helper.mk_handler()
+        q = self.mk_queue()
+        d = handler.write_queue(q)
+        yield q.put({u"a": 1})
+        self.assertFalse(d.called)
+
+        handler.on_connection_close()
+        self.assertEqual(self.fill_cancelled, [q.fill_d])
+        self.assertTrue(q.fill_d.called)
+        yield d
+        self.assertEqual(self.written(handler), '{"a": 1}\n')
+        self.assertEqual(q.waiting, [])
+
+    @inlineCallbacks
+    def test_finish_after_connection_close(self):
+        handler = self.handler_helper.mk_handler()
+        finished = []
+        handler.request.finish = lambda: finished.append(True)
+        q = self.mk_queue()
+        d = handler.write_queue(q)
+        handler.on_connection_close()
+        yield d
+        handler.finish()
+        self.assertEqual(finished, [])
+        self.assertTrue(handler._finished)
+
+    @inlineCallbacks
+    def test_connection_close_after_stream(self):
+        handler = self.handler_helper.mk_handler()
+        q = self.mk_queue()
+        d = handler.write_queue(q)
+        yield q.put(PausingQueueCloseMarker())
+        q.fill_d.callback(None)
+        yield d
+        handler.on_connection_close()
+        self.assertEqual(self.fill_cancelled, [])
+
+    def mk_get_handler(self, handler_cls=CollectionHandler, **args):
+        handler = HandlerHelper(
+            handler_cls,
+            handler_kwargs={'model_factory': lambda req: self.collection},
+        ).mk_handler()
+        handler.request.arguments = dict(
+            (k, [v]) for k, v in args.iteritems())
+        return handler
+
+    def test_is_bulk_request(self):
+        self.assertTrue(
+            self.mk_get_handler(stream='true').is_bulk_request(20))
+        self.assertTrue(self.mk_get_handler().is_bulk_request(20))
+        self.assertTrue(
+            self.mk_get_handler(max_results='21').is_bulk_request(20))
+        self.assertFalse(
+            self.mk_get_handler(max_results='20').is_bulk_request(20))
+        self.assertFalse(
+            self.mk_get_handler(max_results='foo').is_bulk_request(20))
+        self.assertFalse(
+            self.mk_get_handler(query='msisdn=+12345').is_bulk_request(20))
+        self.assertFalse(
+            self.mk_get_handler(ElementHandler).is_bulk_request(20))
+
+    def test_is_bulk_request_not_get(self):
+        handler = self.mk_get_handler()
+        handler.request.method = 'POST'
+        self.assertFalse(handler.is_bulk_request(20))
+
+    def test_connection_close_without_stream(self):
+        handler = self.handler_helper.mk_handler()
+        handler.on_connection_close()
+        self.assertFalse(handler._stream_cancelled)
+
+
+class TestStreamLimits(VumiTestCase):
+    def setUp(self):
+        self.collection = InMemoryCollection()
+        self.app = Application([
+            CollectionHandler.mk_urlspec('/root', self.model_factory),
+            ElementHandler.mk_urlspec('/root', self.model_factory),
+        ])
+        self.app.stream_limiter = StreamLimiter(max_streams_per_owner=1)
+        self.app_helper = AppHelper(app=self.app)
+
+    def model_factory(self, handler):
+        handler.owner_id = handler.request.headers.get('X-Owner-ID')
+        return self.collection
+
+    def get(self, path, owner_id="owner-1"):
+        return self.app_helper.get(path, headers={'X-Owner-ID': owner_id})
+
+    @inlineCallbacks
+    def test_stream_releases_slot(self):
+        yield self.collection.create(u"obj-1", {})
+        resp = yield self.get('/root/?stream=true')
+        content = yield resp.content()
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(json.loads(content)[u"id"], u"obj-1")
+        limiter = self.app.stream_limiter
+        self.assertEqual(limiter.active, 0)
+        self.assertEqual(limiter.admitted, 1)
+
+    @inlineCallbacks
+    def test_stream_over_limit(self):
+        slot = self.successResultOf(
+            self.app.stream_limiter.acquire("owner-1"))
+        resp = yield self.get('/root/?stream=true')
+        content = yield resp.content()
+        self.assertEqual(resp.code, 429)
+        self.assertEqual(resp.headers.getRawHeaders('Retry-After'), ['5'])
+        self.assertEqual(json.loads(content), {
+            u"status_code": 429,
+            u"reason": u"Too many concurrent streams for this owner",
+        })
+        self.assertEqual(self.app.stream_limiter.rejected, 1)
+
+        resp = yield self.get('/root/?stream=true', owner_id="owner-2")
+        yield resp.content()
+        self.assertEqual(resp.code, 200)
+        slot.release()
+
+    @inlineCallbacks
+    def test_pages_not_limited(self):
+        slot = self.successResultOf(
+            self.app.stream_limiter.acquire("owner-1"))
+        resp = yield self.get('/root/')
+        yield resp.content()
+        self.assertEqual(resp.code, 200)
+        resp = yield self.get('/root/obj-1?stream=true')
+        yield resp.content()
+        self.assertEqual(resp.code, 404)
+        self.assertEqual(self.app.stream_limiter.admitted, 1)
+        slot.release()
+
+
+class TestRiakStats(VumiTestCase):
+    def setUp(self):
+        self.collection = InMemoryCollection()
+        self.app = Application([
+            CollectionHandler.mk_urlspec('/root', self.model_factory),
+            ElementHandler.mk_urlspec('/root', self.model_factory),
+        ])
+        self.app.riak_stats = RiakStatsAggregator()
+        self.app_helper = AppHelper(app=self.app)
+
+    def model_factory(self, handler):
+        handler.owner_id = "owner-1"
+        handler.route_name = "/root/:elem_id"
+        handler.riak_stats = RiakOperationStats()
+        handler.riak_stats.record('load', 0.25)
+        handler.riak_stats.record('store', 0.5)
+        return self.collection
+
+    @inlineCallbacks
+    def test_no_headers_by_default(self):
+        resp = yield self.app_helper.get('/root/obj-1')
+        yield resp.content()
+        self.assertEqual(resp.code, 404)
+        self.assertFalse(resp.headers.hasHeader('X-Riak-Gets'))
+
+    @inlineCallbacks
+    def test_headers(self):
+        self.app.riak_stats_headers = True
+        yield self.collection.create(u"obj-1", {})
+        resp = yield self.app_helper.get('/root/obj-1')
+        yield resp.content()
+        self.assertEqual(resp.code, 200)
+        headers = dict(
+            (name, resp.headers.getRawHeaders(name)) for name in [
+                'X-Riak-Gets', 'X-Riak-Index-Queries', 'X-Riak-Searches',
+                'X-Riak-Writes', 'X-Riak-Time'])
+        self.assertEqual(headers, {
+            'X-Riak-Gets': ['1'],
+            'X-Riak-Index-Queries': ['0'],
+            'X-Riak-Searches': ['0'],
+            'X-Riak-Writes': ['1'],
+            'X-Riak-Time': ['0.750000'],
+        })
+
+    @inlineCallbacks
+    def test_aggregated(self):
+        yield self.collection.create(u"obj-1", {})
+        for path in ['/root/obj-1', '/root/obj-2']:
+            resp = yield self.app_helper.get(path)
+            yield resp.content()
+        self.assertEqual(self.app.riak_stats.get_totals(), [{
+            'route': "/root/:elem_id",
+            'owner_id': "owner-1",
+            'requests': 2,
+            'gets': 2,
+            'index_queries': 0,
+            'searches': 0,
+            'writes': 2,
+            'time': 1.5,
+        }])
+
+
+class TestRequestMetrics(VumiTestCase):
+    def setUp(self):
+        self.collection = InMemoryCollection()
+        self.app = Application([
+            CollectionHandler.mk_urlspec('/root', self.model_factory),
+            ElementHandler.mk_urlspec('/root', self.model_factory),
+        ])
+        self.app.metrics = ContactsApiMetrics()
+        self.app_helper = AppHelper(app=self.app)
+
+    def model_factory(self, handler):
+        handler.route_name = "route"
+        return self.collection
+
+    def count(self, method, status):
+        return self.app.metrics.responses.value("route", method, status)
+
+    @inlineCallbacks
+    def test_backend_methods(self):
+        yield self.collection.create(u"obj-1", {})
+        for method, path, body in [
+                ('GET', '/root/', None),
+                ('GET', '/root/?stream=true', None),
+                ('POST', '/root/', '{}'),
+                ('GET', '/root/obj-1', None),
+                ('PUT', '/root/obj-1', '{}'),
+                ('DELETE', '/root/obj-1', None),
+                ('GET', '/root/obj-1', None)]:
+            resp = yield self.app_helper.request(method, path, data=body)
+            yield resp.content()
+        self.assertEqual(self.count('page', '200'), 1)
+        self.assertEqual(self.count('stream', '200'), 1)
+        self.assertEqual(self.count('create', '200'), 1)
+        self.assertEqual(self.count('get', '200'), 1)
+        self.assertEqual(self.count('update', '200'), 1)
+        self.assertEqual(self.count('delete', '200'), 1)
+        self.assertEqual(self.count('get', '404'), 1)
+        self.assertEqual(
+            self.app.metrics.request_duration.count("route", "get"), 2)
+
+    @inlineCallbacks
+    def test_stream_tracked(self):
+        started = []
+        metrics = self.app.metrics
+        self.patch(metrics, 'stream_started', started.append)
+        resp = yield self.app_helper.get('/root/?stream=true')
+        yield resp.content()
+        self.assertEqual(len(started), 1)
+        self.assertEqual(metrics.stream_queue_depth(), 0)
+
+
+class StalledCollection(InMemoryCollection):
+    """
+    A collection whose streams write one object and then wait for more
+    until they are cancelled.
+    """
+
+    def __init__(self):
+        super(StalledCollection, self).__init__()
+        self.streaming = Deferred()
+
+    def stream(self, query):
+        q = PausingDeferredQueue(backlog=1, size=2)
+        q.fill_d = Deferred()
+        q.put({u"id": u"obj-1"})
+        self.streaming.callback(q)
+        return q
+
+
+class RequestClient(Protocol):
+    def __init__(self, request):
+        self.request = request
+
+    def connectionMade(self):
+        self.transport.write(self.request)
+
+
+class TestStreamDisconnect(VumiTestCase):
+    def setUp(self):
+        self.collection = StalledCollection()
+        self.app = Application([
+            CollectionHandler.mk_urlspec('/root', self.model_factory),
+        ])
+        self.app.metrics = ContactsApiMetrics()
+        self.app.riak_stats = RiakStatsAggregator()
+        self.app.metrics.add_riak_stats(self.app.riak_stats)
+        self.app.stream_limiter = StreamLimiter(
+            max_streams_per_owner=1, wait_timeout=60)
+        self.finished = Deferred()
+        server = reactor.listenTCP(0, self.app, interface="127.0.0.1")
+        self.add_cleanup(server.stopListening)
+        self.port = server.getHost().port
+
+    def model_factory(self, handler):
+        handler.owner_id = "owner-1"
+        handler.route_name = "/root/"
+        handler.riak_stats = RiakOperationStats()
+        handler.riak_stats.record('index_keys_page', 0.25)
+        on_finish = handler.on_finish
+
+        def finished():
+            on_finish()
+            self.finished.callback(handler)
+        handler.on_finish = finished
+        return self.collection
+
+    def connect(self):
+        return ClientCreator(
+            reactor, RequestClient,
+            "GET /root/?stream=true HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        ).connectTCP("127.0.0.1", self.port)
+
+    @inlineCallbacks
+    def test_disconnect_mid_stream(self):
+        client = yield self.connect()
+        q = yield self.collection.streaming
+        client.transport.loseConnection()
+        handler = yield self.finished
+
+        self.assertTrue(handler._stream_cancelled)
+        self.assertTrue(q.fill_d.called)
+        self.assertEqual(self.app.stream_limiter.active, 0)
+        self.assertEqual(
+            self.app.metrics.responses.value("/root/", "stream", "200"), 1)
+        self.assertEqual(self.app.riak_stats.get_totals(), [{
+            'route': "/root/",
+            'owner_id': "owner-1",
+            'requests': 1,
+            'gets': 0,
+            'index_queries': 1,
+            'searches': 0,
+            'writes': 0,
+            'time': 0.25,
+        }])
+        lines = self.app.metrics.registry.render().splitlines()
+        self.assertTrue(
+            'contacts_api_riak_operations_total'
+            '{route="/root/",type="index_queries"} 1' in lines)
+
+    @inlineCallbacks
+    def test_disconnect_waiting_for_slot(self):
+        limiter = self.app.stream_limiter
+        slot = self.successResultOf(limiter.acquire("owner-1"))
+        waiting = Deferred()
+        acquire = limiter.acquire
+
+        def acquire_slot(owner_id):
+            d = acquire(owner_id)
+            waiting.callback(None)
+            return d
+        self.patch(limiter, 'acquire', acquire_slot)
+
+        client = yield self.connect()
+        yield waiting
+        client.transport.loseConnection()
+        yield self.finished
+
+        self.assertFalse(self.collection.streaming.called)
+        self.assertEqual(limiter.waiting, 0)
+        responses = self.app.metrics.responses
+        self.assertEqual(responses.value("/root/", "stream", "200"), 0)
+        self.assertEqual(responses.value("/root/", "stream", "499"), 1)
+        slot.release()
+        self.assertEqual(limiter.active, 0)
+
+
+class TestSlowRequestLog(VumiTestCase):
+    def setUp(self):
+        self.collection = InMemoryCollection()
+        self.app = Application([
+            CollectionHandler.mk_urlspec('/root', self.model_factory),
+        ])
+        self.app_helper = AppHelper(app=self.app)
+
+    def model_factory(self, handler):
+        handler.owner_id = "owner-1"
+        handler.route_name = "/root/"
+        handler.riak_stats = RiakOperationStats()
+        handler.riak_stats.record('index_keys_page', 0.25)
+        handler.riak_stats.record('load_bunch', 0.5, objects=3)
+        return self.collection
+
+    @inlineCallbacks
+    def get_logs(self, path):
+        with LogCatcher(message="Slow request") as lc:
+            resp = yield self.app_helper.get(path)
+            yield resp.content()
+        returnValue(lc.logs)
+
+    @inlineCallbacks
+    def test_not_logged_by_default(self):
+        logs = yield self.get_logs('/root/?max_results=5')
+        self.assertEqual(logs, [])
+
+    @inlineCallbacks
+    def test_not_logged_under_threshold(self):
+        self.app.slow_request_threshold = 60
+        logs = yield self.get_logs('/root/?max_results=5')
+        self.assertEqual(logs, [])
+
+    @inlineCallbacks
+    def test_logged(self):
+        self.app.slow_request_threshold = 0
+        logs = yield self.get_logs('/root/?max_results=5&cursor=1')
+        [event] = logs
+        record = event['slow_request']
+        self.assertTrue(record.pop('duration') >= 0)
+        self.assertEqual(record, {
+            'route': "/root/",
+            'owner_id': "owner-1",
+            'method': 'page',
+            'status': 200,
+            'cursor': "1",
+            'max_results': "5",
+            'riak': {
+                'gets': 1,
+                'index_queries': 1,
+                'searches': 0,
+                'writes': 0,
+                'time': 0.75,
+            },
+            'objects': 3,
+            'key_pages': 1,
+            'key_page_times': [
+                {'operation': 'index_keys_page', 'time': 0.25},
+            ],
+        })
+
+
+class TestRequestProfiling(VumiTestCase):
+    def setUp(self):
+        self.collection = InMemoryCollection()
+        self.app = Application([
+            CollectionHandler.mk_urlspec('/root', lambda h: self.collection),
+        ])
+        self.profile_dir = self.mktemp()
+        os.mkdir(self.profile_dir)
+        self.app.profiler = RequestProfiler("secret", self.profile_dir)
+        self.app_helper = AppHelper(app=self.app)
+
+    @inlineCallbacks
+    def test_profiled(self):
+        resp = yield self.app_helper.get(
+            '/root/', headers={'X-Profile-Token': 'secret'})
+        yield resp.content()
+        self.assertEqual(resp.code, 200)
+        [name] = resp.headers.getRawHeaders('X-Profile')
+        self.assertEqual(os.listdir(self.profile_dir), [name])
+        self.assertEqual(self.app.profiler.active, None)
+
+    @inlineCallbacks
+    def test_invalid_token(self):
+        resp = yield self.app_helper.get(
+            '/root/', headers={'X-Profile-Token': 'wrong'})
+        yield resp.content()
+        self.assertEqual(resp.code, 200)
+        self.assertFalse(resp.headers.hasHeader('X-Profile'))
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    @inlineCallbacks
+    def test_no_token(self):
+        resp = yield self.app_helper.get('/root/')
+        yield resp.content()
+        self.assertFalse(resp.headers.hasHeader('X-Profile'))
+        self.assertEqual(self.app.profiler.profiled, 0)
+
+
+class TestRequestTracing(VumiTestCase):
+    def setUp(self):
+        self.collection = InMemoryCollection()
+        self.app = Application([
+            CollectionHandler.mk_urlspec('/root', self.model_factory),
+        ])
+        self.exporter = InMemoryExporter()
+        self.app.tracer = Tracer(self.exporter)
+        self.app_helper = AppHelper(app=self.app)
+
+    def model_factory(self, handler):
+        handler.route_name = "/root/"
+        return TracedModel(self.collection, handler.trace_span)
+
+    @inlineCallbacks
+    def test_traced(self):
+        resp = yield self.app_helper.get('/root/')
+        yield resp.content()
+        self.assertEqual(resp.code, 200)
+        [trace_id] = resp.headers.getRawHeaders('X-Trace-Id')
+        [spans] = self.exporter.traces
+        [page, root] = spans
+        self.assertEqual(root['trace_id'], trace_id)
+        self.assertEqual(root['name'], "GET /root/")
+        self.assertEqual(root['attributes'], {
+            'route': "/root/",
+            'owner_id': None,
+            'status': 200,
+        })
+        self.assertEqual(page['name'], "page")
+        self.assertEqual(page['parent_id'], root['span_id'])
+
+    @inlineCallbacks
+    def test_incoming_trace_id(self):
+        resp = yield self.app_helper.get('/root/?stream=true', headers={
+            'X-Trace-Id': 'trace-1',
+            'X-Parent-Span-Id': 'span-1',
+        })
+        yield resp.content()
+        self.assertEqual(resp.headers.getRawHeaders('X-Trace-Id'), ['trace-1'])
+        [spans] = self.exporter.traces
+        [stream, root] = spans
+        self.assertEqual(stream['name'], "stream")
+        self.assertEqual(root['trace_id'], 'trace-1')
+        self.assertEqual(root['parent_id'], 'span-1')
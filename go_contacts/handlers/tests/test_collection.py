@@ -0,0 +1,122 @@
+"""
+Tests for the contacts API collection and element handlers.
+"""
+
+import json
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from go_api.collections.inmemory import InMemoryCollection
+from go_api.cyclone.helpers import AppHelper
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.formats import msgpack
+from go_contacts.handlers import CollectionHandler, ElementHandler
+
+from cyclone.web import Application
+
+
+class TestCollectionHandlers(VumiTestCase):
+    def setUp(self):
+        self.collection = InMemoryCollection()
+        self.model_factory = lambda req: self.collection
+        self.app_helper = AppHelper(app=Application([
+            CollectionHandler.mk_urlspec('/root', self.model_factory),
+            ElementHandler.mk_urlspec('/root', self.model_factory),
+        ]))
+
+    def require_msgpack(self):
+        if msgpack is None:
+            self.skipTest("msgpack not installed")
+
+    @inlineCallbacks
+    def create(self, object_id, data):
+        key, data = yield self.collection.create(object_id, data)
+        returnValue(data)
+
+    @inlineCallbacks
+    def request(self, method, path, **kw):
+        resp = yield self.app_helper.request(method, path, **kw)
+        content = yield resp.content()
+        [content_type] = resp.headers.getRawHeaders('Content-Type')
+        returnValue((resp.code, content_type, content))
+
+    @inlineCallbacks
+    def test_get_json_by_default(self):
+        obj = yield self.create(u"obj-1", {u"name": u"Foo"})
+        code, content_type, content = yield self.request('GET', '/root/obj-1')
+        self.assertEqual(code, 200)
+        self.assertEqual(content_type, 'application/json; charset=utf-8')
+        self.assertEqual(json.loads(content), obj)
+
+    @inlineCallbacks
+    def test_get_msgpack(self):
+        self.require_msgpack()
+        obj = yield self.create(u"obj-1", {u"name": u"Foo"})
+        code, content_type, content = yield self.request(
+            'GET', '/root/obj-1',
+            headers={'Accept': 'application/x-msgpack'})
+        self.assertEqual(code, 200)
+        self.assertEqual(content_type, 'application/x-msgpack')
+        self.assertEqual(msgpack.unpackb(content, raw=False), obj)
+
+    @inlineCallbacks
+    def test_page_msgpack(self):
+        self.require_msgpack()
+        obj1 = yield self.create(u"obj-1", {u"name": u"Foo"})
+        obj2 = yield self.create(u"obj-2", {u"name": u"Bar"})
+        code, content_type, content = yield self.request(
+            'GET', '/root/?max_results=5',
+            headers={'Accept': 'application/x-msgpack'})
+        self.assertEqual(code, 200)
+        self.assertEqual(content_type, 'application/x-msgpack')
+        self.assertEqual(msgpack.unpackb(content, raw=False), {
+            u"cursor": None, u"data": [obj1, obj2]})
+
+    @inlineCallbacks
+    def test_stream_msgpack(self):
+        self.require_msgpack()
+        obj1 = yield self.create(u"obj-1", {u"name": u"Foo"})
+        obj2 = yield self.create(u"obj-2", {u"name": u"Bar"})
+        code, content_type, content = yield self.request(
+            'GET', '/root/?stream=true',
+            headers={'Accept': 'application/x-msgpack'})
+        self.assertEqual(code, 200)
+        self.assertEqual(content_type, 'application/x-msgpack')
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(content)
+        self.assertEqual(list(unpacker), [obj1, obj2])
+
+    @inlineCallbacks
+    def test_create_msgpack(self):
+        self.require_msgpack()
+        code, content_type, content = yield self.request(
+            'POST', '/root/', data=msgpack.packb({u"name": u"Foo"}),
+            headers={
+                'Content-Type': 'application/x-msgpack',
+                'Accept': 'application/x-msgpack',
+            })
+        self.assertEqual(code, 200)
+        obj = msgpack.unpackb(content, raw=False)
+        self.assertEqual(obj[u"name"], u"Foo")
+        stored = yield self.collection.get(obj[u"id"])
+        self.assertEqual(stored, obj)
+
+    @inlineCallbacks
+    def test_create_invalid_msgpack(self):
+        self.require_msgpack()
+        code, content_type, content = yield self.request(
+            'POST', '/root/', data='\xc1',
+            headers={'Content-Type': 'application/x-msgpack'})
+        self.assertEqual(code, 400)
+        self.assertEqual(content_type, 'application/json; charset=utf-8')
+        self.assertTrue(
+            json.loads(content)[u"reason"].startswith(u"Invalid MSGPACK"))
+
+    @inlineCallbacks
+    def test_update_json_without_content_type(self):
+        yield self.create(u"obj-1", {u"name": u"Foo"})
+        code, content_type, content = yield self.request(
+            'PUT', '/root/obj-1', data=json.dumps({u"name": u"Bar"}))
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(content)[u"name"], u"Bar")
@@ -1,18 +1,18 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from go_api.cyclone.helpers import HandlerHelper, AppHelper
-from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+from vumi.tests.helpers import VumiTestCase
 from go.vumitools.contact import ContactStore
 
 from go_contacts.handlers import ContactsForGroupHandler
 from go_contacts.backends.riak import RiakContactsForGroupModel
+from go_contacts.tests.helpers import ContactsPersistenceHelper
 
 
 class TestContactsForGroupHandler(VumiTestCase):
     @inlineCallbacks
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
         self.collection = yield self.mk_collection('owner-1')
         self.model_factory = lambda req: self.collection
         self.handler_helper = HandlerHelper(
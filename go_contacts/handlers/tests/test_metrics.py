@@ -0,0 +1,29 @@
+"""
+Tests for the metrics handler.
+"""
+
+from twisted.internet.defer import inlineCallbacks
+
+from cyclone.web import Application, URLSpec
+
+from go_api.cyclone.helpers import AppHelper
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.handlers import MetricsHandler
+from go_contacts.metrics import MetricsRegistry
+
+
+class TestMetricsHandler(VumiTestCase):
+    @inlineCallbacks
+    def test_get(self):
+        registry = MetricsRegistry()
+        registry.counter("things_total", "Things.").inc()
+        app = Application([URLSpec(
+            '/metrics/', MetricsHandler, kwargs={'registry': registry})])
+        resp = yield AppHelper(app=app).get('/metrics/')
+        content = yield resp.content()
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Type'),
+            ['text/plain; version=0.0.4; charset=utf-8'])
+        self.assertEqual(content, registry.render())
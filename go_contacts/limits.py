@@ -0,0 +1,187 @@
+"""
+Admission control for expensive requests.
+
+Streaming a whole collection holds a Riak index query and a stream of object
+fetches open for as long as the client keeps reading, so a few owners
+exporting everything at once can starve interactive requests. The
+:class:`StreamLimiter` caps the number of concurrent streams globally and per
+owner.
+"""
+
+from twisted.internet.defer import Deferred, succeed, fail
+
+
+class StreamLimitExceeded(Exception):
+    """
+    Raised when a stream can't be started because too many streams are
+    already running.
+
+    :param str reason:
+        Description of the limit that was hit.
+    :param int retry_after:
+        Number of seconds the client should wait before trying again.
+    """
+
+    def __init__(self, reason, retry_after):
+        super(StreamLimitExceeded, self).__init__(reason)
+        self.retry_after = retry_after
+
+
+class StreamSlot(object):
+    """
+    A running stream. Call :meth:`release` when the stream ends.
+    """
+
+    def __init__(self, limiter, owner_id):
+        self.limiter = limiter
+        self.owner_id = owner_id
+        self.released = False
+
+    def release(self):
+        """
+        Release the slot so that another stream may start. Releasing a slot
+        more than once does nothing.
+        """
+        if not self.released:
+            self.released = True
+            self.limiter._release(self.owner_id)
+
+
+class StreamLimiter(object):
+    """
+    Limits the number of concurrent streams.
+
+    :param int max_streams:
+        Maximum number of concurrent streams across all owners, or ``None``
+        for no limit.
+    :param int max_streams_per_owner:
+        Maximum number of concurrent streams for a single owner, or ``None``
+        for no limit.
+    :param float wait_timeout:
+        Number of seconds a stream may wait for a slot before it is rejected.
+        If this is ``0``, streams over the limit are rejected immediately.
+    :param int retry_after:
+        Number of seconds clients are asked to wait before retrying a
+        rejected stream.
+    :param clock:
+        An :class:`twisted.internet.interfaces.IReactorTime` provider.
+        Defaults to the global reactor.
+
+    The ``active``, ``waiting``, ``admitted``, ``queued`` and ``rejected``
+    counts are available from :meth:`metrics`.
+    """
+
+    def __init__(self, max_streams=None, max_streams_per_owner=None,
+                 wait_timeout=0, retry_after=5, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.max_streams = max_streams
+        self.max_streams_per_owner = max_streams_per_owner
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self.clock = clock
+        self.active = 0
+        self.active_by_owner = {}
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self._waiters = []
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def metrics(self):
+        """
+        Return a dict of the current stream counts.
+        """
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected,
+        }
+
+    def _limit_reached(self, owner_id):
+        """
+        Return a description of the limit preventing ``owner_id`` from
+        starting a stream, or ``None`` if it may start one.
+        """
+        if self.max_streams is not None and self.active >= self.max_streams:
+            return "Too many concurrent streams"
+        if (self.max_streams_per_owner is not None and
+                self.active_by_owner.get(owner_id, 0) >=
+                self.max_streams_per_owner):
+            return "Too many concurrent streams for this owner"
+        return None
+
+    def _admit(self, owner_id):
+        self.active += 1
+        self.active_by_owner[owner_id] = (
+            self.active_by_owner.get(owner_id, 0) + 1)
+        self.admitted += 1
+        return StreamSlot(self, owner_id)
+
+    def _reject(self, reason):
+        self.rejected += 1
+        return StreamLimitExceeded(reason, self.retry_after)
+
+    def acquire(self, owner_id):
+        """
+        Start a stream for ``owner_id``.
+
+        :returns:
+            A deferred that fires with a :class:`StreamSlot` once the stream
+            may start, or fails with :class:`StreamLimitExceeded` if there is
+            no slot available within ``wait_timeout`` seconds. Cancelling the
+            deferred gives up the place in the queue.
+        """
+        reason = self._limit_reached(owner_id)
+        if reason is None:
+            return succeed(self._admit(owner_id))
+        if not self.wait_timeout:
+            return fail(self._reject(reason))
+
+        self.queued += 1
+        waiter = _Waiter(owner_id, reason)
+        waiter.d = Deferred(canceller=lambda d: self._remove_waiter(waiter))
+        waiter.timeout = self.clock.callLater(
+            self.wait_timeout, self._timeout_waiter, waiter)
+        self._waiters.append(waiter)
+        return waiter.d
+
+    def _remove_waiter(self, waiter):
+        self._waiters.remove(waiter)
+        if waiter.timeout.active():
+            waiter.timeout.cancel()
+
+    def _timeout_waiter(self, waiter):
+        self._waiters.remove(waiter)
+        waiter.d.errback(self._reject(waiter.reason))
+
+    def _release(self, owner_id):
+        self.active -= 1
+        self.active_by_owner[owner_id] -= 1
+        if not self.active_by_owner[owner_id]:
+            del self.active_by_owner[owner_id]
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        # Waiters are admitted in the order they arrived, but a waiter that
+        # is blocked by its owner's limit doesn't hold up other owners.
+        for waiter in list(self._waiters):
+            if waiter not in self._waiters:
+                # Removed by a callback fired while we were waking waiters.
+                continue
+            if self._limit_reached(waiter.owner_id) is None:
+                self._remove_waiter(waiter)
+                waiter.d.callback(self._admit(waiter.owner_id))
+
+
+class _Waiter(object):
+    def __init__(self, owner_id, reason):
+        self.owner_id = owner_id
+        self.reason = reason
+        self.d = None
+        self.timeout = None
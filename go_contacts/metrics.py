@@ -0,0 +1,404 @@
+"""
+Metrics for the contacts API, exported in the Prometheus text format.
+
+Recording a metric is a dict lookup and an addition (plus a bisect for
+histograms), so metrics are always collected. Values owned by other objects,
+such as the stream limiter's counts, are read by callbacks when the metrics
+are rendered rather than copied on every change.
+"""
+
+from bisect import bisect_left
+
+from go_contacts.backends.instrumentation import CATEGORIES
+from go_contacts.backends.scheduler import LANES
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# The Prometheus client's default buckets, in seconds.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, escape_label_value(value))
+        for name, value in labels)
+
+
+def escape_label_value(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric(object):
+    """
+    Base class for metrics.
+
+    :param str name:
+        The name of the metric.
+    :param str help:
+        A description of the metric.
+    :param tuple labels:
+        The names of the metric's labels.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self):
+        """
+        Return a list of ``(name, labels, value)`` tuples, where ``labels``
+        is a list of ``(name, value)`` pairs.
+        """
+        raise NotImplementedError()
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        for name, labels, value in self.samples():
+            lines.append("%s%s %s" % (
+                name, format_labels(labels), format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    A count that only goes up.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *label_values, **kw):
+        """
+        Increment the count for the given label values.
+
+        :param amount:
+            The amount to increment by. Defaults to 1.
+        """
+        amount = kw.pop('amount', 1)
+        self._values[label_values] = (
+            self._values.get(label_values, 0) + amount)
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        return [
+            (self.name, zip(self.labels, label_values), value)
+            for label_values, value in sorted(self._values.iteritems())]
+
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, such as request latencies.
+
+    :param tuple buckets:
+        The upper bounds of the buckets, in increasing order. A ``+Inf``
+        bucket is always added.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        """
+        Record an observed value for the given label values.
+        """
+        values = self._values.get(label_values)
+        if values is None:
+            values = self._values[label_values] = _HistogramValues(
+                len(self.buckets))
+        values.bucket_counts[bisect_left(self.buckets, value)] += 1
+        values.total += value
+
+    def count(self, *label_values):
+        values = self._values.get(label_values)
+        if values is None:
+            return 0
+        return sum(values.bucket_counts)
+
+    def samples(self):
+        samples = []
+        bounds = self.buckets + (float('inf'),)
+        for label_values, values in sorted(self._values.iteritems()):
+            labels = zip(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(bounds, values.bucket_counts):
+                cumulative += count
+                samples.append((
+                    self.name + "_bucket",
+                    labels + [("le", format_value(float(bound)))],
+                    cumulative))
+            samples.append((self.name + "_sum", labels, values.total))
+            samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+
+class _HistogramValues(object):
+    def __init__(self, num_buckets):
+        # The last count is for the +Inf bucket.
+        self.bucket_counts = [0] * (num_buckets + 1)
+        self.total = 0.0
+
+
+class CallbackMetric(Metric):
+    """
+    A metric whose values are read from a callback when rendered.
+
+    :param str kind:
+        Either ``counter`` or ``gauge``.
+    :param func callback:
+        A function returning a dict mapping tuples of label values to values.
+        Metrics without labels may return a single value instead.
+    """
+
+    def __init__(self, name, kind, help, callback, labels=()):
+        super(CallbackMetric, self).__init__(name, help, labels)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            (self.name, zip(self.labels, label_values), value)
+            for label_values, value in sorted(values.iteritems())]
+
+
+class MetricsRegistry(object):
+    """
+    A collection of metrics that are rendered together.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, kind, help, callback, labels=()):
+        return self.register(
+            CallbackMetric(name, kind, help, callback, labels))
+
+    def render(self):
+        """
+        Return all the metrics in the Prometheus text format.
+        """
+        return "".join(metric.render() + "\n" for metric in self._metrics)
+
+
+class ContactsApiMetrics(object):
+    """
+    The request metrics for the contacts API.
+
+    Requests are labelled with the route that handled them and the backend
+    method they called: ``page``, ``stream``, ``get``, ``create``,
+    ``update`` or ``delete``.
+
+    :param MetricsRegistry registry:
+        The registry to add metrics to. A new one is created if this isn't
+        given.
+    """
+
+    def __init__(self, registry=None):
+        if registry is None:
+            registry = MetricsRegistry()
+        self.registry = registry
+        self.request_duration = registry.histogram(
+            "contacts_api_request_duration_seconds",
+            "Time taken to handle requests.",
+            labels=("route", "method"))
+        self.responses = registry.counter(
+            "contacts_api_responses_total",
+            "Responses sent, by status code.",
+            labels=("route", "method", "status"))
+        self._streams = set()
+        registry.callback(
+            "contacts_api_streams_active", "gauge",
+            "Streaming responses being written.",
+            lambda: len(self._streams))
+        registry.callback(
+            "contacts_api_stream_queue_depth", "gauge",
+            "Objects fetched for streaming responses but not yet written.",
+            self.stream_queue_depth)
+
+    def record_request(self, route, method, status, duration):
+        """
+        Record a finished request.
+
+        :param str route:
+            The route that handled the request, e.g. ``/contacts/:elem_id``.
+        :param str method:
+            The backend method the request called.
+        :param int status:
+            The response status code.
+        :param float duration:
+            The number of seconds the request took.
+        """
+        self.request_duration.observe(duration, route, method)
+        self.responses.inc(route, method, str(status))
+
+    def stream_started(self, q):
+        self._streams.add(q)
+
+    def stream_finished(self, q):
+        self._streams.discard(q)
+
+    def stream_queue_depth(self):
+        return sum(len(q.pending) for q in self._streams)
+
+    def add_stream_limiter(self, limiter):
+        """
+        Export the counts from a :class:`go_contacts.limits.StreamLimiter`.
+        """
+        def limiter_metric(name):
+            return lambda: limiter.metrics()[name]
+
+        self.registry.callback(
+            "contacts_api_stream_slots_active", "gauge",
+            "Streams holding a slot from the stream limiter.",
+            limiter_metric('active'))
+        self.registry.callback(
+            "contacts_api_stream_slots_waiting", "gauge",
+            "Streams waiting for a slot from the stream limiter.",
+            limiter_metric('waiting'))
+        for name, help in [
+                ('admitted', "Streams given a slot."),
+                ('queued', "Streams that had to wait for a slot."),
+                ('rejected', "Streams rejected for being over the limit.")]:
+            self.registry.callback(
+                "contacts_api_streams_%s_total" % (name,), "counter", help,
+                limiter_metric(name))
+
+    def add_riak_scheduler(self, scheduler):
+        """
+        Export the counts from a
+        :class:`go_contacts.backends.scheduler.RiakScheduler`, by lane.
+        """
+        def lane_metric(get_value):
+            return lambda: dict(
+                ((lane,), get_value(lane)) for lane in LANES)
+
+        self.registry.callback(
+            "contacts_api_riak_scheduler_active", "gauge",
+            "Riak calls running, by the lane whose budget they use.",
+            lane_metric(lambda lane: scheduler.active[lane]),
+            labels=("lane",))
+        self.registry.callback(
+            "contacts_api_riak_scheduler_waiting", "gauge",
+            "Riak calls waiting to be run, by lane.",
+            lane_metric(scheduler.waiting), labels=("lane",))
+        self.registry.callback(
+            "contacts_api_riak_scheduler_dispatched_total", "counter",
+            "Riak calls started, by lane.",
+            lane_metric(lambda lane: scheduler.dispatched[lane]),
+            labels=("lane",))
+
+    def add_single_flight(self, single_flight):
+        """
+        Export the counts from a
+        :class:`go_contacts.backends.singleflight.SingleFlight`.
+        """
+        def single_flight_metric(name):
+            return lambda: single_flight.metrics()[name]
+
+        for name, kind, help in [
+                ('calls', 'counter', "Reads made."),
+                ('coalesced', 'counter',
+                 "Reads that shared an identical in-flight read."),
+                ('overflowed', 'counter',
+                 "Reads made because an identical in-flight read had too "
+                 "many waiters."),
+                ('in_flight', 'gauge', "Reads in flight.")]:
+            suffix = "_total" if kind == 'counter' else ""
+            self.registry.callback(
+                "contacts_api_coalesced_reads_%s%s" % (name, suffix), kind,
+                help, single_flight_metric(name))
+
+    def add_smart_group_memberships(self, memberships):
+        """
+        Export the counts from a
+        :class:`go_contacts.backends.membership.SmartGroupMemberships`.
+        """
+        def membership_metric(name):
+            return lambda: memberships.metrics()[name]
+
+        for name, kind, help in [
+                ('hits', 'counter',
+                 "Reads of smart group contacts served from a kept "
+                 "membership."),
+                ('refreshes', 'counter',
+                 "Searches made to refresh smart group memberships."),
+                ('updates', 'counter',
+                 "Written contacts added to or removed from smart group "
+                 "memberships."),
+                ('groups', 'gauge', "Smart group memberships kept."),
+                ('keys', 'gauge',
+                 "Contact keys kept in smart group memberships.")]:
+            suffix = "_total" if kind == 'counter' else ""
+            self.registry.callback(
+                "contacts_api_smart_group_membership_%s%s" % (name, suffix),
+                kind, help, membership_metric(name))
+
+    def add_riak_stats(self, aggregator):
+        """
+        Export the Riak operations recorded in a
+        :class:`go_contacts.backends.instrumentation.RiakStatsAggregator`,
+        by route. Owners aren't used as labels, as there are too many of them.
+        """
+        def riak_operations():
+            return dict(
+                ((route, category), stats.counts[category])
+                for route, stats in aggregator.get_route_totals().iteritems()
+                for category in CATEGORIES)
+
+        def riak_time():
+            return dict(
+                ((route,), stats.time)
+                for route, stats in aggregator.get_route_totals().iteritems())
+
+        self.registry.callback(
+            "contacts_api_riak_operations_total", "counter",
+            "Riak operations made by requests, by route and type.",
+            riak_operations, labels=("route", "type"))
+        self.registry.callback(
+            "contacts_api_riak_seconds_total", "counter",
+            "Time requests spent waiting for Riak operations, by route.",
+            riak_time, labels=("route",))
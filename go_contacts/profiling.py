@@ -0,0 +1,136 @@
+"""
+On-demand profiling of single requests.
+
+An operator sends a request with an ``X-Profile-Token`` header matching the
+configured token and the request is run under :mod:`cProfile`. The profile is
+written to the configured directory and its file name is returned in the
+``X-Profile`` response header. It can be read with :mod:`pstats`.
+
+The profiler is enabled when the request is received and disabled when it
+finishes, so it covers the handler and every deferred callback run in
+between. Since the profiler hooks the reactor thread, anything else the
+reactor does in that time (such as handling other requests) is included
+too, and only one request may be profiled at a time.
+"""
+
+import cProfile
+import hmac
+import os
+import random
+import re
+import time
+import uuid
+
+
+def _compare_digest(a, b):
+    """
+    Return whether the strings ``a`` and ``b`` are equal, in a time that
+    doesn't depend on where they differ. Used where
+    :func:`hmac.compare_digest` isn't available (before Python 2.7.7).
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+
+class RequestProfiler(object):
+    """
+    Decides which requests to profile and writes out their profiles.
+
+    :param str token:
+        The token operators must send to have a request profiled.
+    :param str profile_dir:
+        The directory to write profiles to.
+    :param float sample_rate:
+        The fraction of requests with a valid token that are profiled.
+    :param func random:
+        A function returning a random float in ``[0, 1)``.
+    :param func clock:
+        A function returning the current time in seconds.
+    """
+
+    def __init__(self, token, profile_dir, sample_rate=1.0,
+                 random=random.random, clock=time.time):
+        self.token = token
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.random = random
+        self.clock = clock
+        self.active = None
+        self.profiled = 0
+        self.skipped = 0
+
+    def is_authorized(self, token):
+        if token is None:
+            return False
+        return compare_digest(str(token), str(self.token))
+
+    def start(self, token, label):
+        """
+        Start profiling a request if ``token`` is valid, no other request is
+        being profiled and the request is sampled.
+
+        :param str token:
+            The token sent with the request.
+        :param str label:
+            A description of the request, included in the profile's name.
+
+        :returns:
+            A started :class:`RequestProfile`, or ``None`` if the request
+            shouldn't be profiled.
+        """
+        if not self.is_authorized(token):
+            return None
+        if self.active is not None or self.random() >= self.sample_rate:
+            self.skipped += 1
+            return None
+        self.profiled += 1
+        self.active = RequestProfile(self, self.profile_name(label))
+        self.active.start()
+        return self.active
+
+    def profile_name(self, label):
+        safe_label = re.sub(r'[^A-Za-z0-9]+', '_', label).strip('_')
+        return "%s-%s-%s.prof" % (
+            time.strftime("%Y%m%d%H%M%S", time.gmtime(self.clock())),
+            safe_label, uuid.uuid4().hex[:8])
+
+    def _stopped(self, profile):
+        if self.active is profile:
+            self.active = None
+
+
+class RequestProfile(object):
+    """
+    A profile of a single request.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.path = os.path.join(profiler.profile_dir, name)
+        self.profile = cProfile.Profile()
+        self.stopped = False
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling and write out the profile. Does nothing if the profile
+        has already been stopped.
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        self.profile.disable()
+        try:
+            self.profile.dump_stats(self.path)
+        finally:
+            self.profiler._stopped(self)
@@ -2,15 +2,59 @@
 Cyclone application for Vumi Go contacts API.
 """
 
-from vumi.persist.txriak_manager import TxRiakManager
+from twisted.internet.defer import maybeDeferred
+from twisted.python.reflect import namedAny
 
-from go_api.cyclone.handlers import ApiApplication
+from cyclone.web import URLSpec
+
+from go_api.cyclone.handlers import ApiApplication, join_paths
+from go_contacts.backends.instrumentation import (
+    InstrumentedRiakManager, RiakOperationStats, RiakStatsAggregator)
+from go_contacts.backends.membership import SmartGroupMemberships
 from go_contacts.backends.riak import (
     RiakContactsBackend, RiakGroupsBackend, ContactsForGroupBackend)
-from go_contacts.handlers import ContactsForGroupHandler
+from go_contacts.backends.scheduler import (
+    RiakScheduler, ScheduledRiakManager, INTERACTIVE, BULK)
+from go_contacts.backends.singleflight import SingleFlight
+from go_contacts.backends.tracing import TracingRiakManager
+from go_contacts.formats import default_formats, get_json_encoder
+from go_contacts.handlers import (
+    CollectionHandler, ElementHandler, ContactsForGroupHandler,
+    MetricsHandler)
+from go_contacts.limits import StreamLimiter
+from go_contacts.metrics import ContactsApiMetrics
+from go_contacts.profiling import RequestProfiler
+from go_contacts.tracing import (
+    Tracer, TracedModel, get_trace_exporter, get_trace_exporter_class)
 
 from confmodel import Config
-from confmodel.fields import ConfigInt, ConfigDict
+from confmodel.fields import (
+    ConfigInt, ConfigDict, ConfigText, ConfigFloat, ConfigBool)
+
+
+# The dotted names of the Riak manager classes that may be given by name.
+# They are only imported when they're used.
+RIAK_MANAGERS = {
+    'riak': 'vumi.persist.txriak_manager.TxRiakManager',
+    'memory': 'go_contacts.backends.memory.InMemoryRiakManager',
+}
+
+
+def get_riak_manager_class(name):
+    """
+    Return a Riak manager class.
+
+    :param str name:
+        Either ``riak``, ``memory`` or the full dotted name of a manager
+        class.
+    """
+    try:
+        return namedAny(RIAK_MANAGERS.get(name, name))
+    except (AttributeError, ImportError, ValueError):
+        raise ValueError(
+            "Unknown Riak manager %r, must be one of: %s or the dotted "
+            "name of a manager class" % (
+                name, ", ".join(sorted(RIAK_MANAGERS))))
 
 
 class ContactsApiConfig(Config):
@@ -23,6 +67,168 @@ class ContactsApiConfig(Config):
         "Maximum number of contacts returned per page", required=True)
     riak_manager = ConfigDict(
         "The configuration parameters for the Riak Manager", required=True)
+    riak_manager_class = ConfigText(
+        "The Riak manager to use. One of 'riak' (a Riak cluster), 'memory' "
+        "(objects are kept in memory in this process, for tests and "
+        "benchmarks) or the dotted name of a manager class with a "
+        "from_config class method. The 'memory' manager accepts a 'latency' "
+        "option in riak_manager, either the seconds every Riak call takes or "
+        "a dict of seconds by operation.", default='riak')
+    json_encoder = ConfigText(
+        "The JSON encoder to use for responses. One of 'json' (the stdlib "
+        "encoder), 'simplejson', 'ujson' or 'auto' (the fastest installed "
+        "encoder).", default='json')
+    max_concurrent_streams = ConfigInt(
+        "Maximum number of streaming requests that may run at once across "
+        "all owners. Unlimited if not set.", default=None)
+    max_concurrent_streams_per_owner = ConfigInt(
+        "Maximum number of streaming requests that may run at once for a "
+        "single owner. Unlimited if not set.", default=None)
+    stream_wait_timeout = ConfigFloat(
+        "Number of seconds a streaming request over the limit may wait for "
+        "another stream to finish. If 0, such requests are rejected "
+        "immediately.", default=0)
+    stream_retry_after = ConfigInt(
+        "Number of seconds clients are asked to wait before retrying a "
+        "rejected streaming request.", default=5)
+    riak_interactive_concurrency = ConfigInt(
+        "Number of concurrent Riak calls reserved for interactive requests, "
+        "such as fetching a single contact. Interactive requests may also "
+        "use any idle bulk capacity. Unlimited if not set.", default=None)
+    riak_bulk_concurrency = ConfigInt(
+        "Maximum number of concurrent Riak calls for bulk requests, such as "
+        "streams and large pages. Unlimited if not set. Riak calls are only "
+        "scheduled if this or riak_interactive_concurrency is set.",
+        default=None)
+    riak_bulk_page_size = ConfigInt(
+        "Requests for pages of more than this many objects are treated as "
+        "bulk requests. Pages requested without max_results are always bulk "
+        "requests.", default=20)
+    coalesce_reads = ConfigBool(
+        "Whether identical concurrent requests for a single contact or group, "
+        "or for a contact by address, share a single set of Riak calls.",
+        default=True)
+    coalesce_max_waiters = ConfigInt(
+        "Maximum number of requests that may share a single set of Riak "
+        "calls. Unlimited if not set.", default=100)
+    smart_group_max_age = ConfigFloat(
+        "If set, the keys of the contacts matching a smart group's query are "
+        "searched for in the background when the group is read, and later "
+        "pages and streams of the group's contacts are served from them for "
+        "up to this many seconds before they are searched for again. "
+        "Responses served from them say how old they are in an "
+        "X-Smart-Group-Age header. Smart group queries are searched for on "
+        "every page if not set.", default=None)
+    smart_group_refresh_interval = ConfigFloat(
+        "If set, the kept smart group contacts that were read since the last "
+        "refresh are refreshed in the background every this many seconds, "
+        "and the others are dropped.", default=None)
+    smart_group_write_refresh_delay = ConfigFloat(
+        "If set, an owner's kept smart group contacts are refreshed in the "
+        "background this many seconds after one of their contacts is "
+        "written through the API.", default=None)
+    smart_group_max_groups = ConfigInt(
+        "Maximum number of smart groups whose contacts are kept.",
+        default=1000)
+    smart_group_max_keys = ConfigInt(
+        "Maximum number of smart group contact keys kept across all groups. "
+        "The contacts of larger groups are always searched for.",
+        default=1000000)
+    riak_stats_headers = ConfigBool(
+        "Whether responses include headers with the number of Riak gets, "
+        "index queries, searches and writes made for the request and the "
+        "time spent waiting for them.", default=False)
+    riak_stats_max_owners = ConfigInt(
+        "Maximum number of route and owner pairs whose Riak operation totals "
+        "are kept. The least recently seen are dropped first.",
+        default=10000)
+    slow_request_threshold = ConfigFloat(
+        "Requests that take at least this many seconds are logged along with "
+        "the Riak operations they made. Nothing is logged if not set.",
+        default=None)
+    profile_token = ConfigText(
+        "A secret token operators may send in an X-Profile-Token header to "
+        "have a request run under the profiler. Profiling is disabled if not "
+        "set.", default=None)
+    profile_dir = ConfigText(
+        "The directory profiles are written to. Required if profile_token "
+        "is set.", default=None)
+    profile_sample_rate = ConfigFloat(
+        "The fraction of requests with a valid profile token that are "
+        "profiled. Only one request is profiled at a time.", default=1.0)
+    trace_exporter = ConfigText(
+        "Where request traces are sent. One of 'file' (JSON lines appended "
+        "to trace_file), 'memory' (kept in memory, for tests) or the dotted "
+        "name of an exporter class. Requests are not traced if not set.",
+        default=None)
+    trace_file = ConfigText(
+        "The file the 'file' trace exporter writes to.", default=None)
+    trace_sample_rate = ConfigFloat(
+        "The fraction of requests traced. Requests with an X-Trace-Id header "
+        "are always traced.", default=1.0)
+    trace_max_spans = ConfigInt(
+        "Maximum number of spans recorded for a single request.",
+        default=1000)
+    metrics_enabled = ConfigBool(
+        "Whether metrics are exported in the Prometheus text format at "
+        "/metrics/.", default=True)
+
+    def post_validate(self):
+        try:
+            get_json_encoder(self.json_encoder)
+        except ValueError as e:
+            self.raise_config_error(str(e))
+        try:
+            get_riak_manager_class(self.riak_manager_class)
+        except ValueError as e:
+            self.raise_config_error(str(e))
+        for field in ['max_concurrent_streams',
+                      'max_concurrent_streams_per_owner',
+                      'riak_interactive_concurrency',
+                      'riak_bulk_concurrency',
+                      'coalesce_max_waiters',
+                      'smart_group_max_groups',
+                      'smart_group_max_keys',
+                      'riak_stats_max_owners',
+                      'trace_max_spans']:
+            value = getattr(self, field)
+            if value is not None and value < 1:
+                self.raise_config_error(
+                    "Field '%s' must be at least 1" % (field,))
+        for field in ['smart_group_refresh_interval',
+                      'smart_group_write_refresh_delay']:
+            if (getattr(self, field) is not None and
+                    self.smart_group_max_age is None):
+                self.raise_config_error(
+                    "Field 'smart_group_max_age' is required if '%s' is "
+                    "set" % (field,))
+        if (self.smart_group_refresh_interval is not None and
+                self.smart_group_refresh_interval <= 0):
+            self.raise_config_error(
+                "Field 'smart_group_refresh_interval' must be greater than 0")
+        if self.profile_token is not None and self.profile_dir is None:
+            self.raise_config_error(
+                "Field 'profile_dir' is required if 'profile_token' is set")
+        if self.trace_exporter is not None:
+            try:
+                get_trace_exporter_class(self.trace_exporter)
+            except ValueError as e:
+                self.raise_config_error(str(e))
+            if self.trace_exporter == 'file' and self.trace_file is None:
+                self.raise_config_error(
+                    "Field 'trace_file' is required for the 'file' trace "
+                    "exporter")
+        for field in ['profile_sample_rate', 'trace_sample_rate']:
+            if not 0 <= getattr(self, field) <= 1:
+                self.raise_config_error(
+                    "Field '%s' must be between 0 and 1" % (field,))
+        for field in ['stream_wait_timeout', 'slow_request_threshold',
+                      'smart_group_max_age',
+                      'smart_group_write_refresh_delay']:
+            value = getattr(self, field)
+            if value is not None and value < 0:
+                self.raise_config_error(
+                    "Field '%s' must not be negative" % (field,))
 
 
 class ContactsApi(ApiApplication):
@@ -35,35 +241,211 @@ class ContactsApi(ApiApplication):
 
     def initialize(self, settings, config):
         config = ContactsApiConfig(config)
+        self.formats = default_formats(
+            json_dumps=get_json_encoder(config.json_encoder))
+        self.stream_limiter = StreamLimiter(
+            max_streams=config.max_concurrent_streams,
+            max_streams_per_owner=config.max_concurrent_streams_per_owner,
+            wait_timeout=config.stream_wait_timeout,
+            retry_after=config.stream_retry_after)
+        self.riak_scheduler = self._setup_riak_scheduler(config)
+        self.riak_bulk_page_size = config.riak_bulk_page_size
+        self.single_flight = self._setup_single_flight(config)
+        self.riak_stats_headers = config.riak_stats_headers
+        self.riak_stats = RiakStatsAggregator(
+            max_owner_totals=config.riak_stats_max_owners)
+        self.slow_request_threshold = config.slow_request_threshold
+        self.profiler = self._setup_profiler(config)
+        self.tracer = self._setup_tracer(config)
+        self.smart_group_memberships = self._setup_smart_group_memberships(
+            config)
         self.contact_backend = self._setup_contacts_backend(config)
         self.group_backend = self._setup_groups_backend(config)
         self.contactsforgroup_backend = self._setup_contactsforgroup_backend(
             config)
+        self.metrics = self._setup_metrics(config)
 
     def _get_riak_manager(self, config):
         try:
             return self.riak_manager
         except AttributeError:
-            self.riak_manager = TxRiakManager.from_config(config.riak_manager)
+            manager_cls = get_riak_manager_class(config.riak_manager_class)
+            self.riak_manager = manager_cls.from_config(config.riak_manager)
             return self.riak_manager
 
+    def _setup_riak_scheduler(self, config):
+        if (config.riak_interactive_concurrency is None and
+                config.riak_bulk_concurrency is None):
+            return None
+        return RiakScheduler(
+            interactive_concurrency=config.riak_interactive_concurrency,
+            bulk_concurrency=config.riak_bulk_concurrency)
+
+    def _setup_single_flight(self, config):
+        if not config.coalesce_reads:
+            return None
+        return SingleFlight(max_waiters=config.coalesce_max_waiters)
+
+    def _setup_profiler(self, config):
+        if config.profile_token is None:
+            return None
+        return RequestProfiler(
+            config.profile_token, config.profile_dir,
+            sample_rate=config.profile_sample_rate)
+
+    def _setup_tracer(self, config):
+        if config.trace_exporter is None:
+            return None
+        options = {}
+        if config.trace_exporter == 'file':
+            options['path'] = config.trace_file
+        return Tracer(
+            get_trace_exporter(config.trace_exporter, **options),
+            sample_rate=config.trace_sample_rate,
+            max_spans=config.trace_max_spans)
+
+    def _setup_smart_group_memberships(self, config):
+        if config.smart_group_max_age is None:
+            return None
+        riak_manager = self._get_riak_manager(config)
+        if self.riak_scheduler is not None:
+            riak_manager = ScheduledRiakManager(
+                riak_manager, self.riak_scheduler, BULK)
+        memberships = SmartGroupMemberships(
+            riak_manager, config.smart_group_max_age,
+            refresh_interval=config.smart_group_refresh_interval,
+            write_refresh_delay=config.smart_group_write_refresh_delay,
+            max_groups=config.smart_group_max_groups,
+            max_keys=config.smart_group_max_keys)
+        memberships.start()
+        return memberships
+
+    def _setup_metrics(self, config):
+        if not config.metrics_enabled:
+            return None
+        metrics = ContactsApiMetrics()
+        metrics.add_stream_limiter(self.stream_limiter)
+        if self.riak_scheduler is not None:
+            metrics.add_riak_scheduler(self.riak_scheduler)
+        if self.single_flight is not None:
+            metrics.add_single_flight(self.single_flight)
+        if self.smart_group_memberships is not None:
+            metrics.add_smart_group_memberships(self.smart_group_memberships)
+        metrics.add_riak_stats(self.riak_stats)
+        return metrics
+
     def _setup_contacts_backend(self, config):
         riak_manager = self._get_riak_manager(config)
         backend = RiakContactsBackend(
-            riak_manager, config.max_contacts_per_page)
+            riak_manager, config.max_contacts_per_page,
+            single_flight=self.single_flight,
+            memberships=self.smart_group_memberships)
         return backend
 
     def _setup_groups_backend(self, config):
         riak_manager = self._get_riak_manager(config)
-        backend = RiakGroupsBackend(riak_manager, config.max_groups_per_page)
+        backend = RiakGroupsBackend(
+            riak_manager, config.max_groups_per_page,
+            single_flight=self.single_flight)
         return backend
 
     def _setup_contactsforgroup_backend(self, config):
         riak_manager = self._get_riak_manager(config)
         backend = ContactsForGroupBackend(
-            riak_manager, config.max_contacts_per_page)
+            riak_manager, config.max_contacts_per_page,
+            memberships=self.smart_group_memberships)
         return backend
 
+    def _build_route(self, path_prefix, dfn, handler_cls, factory):
+        """
+        Build a route whose model factory is called with the owner returned by
+        the factory preprocessor and any keyword arguments returned by
+        :meth:`get_factory_kwargs`. The owner is stored on the handler as
+        ``owner_id`` and the route as ``route_name``. If the request is being
+        traced, calls to the model's methods are recorded as spans.
+        """
+        route_name = join_paths(path_prefix, dfn, handler_cls.route_suffix)
+        preprocessor = self.factory_preprocessor
+
+        def model_factory(handler):
+            handler.route_name = route_name
+            if preprocessor is None:
+                return factory(handler)
+            d = maybeDeferred(preprocessor, handler)
+
+            def build_model(owner_id):
+                handler.owner_id = owner_id
+                return factory(owner_id, **self.get_factory_kwargs(handler))
+            d.addCallback(build_model)
+            if handler.trace_span is not None:
+                d.addCallback(TracedModel, handler.trace_span)
+            return d
+
+        return handler_cls.mk_urlspec(
+            dfn, model_factory, path_prefix=path_prefix)
+
+    def get_factory_kwargs(self, handler):
+        """
+        Return extra keyword arguments for the collection and model factories.
+        """
+        return {'riak_manager': self.get_riak_manager(handler)}
+
+    def get_riak_manager(self, handler):
+        """
+        Return the Riak manager to use for a request.
+
+        The Riak operations made through it are recorded in a
+        :class:`RiakOperationStats` stored on the handler as ``riak_stats``.
+        If Riak calls are being scheduled, calls are run in the lane for the
+        request. The time an operation spends waiting for the scheduler is
+        included in the time recorded for it. If the request is being traced,
+        each Riak call is recorded as a span.
+        """
+        riak_manager = self.riak_manager
+        if self.riak_scheduler is not None:
+            riak_manager = ScheduledRiakManager(
+                riak_manager, self.riak_scheduler,
+                self.riak_lane_for_request(handler))
+        handler.riak_stats = RiakOperationStats()
+        riak_manager = InstrumentedRiakManager(
+            riak_manager, handler.riak_stats)
+        if handler.trace_span is not None:
+            riak_manager = TracingRiakManager(
+                riak_manager, handler.trace_span.trace)
+        return riak_manager
+
+    def riak_lane_for_request(self, handler):
+        """
+        Return the Riak scheduling lane for a request.
+        """
+        if handler.is_bulk_request(self.riak_bulk_page_size):
+            return BULK
+        return INTERACTIVE
+
+    def _build_routes(self, path_prefix=""):
+        routes = ApiApplication._build_routes(self, path_prefix)
+        if self.metrics is not None:
+            routes.append(URLSpec(
+                '/metrics/', MetricsHandler,
+                kwargs={'registry': self.metrics.registry}))
+        return routes
+
+    def _build_collection_routes(self, path_prefix):
+        """
+        Build up routes for collection handlers.
+        """
+        return [
+            self._build_route(path_prefix, dfn, CollectionHandler, factory)
+            for dfn, factory in self.collections]
+
+    def _build_element_routes(self, path_prefix):
+        """
+        Build up routes for element handlers.
+        """
+        return [
+            self._build_route(path_prefix, dfn, ElementHandler, factory)
+            for dfn, factory in self.collections]
+
     @property
     def collections(self):
         return (
@@ -77,5 +459,6 @@ class ContactsApi(ApiApplication):
             ('/groups/', ContactsForGroupHandler, self.get_groups_model),
         )
 
-    def get_groups_model(self, owner_id):
-        return self.contactsforgroup_backend.get_model(owner_id)
+    def get_groups_model(self, owner_id, riak_manager=None):
+        return self.contactsforgroup_backend.get_model(
+            owner_id, riak_manager=riak_manager)
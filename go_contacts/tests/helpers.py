@@ -0,0 +1,69 @@
+"""
+Helpers for the go_contacts tests.
+"""
+
+import os
+
+from vumi.tests.helpers import PersistenceHelper
+
+from go_contacts.backends.memory import (
+    InMemoryRiakClient, InMemoryRiakManager)
+
+
+# Set this to ``memory`` to run the Riak-backed tests without Riak.
+RIAK_MANAGER_ENV = 'GO_CONTACTS_TEST_RIAK_MANAGER'
+
+
+def use_memory_riak():
+    """
+    Return ``True`` if the tests should use an
+    :class:`go_contacts.backends.memory.InMemoryRiakManager` in place of a
+    Riak cluster.
+    """
+    name = os.environ.get(RIAK_MANAGER_ENV, 'riak')
+    if name not in ('riak', 'memory'):
+        raise ValueError(
+            "%s must be 'riak' or 'memory', not %r" % (RIAK_MANAGER_ENV, name))
+    return name == 'memory'
+
+
+class ContactsPersistenceHelper(PersistenceHelper):
+    """
+    A :class:`vumi.tests.helpers.PersistenceHelper` for async Riak-backed
+    tests. If the ``GO_CONTACTS_TEST_RIAK_MANAGER`` environment variable is
+    ``memory``, every ``TxRiakManager`` built from config while the helper is
+    set up (including the ones built by the API server) is an
+    :class:`go_contacts.backends.memory.InMemoryRiakManager` instead. These
+    share their data, which is cleared when the helper is cleaned up::
+
+        GO_CONTACTS_TEST_RIAK_MANAGER=memory trial go_contacts
+    """
+
+    def __init__(self, **kw):
+        kw.setdefault('use_riak', True)
+        kw.setdefault('is_sync', False)
+        super(ContactsPersistenceHelper, self).__init__(**kw)
+        self.riak_client = None
+        self.riak_manager_class = None
+
+    def setup(self):
+        super(ContactsPersistenceHelper, self).setup()
+        from vumi.persist.txriak_manager import TxRiakManager
+        self.riak_manager_class = TxRiakManager
+        if self.use_riak and use_memory_riak():
+            self._patch_memory_riak(TxRiakManager)
+
+    def _patch_memory_riak(self, manager_cls):
+        self.riak_client = InMemoryRiakClient()
+        self.riak_manager_class = InMemoryRiakManager
+
+        def from_config(cls, config):
+            return InMemoryRiakManager.from_config(
+                config, client=self.riak_client)
+
+        self._patch(manager_cls, 'from_config', classmethod(from_config))
+
+    def cleanup(self):
+        if self.riak_client is not None:
+            self.riak_client.buckets.clear()
+        return super(ContactsPersistenceHelper, self).cleanup()
@@ -0,0 +1,153 @@
+"""
+Tests for request and response body formats.
+"""
+
+import json
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.formats import (
+    JsonFormat, MsgpackFormat, default_formats, format_for_content_type,
+    negotiate_format, get_json_encoder, msgpack)
+
+
+class TestGetJsonEncoder(VumiTestCase):
+    def test_stdlib(self):
+        self.assertEqual(get_json_encoder('json'), json.dumps)
+
+    def test_auto(self):
+        dumps = get_json_encoder('auto')
+        obj = {u"a": [1, None, u"b/c"], u"d": {u"e": u"\u00e9"}}
+        self.assertEqual(json.loads(dumps(obj)), obj)
+
+    def test_unknown(self):
+        err = self.assertRaises(ValueError, get_json_encoder, 'foo')
+        self.assertEqual(
+            str(err),
+            "Unknown JSON encoder 'foo', must be one of: "
+            "auto, json, simplejson, ujson")
+
+    def test_optional_encoders(self):
+        for name in ('simplejson', 'ujson'):
+            try:
+                dumps = get_json_encoder(name)
+            except ValueError as e:
+                self.assertEqual(
+                    str(e), "JSON encoder %r is not installed" % (name,))
+            else:
+                obj = {u"a": [1, None, u"b/c"]}
+                self.assertEqual(json.loads(dumps(obj)), obj)
+
+
+class TestJsonFormat(VumiTestCase):
+    def test_encode(self):
+        fmt = JsonFormat()
+        self.assertEqual(fmt.encode({u"a": 1}), '{"a": 1}')
+
+    def test_encode_custom_dumps(self):
+        fmt = JsonFormat(lambda obj: "custom")
+        self.assertEqual(fmt.encode({u"a": 1}), "custom")
+        self.assertEqual(fmt.encode_stream_item({u"a": 1}), "custom\n")
+
+    def test_encode_stream_item(self):
+        fmt = JsonFormat()
+        self.assertEqual(fmt.encode_stream_item({u"a": 1}), '{"a": 1}\n')
+
+    def test_decode(self):
+        fmt = JsonFormat()
+        self.assertEqual(fmt.decode('{"a": 1}'), {u"a": 1})
+
+    def test_decode_invalid(self):
+        fmt = JsonFormat()
+        self.assertRaises(ValueError, fmt.decode, '{')
+
+
+class TestMsgpackFormat(VumiTestCase):
+    def setUp(self):
+        if msgpack is None:
+            self.skipTest("msgpack not installed")
+
+    def test_round_trip(self):
+        fmt = MsgpackFormat()
+        obj = {u"key": "abc", u"name": u"Foo", u"groups": [], u"dob": None}
+        self.assertEqual(fmt.decode(fmt.encode(obj)), {
+            u"key": u"abc", u"name": u"Foo", u"groups": [], u"dob": None})
+
+    def test_byte_strings_decode_as_unicode(self):
+        fmt = MsgpackFormat()
+        decoded = fmt.decode(fmt.encode({"key": "abc"}))
+        self.assertEqual(decoded, {u"key": u"abc"})
+        self.assertTrue(isinstance(decoded.keys()[0], unicode))
+
+    def test_stream_items_are_concatenated(self):
+        fmt = MsgpackFormat()
+        data = "".join(
+            fmt.encode_stream_item({u"n": i}) for i in range(3))
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(data)
+        self.assertEqual(list(unpacker), [{u"n": 0}, {u"n": 1}, {u"n": 2}])
+
+    def test_decode_invalid(self):
+        fmt = MsgpackFormat()
+        self.assertRaises(ValueError, fmt.decode, '\xc1')
+
+
+class TestNegotiation(VumiTestCase):
+    def setUp(self):
+        self.json_format = JsonFormat()
+        self.msgpack_format = MsgpackFormat()
+        self.formats = [self.json_format, self.msgpack_format]
+
+    def test_default_formats(self):
+        formats = default_formats()
+        self.assertTrue(isinstance(formats[0], JsonFormat))
+        self.assertEqual(formats[0].dumps, json.dumps)
+        self.assertEqual(len(formats), 1 if msgpack is None else 2)
+
+    def test_default_formats_json_dumps(self):
+        def dumps(obj):
+            return "custom"
+        formats = default_formats(json_dumps=dumps)
+        self.assertEqual(formats[0].dumps, dumps)
+
+    def test_negotiate_no_accept(self):
+        self.assertEqual(
+            negotiate_format(self.formats, None), self.json_format)
+
+    def test_negotiate_wildcard(self):
+        self.assertEqual(
+            negotiate_format(self.formats, '*/*'), self.json_format)
+
+    def test_negotiate_msgpack(self):
+        self.assertEqual(
+            negotiate_format(self.formats, 'application/x-msgpack'),
+            self.msgpack_format)
+        self.assertEqual(
+            negotiate_format(self.formats, 'application/msgpack'),
+            self.msgpack_format)
+
+    def test_negotiate_quality(self):
+        accept = 'application/json;q=0.5, application/x-msgpack'
+        self.assertEqual(
+            negotiate_format(self.formats, accept), self.msgpack_format)
+        accept = 'application/json, application/x-msgpack;q=0.5'
+        self.assertEqual(
+            negotiate_format(self.formats, accept), self.json_format)
+
+    def test_negotiate_unavailable(self):
+        self.assertEqual(
+            negotiate_format([self.json_format], 'application/x-msgpack'),
+            self.json_format)
+
+    def test_format_for_content_type(self):
+        self.assertEqual(
+            format_for_content_type(self.formats, None), self.json_format)
+        self.assertEqual(
+            format_for_content_type(
+                self.formats, 'application/json; charset=utf-8'),
+            self.json_format)
+        self.assertEqual(
+            format_for_content_type(self.formats, 'application/x-msgpack'),
+            self.msgpack_format)
+        self.assertEqual(
+            format_for_content_type(self.formats, 'text/plain'), None)
@@ -0,0 +1,135 @@
+"""
+Tests for go_contacts.limits.
+"""
+
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.limits import StreamLimiter, StreamLimitExceeded
+
+
+class TestStreamLimiter(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_limiter(self, **kw):
+        kw.setdefault('clock', self.clock)
+        return StreamLimiter(**kw)
+
+    def acquire(self, limiter, owner_id):
+        return self.successResultOf(limiter.acquire(owner_id))
+
+    def assert_rejected(self, d, reason, retry_after=5):
+        f = self.failureResultOf(d, StreamLimitExceeded)
+        self.assertEqual(str(f.value), reason)
+        self.assertEqual(f.value.retry_after, retry_after)
+
+    def test_unlimited(self):
+        limiter = self.mk_limiter()
+        slots = [self.acquire(limiter, "owner-1") for _ in range(10)]
+        self.assertEqual(limiter.active, 10)
+        for slot in slots:
+            slot.release()
+        self.assertEqual(limiter.active, 0)
+        self.assertEqual(limiter.active_by_owner, {})
+
+    def test_global_limit(self):
+        limiter = self.mk_limiter(max_streams=2, retry_after=3)
+        slot = self.acquire(limiter, "owner-1")
+        self.acquire(limiter, "owner-2")
+        self.assert_rejected(
+            limiter.acquire("owner-3"), "Too many concurrent streams", 3)
+        slot.release()
+        self.acquire(limiter, "owner-3")
+
+    def test_owner_limit(self):
+        limiter = self.mk_limiter(max_streams_per_owner=1)
+        slot = self.acquire(limiter, "owner-1")
+        self.assert_rejected(
+            limiter.acquire("owner-1"),
+            "Too many concurrent streams for this owner")
+        self.acquire(limiter, "owner-2")
+        slot.release()
+        self.acquire(limiter, "owner-1")
+
+    def test_release_twice(self):
+        limiter = self.mk_limiter(max_streams=1)
+        slot = self.acquire(limiter, "owner-1")
+        slot.release()
+        slot.release()
+        self.assertEqual(limiter.active, 0)
+        self.acquire(limiter, "owner-1")
+        self.assertEqual(limiter.active, 1)
+
+    def test_wait_for_slot(self):
+        limiter = self.mk_limiter(max_streams=1, wait_timeout=10)
+        slot = self.acquire(limiter, "owner-1")
+        d = limiter.acquire("owner-2")
+        self.assertNoResult(d)
+        self.assertEqual(limiter.waiting, 1)
+        self.clock.advance(5)
+        slot.release()
+        new_slot = self.successResultOf(d)
+        self.assertEqual(new_slot.owner_id, "owner-2")
+        self.assertEqual(limiter.waiting, 0)
+        self.assertEqual(limiter.active_by_owner, {"owner-2": 1})
+        # The timeout was cancelled.
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_wait_timeout(self):
+        limiter = self.mk_limiter(max_streams=1, wait_timeout=10)
+        self.acquire(limiter, "owner-1")
+        d = limiter.acquire("owner-2")
+        self.clock.advance(10)
+        self.assert_rejected(d, "Too many concurrent streams")
+        self.assertEqual(limiter.waiting, 0)
+
+    def test_cancel_wait(self):
+        limiter = self.mk_limiter(max_streams=1, wait_timeout=10)
+        slot = self.acquire(limiter, "owner-1")
+        d = limiter.acquire("owner-2")
+        d.addErrback(lambda f: None)
+        d.cancel()
+        self.assertEqual(limiter.waiting, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        slot.release()
+        self.assertEqual(limiter.active, 0)
+
+    def test_waiters_admitted_in_order(self):
+        limiter = self.mk_limiter(max_streams=1, wait_timeout=10)
+        slot = self.acquire(limiter, "owner-1")
+        d1 = limiter.acquire("owner-2")
+        d2 = limiter.acquire("owner-3")
+        slot.release()
+        self.successResultOf(d1)
+        self.assertNoResult(d2)
+
+    def test_owner_waiter_does_not_block_others(self):
+        limiter = self.mk_limiter(
+            max_streams=2, max_streams_per_owner=1, wait_timeout=10)
+        slot1 = self.acquire(limiter, "owner-1")
+        slot2 = self.acquire(limiter, "owner-2")
+        d1 = limiter.acquire("owner-1")
+        d3 = limiter.acquire("owner-3")
+        slot2.release()
+        self.assertNoResult(d1)
+        self.assertEqual(self.successResultOf(d3).owner_id, "owner-3")
+        slot1.release()
+        self.assertEqual(self.successResultOf(d1).owner_id, "owner-1")
+
+    def test_metrics(self):
+        limiter = self.mk_limiter(max_streams=1, wait_timeout=10)
+        slot = self.acquire(limiter, "owner-1")
+        for owner_id in ["owner-2", "owner-3"]:
+            limiter.acquire(owner_id).addErrback(lambda f: None)
+        self.clock.advance(10)
+        self.assertEqual(limiter.metrics(), {
+            'active': 1,
+            'waiting': 0,
+            'admitted': 1,
+            'queued': 2,
+            'rejected': 2,
+        })
+        slot.release()
+        self.assertEqual(limiter.metrics()['active'], 0)
@@ -0,0 +1,172 @@
+"""
+Tests for go_contacts.metrics.
+"""
+
+from twisted.internet.defer import Deferred
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_api.queue import PausingDeferredQueue
+
+from go_contacts.backends.instrumentation import (
+    RiakOperationStats, RiakStatsAggregator)
+from go_contacts.backends.scheduler import RiakScheduler, BULK
+from go_contacts.backends.singleflight import SingleFlight
+from go_contacts.limits import StreamLimiter
+from go_contacts.metrics import (
+    MetricsRegistry, ContactsApiMetrics, format_labels)
+
+
+class TestMetricsRegistry(VumiTestCase):
+    def test_empty(self):
+        self.assertEqual(MetricsRegistry().render(), "")
+
+    def test_counter(self):
+        registry = MetricsRegistry()
+        counter = registry.counter(
+            "requests_total", "Requests.", labels=("route",))
+        counter.inc("/a")
+        counter.inc("/b", amount=2)
+        counter.inc("/a")
+        self.assertEqual(counter.value("/a"), 2)
+        self.assertEqual(registry.render(), "\n".join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{route="/a"} 2',
+            'requests_total{route="/b"} 2',
+            '']))
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram(
+            "latency_seconds", "Latency.", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+        self.assertEqual(histogram.count(), 4)
+        self.assertEqual(registry.render(), "\n".join([
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1.0"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            'latency_seconds_sum 2.65',
+            'latency_seconds_count 4',
+            '']))
+
+    def test_callback(self):
+        registry = MetricsRegistry()
+        values = {("x",): 1, ("y",): 2}
+        registry.callback(
+            "things", "gauge", "Things.", lambda: values, labels=("name",))
+        registry.callback("total", "gauge", "Total.", lambda: 3)
+        self.assertEqual(registry.render(), "\n".join([
+            '# HELP things Things.',
+            '# TYPE things gauge',
+            'things{name="x"} 1',
+            'things{name="y"} 2',
+            '# HELP total Total.',
+            '# TYPE total gauge',
+            'total 3',
+            '']))
+
+    def test_label_escaping(self):
+        self.assertEqual(
+            format_labels([("a", u'x"y\\z\n\u2603')]),
+            '{a="x\\"y\\\\z\\n\xe2\x98\x83"}')
+
+
+class TestContactsApiMetrics(VumiTestCase):
+    def render_lines(self, metrics):
+        return [
+            line for line in metrics.registry.render().splitlines()
+            if not line.startswith("#")]
+
+    def test_record_request(self):
+        metrics = ContactsApiMetrics()
+        metrics.record_request("/contacts/", "page", 200, 0.02)
+        metrics.record_request("/contacts/", "page", 500, 0.5)
+        self.assertEqual(
+            metrics.request_duration.count("/contacts/", "page"), 2)
+        self.assertEqual(
+            metrics.responses.value("/contacts/", "page", "500"), 1)
+        lines = self.render_lines(metrics)
+        self.assertTrue(
+            'contacts_api_request_duration_seconds_bucket'
+            '{route="/contacts/",method="page",le="0.025"} 1' in lines)
+        self.assertTrue(
+            'contacts_api_responses_total'
+            '{route="/contacts/",method="page",status="200"} 1' in lines)
+
+    def test_streams(self):
+        metrics = ContactsApiMetrics()
+        q = PausingDeferredQueue(backlog=1, size=3)
+        metrics.stream_started(q)
+        q.put({})
+        q.put({})
+        lines = self.render_lines(metrics)
+        self.assertTrue('contacts_api_streams_active 1' in lines)
+        self.assertTrue('contacts_api_stream_queue_depth 2' in lines)
+        metrics.stream_finished(q)
+        lines = self.render_lines(metrics)
+        self.assertTrue('contacts_api_streams_active 0' in lines)
+        self.assertTrue('contacts_api_stream_queue_depth 0' in lines)
+
+    def test_stream_limiter(self):
+        metrics = ContactsApiMetrics()
+        limiter = StreamLimiter(max_streams=1)
+        metrics.add_stream_limiter(limiter)
+        limiter.acquire("owner-1")
+        d = limiter.acquire("owner-1")
+        d.addErrback(lambda f: None)
+        lines = self.render_lines(metrics)
+        self.assertTrue('contacts_api_stream_slots_active 1' in lines)
+        self.assertTrue('contacts_api_streams_admitted_total 1' in lines)
+        self.assertTrue('contacts_api_streams_rejected_total 1' in lines)
+
+    def test_riak_scheduler(self):
+        metrics = ContactsApiMetrics()
+        scheduler = RiakScheduler(bulk_concurrency=1)
+        metrics.add_riak_scheduler(scheduler)
+        scheduler.run(BULK, Deferred)
+        scheduler.run(BULK, Deferred)
+        lines = self.render_lines(metrics)
+        self.assertTrue(
+            'contacts_api_riak_scheduler_active{lane="bulk"} 1' in lines)
+        self.assertTrue(
+            'contacts_api_riak_scheduler_waiting{lane="bulk"} 1' in lines)
+        self.assertTrue(
+            'contacts_api_riak_scheduler_dispatched_total{lane="interactive"}'
+            ' 0' in lines)
+
+    def test_single_flight(self):
+        metrics = ContactsApiMetrics()
+        single_flight = SingleFlight()
+        metrics.add_single_flight(single_flight)
+        single_flight.run("key", Deferred)
+        single_flight.run("key", Deferred)
+        lines = self.render_lines(metrics)
+        self.assertTrue('contacts_api_coalesced_reads_calls_total 1' in lines)
+        self.assertTrue(
+            'contacts_api_coalesced_reads_coalesced_total 1' in lines)
+        self.assertTrue('contacts_api_coalesced_reads_in_flight 1' in lines)
+
+    def test_riak_stats(self):
+        metrics = ContactsApiMetrics()
+        aggregator = RiakStatsAggregator()
+        metrics.add_riak_stats(aggregator)
+        for owner_id in ["owner-1", "owner-2"]:
+            stats = RiakOperationStats()
+            stats.record('load', 0.25)
+            aggregator.record("/contacts/:elem_id", owner_id, stats)
+        lines = self.render_lines(metrics)
+        self.assertTrue(
+            'contacts_api_riak_operations_total'
+            '{route="/contacts/:elem_id",type="gets"} 2' in lines)
+        self.assertTrue(
+            'contacts_api_riak_operations_total'
+            '{route="/contacts/:elem_id",type="writes"} 0' in lines)
+        self.assertTrue(
+            'contacts_api_riak_seconds_total'
+            '{route="/contacts/:elem_id"} 0.5' in lines)
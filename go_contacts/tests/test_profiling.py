@@ -0,0 +1,83 @@
+"""
+Tests for go_contacts.profiling.
+"""
+
+import os
+import pstats
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.profiling import RequestProfiler, _compare_digest
+
+
+class TestCompareDigest(VumiTestCase):
+    def test_compare_digest(self):
+        self.assertTrue(_compare_digest("secret", "secret"))
+        self.assertTrue(_compare_digest("", ""))
+        self.assertFalse(_compare_digest("secret", "secreT"))
+        self.assertFalse(_compare_digest("secret", "secret1"))
+        self.assertFalse(_compare_digest("secret", ""))
+
+
+class TestRequestProfiler(VumiTestCase):
+    def setUp(self):
+        self.profile_dir = self.mktemp()
+        os.mkdir(self.profile_dir)
+        self.random_values = []
+
+    def mk_profiler(self, sample_rate=1.0):
+        return RequestProfiler(
+            "secret", self.profile_dir, sample_rate=sample_rate,
+            random=lambda: self.random_values.pop(0), clock=lambda: 0)
+
+    def test_invalid_token(self):
+        profiler = self.mk_profiler()
+        self.assertEqual(profiler.start(None, "GET /contacts/"), None)
+        self.assertEqual(profiler.start("wrong", "GET /contacts/"), None)
+        self.assertEqual(profiler.profiled, 0)
+        self.assertEqual(profiler.skipped, 0)
+
+    def test_profile(self):
+        profiler = self.mk_profiler()
+        self.random_values = [0.5]
+        profile = profiler.start("secret", "GET /contacts/")
+        sorted(range(100))
+        profile.stop()
+        self.assertTrue(
+            profile.name.startswith("19700101000000-GET_contacts-"))
+        self.assertTrue(profile.name.endswith(".prof"))
+        self.assertEqual(
+            profile.path, os.path.join(self.profile_dir, profile.name))
+        stats = pstats.Stats(profile.path)
+        self.assertTrue(('~', 0, '<sorted>') in stats.stats)
+        self.assertEqual(profiler.active, None)
+        self.assertEqual(profiler.profiled, 1)
+
+    def test_stop_twice(self):
+        profiler = self.mk_profiler()
+        self.random_values = [0.5]
+        profile = profiler.start("secret", "GET /contacts/")
+        profile.stop()
+        os.remove(profile.path)
+        profile.stop()
+        self.assertFalse(os.path.exists(profile.path))
+
+    def test_one_at_a_time(self):
+        profiler = self.mk_profiler()
+        self.random_values = [0.5, 0.5]
+        profile = profiler.start("secret", "GET /contacts/")
+        self.assertEqual(profiler.start("secret", "GET /groups/"), None)
+        self.assertEqual(profiler.skipped, 1)
+        profile.stop()
+        profile = profiler.start("secret", "GET /groups/")
+        self.assertNotEqual(profile, None)
+        profile.stop()
+
+    def test_sample_rate(self):
+        profiler = self.mk_profiler(sample_rate=0.25)
+        self.random_values = [0.5, 0.1]
+        self.assertEqual(profiler.start("secret", "GET /contacts/"), None)
+        self.assertEqual(profiler.skipped, 1)
+        profile = profiler.start("secret", "GET /contacts/")
+        self.assertNotEqual(profile, None)
+        profile.stop()
@@ -10,19 +10,21 @@ import yaml
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
-from vumi.persist.txriak_manager import TxRiakManager
 from vumi.tests.helpers import VumiTestCase
-from vumi.tests.helpers import PersistenceHelper
 
 from go_api.cyclone.helpers import AppHelper
 
 from go_contacts.backends.riak import (
     RiakContactsBackend, contact_to_dict, group_to_dict, RiakGroupsBackend)
+from go_contacts.backends.memory import InMemoryRiakManager
+from go_contacts.backends.scheduler import INTERACTIVE, BULK
+from go_contacts.handlers import MetricsHandler
 from go_contacts.server import ContactsApi
 from go_contacts.tests.server_groups_test_mixin import GroupsApiTestMixin
 from go_contacts.tests.server_contacts_test_mixin import ContactsApiTestMixin
 from go_contacts.tests.server_contactsforgroup_test_mixin import (
     ContactsForGroupApiTestMixin)
+from go_contacts.tests.helpers import ContactsPersistenceHelper
 from go_api.collections.errors import CollectionObjectNotFound
 
 from confmodel.errors import ConfigError
@@ -69,6 +71,456 @@ class TestApiServer(object):
             str(err),
             "Missing required config field 'max_groups_per_page'")
 
+    def test_init_invalid_json_encoder(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "json_encoder": "foo",
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err),
+            "Unknown JSON encoder 'foo', must be one of: "
+            "auto, json, simplejson, ujson")
+
+    def test_json_encoder_default(self):
+        api = self.mk_api()
+        self.assertEqual(api.formats[0].dumps, json.dumps)
+
+    def test_init_invalid_stream_limit(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "max_concurrent_streams_per_owner": 0,
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err),
+            "Field 'max_concurrent_streams_per_owner' must be at least 1")
+
+    def test_init_negative_slow_request_threshold(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "slow_request_threshold": -1,
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err), "Field 'slow_request_threshold' must not be negative")
+
+    def test_slow_request_threshold(self):
+        self.assertEqual(self.mk_api().slow_request_threshold, None)
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "slow_request_threshold": 0.5,
+        })
+        api = ContactsApi(configfile)
+        self.assertEqual(api.slow_request_threshold, 0.5)
+
+    def test_init_profile_token_without_dir(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "profile_token": "secret",
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err),
+            "Field 'profile_dir' is required if 'profile_token' is set")
+
+    def test_init_invalid_profile_sample_rate(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "profile_sample_rate": 1.5,
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err), "Field 'profile_sample_rate' must be between 0 and 1")
+
+    def test_profiler_default(self):
+        self.assertEqual(self.mk_api().profiler, None)
+
+    def test_profiler_config(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "profile_token": "secret",
+            "profile_dir": "/tmp/profiles",
+            "profile_sample_rate": 0.5,
+        })
+        profiler = ContactsApi(configfile).profiler
+        self.assertEqual(profiler.token, "secret")
+        self.assertEqual(profiler.profile_dir, "/tmp/profiles")
+        self.assertEqual(profiler.sample_rate, 0.5)
+
+    def test_init_invalid_trace_exporter(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "trace_exporter": "foo",
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err),
+            "Unknown trace exporter 'foo', must be one of: file, memory or "
+            "the dotted name of an exporter class")
+
+    def test_init_invalid_riak_manager_class(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "riak_manager_class": "foo",
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err),
+            "Unknown Riak manager 'foo', must be one of: memory, riak or the "
+            "dotted name of a manager class")
+
+    @inlineCallbacks
+    def test_memory_riak_manager(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+                "latency": {"load": 0.01},
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "riak_manager_class": "memory",
+        })
+        api = ContactsApi(configfile)
+        manager = api.contact_backend.riak_manager
+        self.assertTrue(isinstance(manager, InMemoryRiakManager))
+        self.assertIdentical(api.group_backend.riak_manager, manager)
+        self.assertEqual(manager.latency, {"load": 0.01})
+        code, contact = yield self.request(
+            api, "POST", "/contacts/", body=json.dumps({"msisdn": "+12345"}))
+        self.assertEqual(code, 200)
+        code, data = yield self.request(
+            api, "GET", "/contacts/%s" % (contact["key"],))
+        self.assertEqual(code, 200)
+        self.assertEqual(data, contact)
+
+    def test_riak_manager_class_by_name(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "riak_manager_class":
+                "go_contacts.backends.memory.InMemoryRiakManager",
+        })
+        api = ContactsApi(configfile)
+        self.assertTrue(isinstance(
+            api.contact_backend.riak_manager, InMemoryRiakManager))
+
+    def test_init_file_trace_exporter_without_file(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "trace_exporter": "file",
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err),
+            "Field 'trace_file' is required for the 'file' trace exporter")
+
+    def test_tracer_default(self):
+        self.assertEqual(self.mk_api().tracer, None)
+
+    @inlineCallbacks
+    def test_traced_request(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "trace_exporter": "memory",
+            "trace_sample_rate": 0.5,
+        })
+        api = ContactsApi(configfile)
+        self.assertEqual(api.tracer.sample_rate, 0.5)
+        contact = yield self.create_contact(api, msisdn=u"+12345")
+        code, data = yield self.request(
+            api, "GET", '/contacts/%s' % (contact["key"],),
+            headers={"X-Trace-Id": "trace-1"})
+        self.assertEqual(code, 200)
+        [spans] = api.tracer.exporter.traces
+        names = [span["name"] for span in spans]
+        self.assertEqual(names[-1], "GET /contacts/%s" % (contact["key"],))
+        self.assertTrue("get" in names)
+        self.assertTrue("riak.load" in names)
+
+    def test_stream_limiter_config(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "max_concurrent_streams": 20,
+            "max_concurrent_streams_per_owner": 2,
+            "stream_wait_timeout": 1.5,
+            "stream_retry_after": 10,
+        })
+        limiter = ContactsApi(configfile).stream_limiter
+        self.assertEqual(limiter.max_streams, 20)
+        self.assertEqual(limiter.max_streams_per_owner, 2)
+        self.assertEqual(limiter.wait_timeout, 1.5)
+        self.assertEqual(limiter.retry_after, 10)
+
+    def test_stream_limiter_default(self):
+        limiter = self.mk_api().stream_limiter
+        self.assertEqual(limiter.max_streams, None)
+        self.assertEqual(limiter.max_streams_per_owner, None)
+        self.assertEqual(limiter.wait_timeout, 0)
+
+    def test_riak_scheduler_default(self):
+        api = self.mk_api()
+        self.assertEqual(api.riak_scheduler, None)
+
+    def test_riak_scheduler_config(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "riak_interactive_concurrency": 4,
+            "riak_bulk_concurrency": 8,
+        })
+        api = ContactsApi(configfile)
+        self.assertEqual(api.riak_scheduler.limits, {
+            INTERACTIVE: 4,
+            BULK: 8,
+        })
+
+    def test_single_flight_default(self):
+        api = self.mk_api()
+        self.assertEqual(api.single_flight.max_waiters, 100)
+        self.assertTrue(
+            api.contact_backend.single_flight is api.single_flight)
+        self.assertTrue(api.group_backend.single_flight is api.single_flight)
+
+    def test_single_flight_disabled(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "coalesce_reads": False,
+        })
+        api = ContactsApi(configfile)
+        self.assertEqual(api.single_flight, None)
+        self.assertEqual(api.contact_backend.single_flight, None)
+
+    def test_init_smart_group_refresh_without_max_age(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "smart_group_write_refresh_delay": 1,
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err),
+            "Field 'smart_group_max_age' is required if "
+            "'smart_group_write_refresh_delay' is set")
+
+    def test_init_invalid_smart_group_refresh_interval(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "smart_group_max_age": 60,
+            "smart_group_refresh_interval": 0,
+        })
+        err = self.assertRaises(ConfigError, ContactsApi, configfile)
+        self.assertEqual(
+            str(err),
+            "Field 'smart_group_refresh_interval' must be greater than 0")
+
+    def test_smart_group_memberships_default(self):
+        api = self.mk_api()
+        self.assertEqual(api.smart_group_memberships, None)
+        self.assertEqual(api.contact_backend.memberships, None)
+        self.assertEqual(api.contactsforgroup_backend.memberships, None)
+
+    def test_smart_group_memberships_config(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "smart_group_max_age": 60,
+            "smart_group_refresh_interval": 30,
+            "smart_group_write_refresh_delay": 5,
+            "smart_group_max_groups": 50,
+        })
+        api = ContactsApi(configfile)
+        memberships = api.smart_group_memberships
+        self.add_cleanup(memberships.stop)
+        self.assertEqual(memberships.max_age, 60)
+        self.assertEqual(memberships.refresh_interval, 30)
+        self.assertEqual(memberships.write_refresh_delay, 5)
+        self.assertEqual(memberships.max_groups, 50)
+        self.assertTrue(api.contact_backend.memberships is memberships)
+        self.assertTrue(
+            api.contactsforgroup_backend.memberships is memberships)
+
+    @inlineCallbacks
+    def test_scheduled_requests(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "riak_interactive_concurrency": 1,
+            "riak_bulk_concurrency": 1,
+        })
+        api = ContactsApi(configfile)
+        code, data = yield self.request(
+            api, "GET", '/contacts/?stream=true', parser="json_lines")
+        self.assertEqual(code, 200)
+        code, data = yield self.request(
+            api, "GET", '/contacts/?max_results=5')
+        self.assertEqual(code, 200)
+        dispatched = api.riak_scheduler.dispatched
+        self.assertTrue(dispatched[BULK] > 0)
+        self.assertTrue(dispatched[INTERACTIVE] > 0)
+
+    @inlineCallbacks
+    def test_stream_slot_released(self):
+        api = self.mk_api()
+        code, data = yield self.request(
+            api, "GET", '/contacts/?stream=true', parser="json_lines")
+        self.assertEqual(code, 200)
+        self.assertEqual(api.stream_limiter.admitted, 1)
+        self.assertEqual(api.stream_limiter.active, 0)
+
+    def test_riak_stats_headers_default(self):
+        api = self.mk_api()
+        self.assertEqual(api.riak_stats_headers, False)
+
+    def test_riak_stats_max_owners(self):
+        api = self.mk_api()
+        self.assertEqual(api.riak_stats.max_owner_totals, 10000)
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "riak_stats_max_owners": 5,
+        })
+        api = ContactsApi(configfile)
+        self.assertEqual(api.riak_stats.max_owner_totals, 5)
+
+    @inlineCallbacks
+    def test_riak_stats_recorded(self):
+        api = self.mk_api()
+        contact = yield self.create_contact(api, msisdn=u"+12345")
+        code, data = yield self.request(
+            api, "GET", '/contacts/%s' % (contact["key"],))
+        self.assertEqual(code, 200)
+        [totals] = api.riak_stats.get_totals()
+        self.assertEqual(totals["route"], "/contacts/:elem_id")
+        self.assertEqual(totals["owner_id"], self.OWNER_ID)
+        self.assertEqual(totals["requests"], 1)
+        self.assertEqual(totals["gets"], 1)
+        self.assertEqual(totals["writes"], 0)
+
+    @inlineCallbacks
+    def test_riak_stats_headers(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "riak_stats_headers": True,
+        })
+        api = ContactsApi(configfile)
+        contact = yield self.create_contact(api, msisdn=u"+12345")
+        resp = yield AppHelper(app=api).get(
+            '/contacts/%s' % (contact["key"],),
+            headers={"X-Owner-ID": self.OWNER_ID.encode("utf-8")})
+        yield resp.content()
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.headers.getRawHeaders('X-Riak-Gets'), ['1'])
+        self.assertEqual(
+            resp.headers.getRawHeaders('X-Riak-Writes'), ['0'])
+        self.assertTrue(resp.headers.hasHeader('X-Riak-Time'))
+
+    @inlineCallbacks
+    def test_metrics(self):
+        api = self.mk_api()
+        code, data = yield self.request(api, "GET", '/contacts/')
+        self.assertEqual(code, 200)
+        resp = yield AppHelper(app=api).get('/metrics/')
+        content = yield resp.content()
+        self.assertEqual(resp.code, 200)
+        self.assertTrue(
+            'contacts_api_responses_total'
+            '{route="/contacts/",method="page",status="200"} 1'
+            in content.splitlines())
+
+    def test_metrics_disabled(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_groups_per_page": 10,
+            "max_contacts_per_page": 10,
+            "metrics_enabled": False,
+        })
+        api = ContactsApi(configfile)
+        self.assertEqual(api.metrics, None)
+        self.assertFalse(any(
+            spec.handler_class is MetricsHandler
+            for spec in api.handlers[0][1]))
+
     def test_collections(self):
         api = self.mk_api()
         self.assertEqual(api.collections, (
@@ -94,8 +546,7 @@ class TestApiServer(object):
 class TestContactsApi(VumiTestCase, ContactsApiTestMixin,
                       TestApiServer):
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
 
     def mk_config(self, config_dict):
         tempfile = self.mktemp()
@@ -169,8 +620,9 @@ class TestContactsApi(VumiTestCase, ContactsApiTestMixin,
         })
         api = ContactsApi(configfile)
         self.assertTrue(isinstance(api.contact_backend, RiakContactsBackend))
-        self.assertTrue(isinstance(api.contact_backend.riak_manager,
-                                   TxRiakManager))
+        self.assertTrue(isinstance(
+            api.contact_backend.riak_manager,
+            self.persistence_helper.riak_manager_class))
 
 
 class TestFakeContactsApi(VumiTestCase, ContactsApiTestMixin):
@@ -219,8 +671,7 @@ class TestFakeContactsApi(VumiTestCase, ContactsApiTestMixin):
 
 class TestGroupsApi(VumiTestCase, GroupsApiTestMixin):
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
 
     def mk_config(self, config_dict):
         tempfile = self.mktemp()
@@ -298,8 +749,9 @@ class TestGroupsApi(VumiTestCase, GroupsApiTestMixin):
         })
         api = ContactsApi(configfile)
         self.assertTrue(isinstance(api.group_backend, RiakGroupsBackend))
-        self.assertTrue(isinstance(api.group_backend.riak_manager,
-                                   TxRiakManager))
+        self.assertTrue(isinstance(
+            api.group_backend.riak_manager,
+            self.persistence_helper.riak_manager_class))
 
 
 class TestFakeGroupsApi(VumiTestCase, GroupsApiTestMixin):
@@ -348,8 +800,7 @@ class TestFakeGroupsApi(VumiTestCase, GroupsApiTestMixin):
 
 class TestContactsForGroupApi(VumiTestCase, ContactsForGroupApiTestMixin):
     def setUp(self):
-        self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=False))
+        self.persistence_helper = self.add_helper(ContactsPersistenceHelper())
 
     def mk_config(self, config_dict):
         tempfile = self.mktemp()
@@ -409,6 +860,104 @@ class TestContactsForGroupApi(VumiTestCase, ContactsForGroupApiTestMixin):
         contact = yield self._store(api).new_contact(**contact_data)
         returnValue(contact_to_dict(contact))
 
+    @inlineCallbacks
+    def mk_membership_api(self):
+        configfile = self.mk_config({
+            "riak_manager": {
+                "bucket_prefix": "test",
+            },
+            "max_contacts_per_page": 10,
+            "max_groups_per_page": 10,
+            "smart_group_max_age": 60,
+        })
+        api = ContactsApi(configfile)
+        yield self._store(api).contacts.enable_search()
+        returnValue(api)
+
+    @inlineCallbacks
+    def get_with_headers(self, api, path):
+        resp = yield AppHelper(app=api).get(
+            path, headers={"X-Owner-ID": self.OWNER_ID.encode("utf-8")})
+        content = yield resp.content()
+        returnValue((resp, content))
+
+    @inlineCallbacks
+    def read_pages(self, api, path):
+        """
+        Page through a group's contacts, returning their keys and whether
+        each page had an X-Smart-Group-Age header.
+        """
+        keys, ages = [], []
+        cursor = None
+        while True:
+            page_path = path
+            if cursor is not None:
+                page_path += '&cursor=%s' % (cursor,)
+            resp, content = yield self.get_with_headers(api, page_path)
+            self.assertEqual(resp.code, 200)
+            page = json.loads(content)
+            keys.extend(c["key"] for c in page["data"])
+            ages.append(resp.headers.hasHeader('X-Smart-Group-Age'))
+            cursor = page["cursor"]
+            if cursor is None:
+                returnValue((keys, ages))
+
+    @inlineCallbacks
+    def test_smart_group_page_from_membership(self):
+        api = yield self.mk_membership_api()
+        contacts = []
+        for i in range(3):
+            contact = yield self.create_contact(
+                api, name=u"Jane", msisdn=u"+1234%d" % (i,))
+            contacts.append(contact)
+        yield self.create_contact(api, name=u"John", msisdn=u"+12349")
+        group = yield self.create_group(api, u"Janes", query=u"name:Jane")
+        path = '/groups/%s/contacts?max_results=2' % (group["key"],)
+        expected = sorted(c["key"] for c in contacts)
+
+        # The group's contacts are searched for until its membership has
+        # been refreshed in the background.
+        keys, ages = yield self.read_pages(api, path)
+        self.assertEqual(sorted(keys), expected)
+        self.assertEqual(ages, [False, False, False, False])
+        yield api.smart_group_memberships.refresh(
+            self._store(api), group["key"], group["query"])
+
+        # The first page holds the group's static contacts.
+        keys, ages = yield self.read_pages(api, path)
+        self.assertEqual(sorted(keys), expected)
+        self.assertEqual(ages, [False, True, True])
+        self.assertEqual(api.smart_group_memberships.hits, 2)
+
+    @inlineCallbacks
+    def test_smart_group_stream_from_membership(self):
+        api = yield self.mk_membership_api()
+        contact = yield self.create_contact(
+            api, name=u"Jane", msisdn=u"+12345")
+        group = yield self.create_group(api, u"Janes", query=u"name:Jane")
+        path = '/groups/%s/contacts?stream=true' % (group["key"],)
+        resp, content = yield self.get_with_headers(api, path)
+        self.assertEqual(resp.code, 200)
+        self.assertFalse(resp.headers.hasHeader('X-Smart-Group-Age'))
+        yield api.smart_group_memberships.refresh(
+            self._store(api), group["key"], group["query"])
+
+        resp, content = yield self.get_with_headers(api, path)
+        self.assertEqual(resp.code, 200)
+        self.assertTrue(resp.headers.hasHeader('X-Smart-Group-Age'))
+        self.assertEqual(
+            [json.loads(l)["key"] for l in content.splitlines()],
+            [contact["key"]])
+
+    @inlineCallbacks
+    def test_static_group_without_membership_age(self):
+        api = yield self.mk_membership_api()
+        group = yield self.create_group(api, u"Static")
+        resp, content = yield self.get_with_headers(
+            api, '/groups/%s/contacts' % (group["key"],))
+        self.assertEqual(resp.code, 200)
+        self.assertFalse(resp.headers.hasHeader('X-Smart-Group-Age'))
+
     def test_init(self):
         configfile = self.mk_config({
             "riak_manager": {
@@ -419,8 +968,9 @@ class TestContactsForGroupApi(VumiTestCase, ContactsForGroupApiTestMixin):
         })
         api = ContactsApi(configfile)
         self.assertTrue(isinstance(api.group_backend, RiakGroupsBackend))
-        self.assertTrue(isinstance(api.group_backend.riak_manager,
-                                   TxRiakManager))
+        self.assertTrue(isinstance(
+            api.group_backend.riak_manager,
+            self.persistence_helper.riak_manager_class))
 
 
 class TestFakeContactsForGroupApi(VumiTestCase, ContactsForGroupApiTestMixin):
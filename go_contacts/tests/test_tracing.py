@@ -0,0 +1,182 @@
+"""
+Tests for go_contacts.tracing.
+"""
+
+import json
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.tracing import (
+    Tracer, InMemoryExporter, FileExporter, TracedModel, get_trace_exporter)
+
+
+class TestTracer(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.exporter = InMemoryExporter()
+        self.random_values = []
+
+    def random(self):
+        if not self.random_values:
+            return 0
+        return self.random_values.pop(0)
+
+    def mk_tracer(self, **kw):
+        return Tracer(
+            self.exporter, clock=self.clock.seconds, random=self.random, **kw)
+
+    def test_trace(self):
+        root = self.mk_tracer().start_trace("GET /contacts/", route="r")
+        self.clock.advance(1)
+        child = root.child("page", cursor=None)
+        self.clock.advance(2)
+        child.finish()
+        self.assertEqual(self.exporter.traces, [])
+        root.finish(status=200)
+        [spans] = self.exporter.traces
+        [child_dict, root_dict] = spans
+        self.assertEqual(root_dict, {
+            'trace_id': root.trace.trace_id,
+            'span_id': root.span_id,
+            'parent_id': None,
+            'name': "GET /contacts/",
+            'start': 0,
+            'duration': 3,
+            'attributes': {'route': "r", 'status': 200},
+        })
+        self.assertEqual(child_dict, {
+            'trace_id': root.trace.trace_id,
+            'span_id': child.span_id,
+            'parent_id': root.span_id,
+            'name': "page",
+            'start': 1,
+            'duration': 2,
+            'attributes': {'cursor': None},
+        })
+
+    def test_incoming_trace_id(self):
+        tracer = self.mk_tracer(sample_rate=0)
+        root = tracer.start_trace("GET", trace_id="abc", parent_id="def")
+        self.assertEqual(root.trace.trace_id, "abc")
+        self.assertEqual(root.parent_id, "def")
+
+    def test_sample_rate(self):
+        tracer = self.mk_tracer(sample_rate=0.5)
+        self.random_values = [0.5, 0.25]
+        self.assertEqual(tracer.start_trace("GET"), None)
+        self.assertNotEqual(tracer.start_trace("GET"), None)
+
+    def test_finish_twice(self):
+        root = self.mk_tracer().start_trace("GET")
+        root.finish()
+        root.finish(status=500)
+        self.assertEqual(len(self.exporter.traces), 1)
+        self.assertEqual(root.attributes, {})
+
+    def test_max_spans(self):
+        root = self.mk_tracer(max_spans=3).start_trace("GET")
+        for i in range(4):
+            root.child("riak.load").finish()
+        root.finish()
+        [spans] = self.exporter.traces
+        self.assertEqual(len(spans), 3)
+        self.assertEqual(spans[-1]['attributes'], {'dropped_spans': 2})
+
+    def test_error(self):
+        root = self.mk_tracer().start_trace("GET")
+        d = Deferred().addBoth(root.finish_with)
+        d.errback(ValueError("Bad"))
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(root.attributes, {'error': "Bad"})
+
+    def test_export_error(self):
+        def export(spans):
+            raise ValueError("Export failed")
+        self.exporter.export = export
+        root = self.mk_tracer().start_trace("GET")
+        root.finish()
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(err.getErrorMessage(), "Export failed")
+
+
+class TestExporters(VumiTestCase):
+    def test_file_exporter(self):
+        path = self.mktemp()
+        exporter = get_trace_exporter('file', path=path)
+        self.assertTrue(isinstance(exporter, FileExporter))
+        exporter.export([{'name': 'a'}, {'name': 'b'}])
+        exporter.export([{'name': 'c'}])
+        exporter.close()
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual(spans, [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}])
+
+    def test_memory_exporter(self):
+        exporter = get_trace_exporter('memory')
+        self.assertTrue(isinstance(exporter, InMemoryExporter))
+
+    def test_dotted_name(self):
+        exporter = get_trace_exporter('go_contacts.tracing.InMemoryExporter')
+        self.assertTrue(isinstance(exporter, InMemoryExporter))
+
+    def test_unknown(self):
+        err = self.assertRaises(ValueError, get_trace_exporter, 'foo')
+        self.assertEqual(
+            str(err),
+            "Unknown trace exporter 'foo', must be one of: file, memory or "
+            "the dotted name of an exporter class")
+
+
+class DummyCollection(object):
+    name = "dummy"
+
+    def __init__(self):
+        self.fill_d = Deferred()
+
+    def page(self, cursor, max_results, query):
+        return succeed((None, []))
+
+    def stream(self, query):
+        return self
+
+    def get(self, object_id):
+        raise ValueError("Bad key")
+
+
+class TestTracedModel(VumiTestCase):
+    def setUp(self):
+        self.exporter = InMemoryExporter()
+        self.root = Tracer(self.exporter).start_trace("GET")
+        self.model = TracedModel(DummyCollection(), self.root)
+
+    def span_names(self):
+        self.root.finish()
+        [spans] = self.exporter.traces
+        return [span['name'] for span in spans]
+
+    def test_untraced_attribute(self):
+        self.assertEqual(self.model.name, "dummy")
+
+    def test_page(self):
+        d = self.model.page(None, 5, None)
+        self.assertEqual(self.successResultOf(d), (None, []))
+        self.assertEqual(self.root.trace.current, self.root)
+        self.assertEqual(self.span_names(), ["page", "GET"])
+
+    def test_stream_lasts_until_filled(self):
+        q = self.successResultOf(self.model.stream(None))
+        stream_span = self.root.trace.current
+        self.assertEqual(stream_span.name, "stream")
+        self.assertFalse(stream_span.finished)
+        q.fill_d.callback(None)
+        self.assertTrue(stream_span.finished)
+        self.assertEqual(self.root.trace.current, self.root)
+
+    def test_error(self):
+        self.failureResultOf(self.model.get("key"), ValueError)
+        self.root.finish()
+        [spans] = self.exporter.traces
+        self.assertEqual(spans[0]['attributes'], {'error': "Bad key"})
@@ -0,0 +1,629 @@
+"""
+Tests for the parts of the verified fake that have no equivalent in the API
+it is faking.
+"""
+
+import json
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.web.client import (
+    Agent, FileBodyProducer, ResponseFailed, readBody)
+from twisted.web.http_headers import Headers
+
+from vumi.tests.helpers import VumiTestCase
+
+from go_contacts.backends.search import compile_query
+
+
+def import_fake():
+    try:
+        import fake_go_contacts
+    except ImportError as err:
+        if "fake_go_contacts" not in err.args[0]:
+            raise
+        raise ImportError(" ".join([
+            err.args[0],
+            "(install from pypi or the 'verified-fake' directory)"]))
+    return fake_go_contacts
+
+
+class TestFakeContactsIndexes(VumiTestCase):
+    def setUp(self):
+        self.fake = import_fake()
+        self.api = self.fake.FakeContactsApi("", "token-1")
+        self.contacts = self.api.contacts
+
+    def keys(self, contacts):
+        return [contact[u"key"] for contact in contacts]
+
+    def test_contacts_data_not_shared(self):
+        self.contacts.create_contact({u"msisdn": u"+1"})
+        other_api = self.fake.FakeContactsApi("", "token-1")
+        self.assertEqual(other_api.contacts.contacts_data, {})
+        self.assertEqual(other_api.groups.groups_data, {})
+
+    def test_initial_data_indexed(self):
+        contact = self.fake.FakeContactsApi.make_contact_dict(
+            {u"key": u"c1", u"msisdn": u"+1", u"groups": [u"g1"]})
+        api = self.fake.FakeContactsApi("", "token-1", {u"c1": contact})
+        self.assertEqual(
+            self.keys(api.contacts.get_contacts_by_field("msisdn", u"+1")),
+            [u"c1"])
+        self.assertEqual(
+            self.keys(api.contacts.get_contacts_in_group(u"g1")), [u"c1"])
+
+    def test_create_contact(self):
+        c1 = self.contacts.create_contact(
+            {u"msisdn": u"+1", u"groups": [u"g1", u"g2"]})
+        c2 = self.contacts.create_contact(
+            {u"msisdn": u"+1", u"groups": [u"g1"]})
+        self.assertEqual(
+            self.keys(self.contacts.get_contacts_by_field("msisdn", u"+1")),
+            sorted([c1[u"key"], c2[u"key"]]))
+        self.assertEqual(
+            self.keys(self.contacts.get_contacts_in_group(u"g2")),
+            [c1[u"key"]])
+
+    def test_update_contact(self):
+        contact = self.contacts.create_contact(
+            {u"msisdn": u"+1", u"groups": [u"g1"]})
+        self.contacts.update_contact(
+            contact[u"key"], {u"msisdn": u"+2", u"groups": [u"g2"]})
+        self.assertEqual(
+            self.contacts.get_contacts_by_field("msisdn", u"+1"), [])
+        self.assertEqual(
+            self.keys(self.contacts.get_contacts_by_field("msisdn", u"+2")),
+            [contact[u"key"]])
+        self.assertEqual(self.contacts.get_contacts_in_group(u"g1"), [])
+        self.assertEqual(
+            self.keys(self.contacts.get_contacts_in_group(u"g2")),
+            [contact[u"key"]])
+
+    def test_delete_contact(self):
+        contact = self.contacts.create_contact(
+            {u"msisdn": u"+1", u"groups": [u"g1"]})
+        self.contacts.delete_contact(contact[u"key"])
+        self.assertEqual(
+            self.contacts.get_contacts_by_field("msisdn", u"+1"), [])
+        self.assertEqual(self.contacts.get_contacts_in_group(u"g1"), [])
+        self.assertEqual(self.contacts.indexes.by_group, {})
+
+    def test_unindexed_field(self):
+        contact = self.contacts.create_contact({u"name": u"Jane"})
+        self.contacts.create_contact({u"name": u"John"})
+        self.assertEqual(
+            self.keys(self.contacts.get_contacts_by_field("name", u"Jane")),
+            [contact[u"key"]])
+        self.assertRaises(
+            KeyError, self.contacts.get_contacts_by_field, "foo", u"Jane")
+
+    def test_add_contacts(self):
+        self.contacts.add_contacts([
+            {u"key": u"c1", u"msisdn": u"+1", u"groups": [u"g1"]},
+            {u"key": u"c2", u"msisdn": u"+2"},
+        ])
+        self.assertEqual(sorted(self.contacts.contacts_data), [u"c1", u"c2"])
+        self.assertEqual(
+            self.keys(self.contacts.get_contacts_by_field("msisdn", u"+2")),
+            [u"c2"])
+        self.assertEqual(
+            self.keys(self.contacts.get_contacts_in_group(u"g1")), [u"c1"])
+        self.assertEqual(list(self.contacts.sorted_keys), [u"c1", u"c2"])
+
+    def test_add_groups(self):
+        self.api.groups.add_groups([{u"key": u"g2"}, {u"key": u"g1"}])
+        self.assertEqual(list(self.api.groups.sorted_keys), [u"g1", u"g2"])
+
+    def test_reindex(self):
+        contact = self.contacts.create_contact({u"msisdn": u"+1"})
+        contact[u"msisdn"] = u"+2"
+        self.contacts.reindex()
+        self.assertEqual(
+            self.keys(self.contacts.get_contacts_by_field("msisdn", u"+2")),
+            [contact[u"key"]])
+
+
+class TestSearchQuery(VumiTestCase):
+    QUERIES = [
+        u"msisdn:+1",
+        u"msisdn:\\+1",
+        u"name:jane",
+        u"name:J*",
+        u"name:J?ne",
+        u"name:\"Jane Doe\"",
+        u"name:'jane doe' OR surname:Smith",
+        u"name:Jane AND surname:Smith",
+        u"name:Jane && NOT surname:Smith",
+        u"name:Jane -surname:Smith",
+        u"name:Jane surname:Smith",
+        u"(name:Jane || name:John) AND extras-city:Cape*",
+        u"extras-city:\"Cape Town\"",
+        u"subscription-news:yes",
+        u"groups:g1",
+        u"Smith",
+        u"NOT name:*",
+        u"foo:bar",
+        u"name:J* NOT surname:Smith",
+        u"+name:john surname:Smith",
+        u"-surname:Smith",
+    ]
+
+    def setUp(self):
+        self.fake = import_fake()
+        self.api = self.fake.FakeContactsApi("", "token-1")
+        self.contacts = self.api.contacts
+        for fields in [
+                {u"name": u"Jane", u"surname": u"Smith", u"msisdn": u"+1",
+                 u"extra": {u"city": u"Cape Town"}, u"groups": [u"g1"]},
+                {u"name": u"Jane Doe", u"msisdn": u"+2",
+                 u"subscription": {u"news": u"yes"}},
+                {u"name": u"John", u"surname": u"Smith",
+                 u"extra": {u"city": u"Cairo"}, u"groups": [u"g1", u"g2"]},
+                {u"name": u"john", u"extra": {u"city": u"Cape Point"}},
+                {u"surname": u"Jones"}]:
+            self.contacts.create_contact(fields)
+        self.by_name = dict(
+            (contact[u"name"] or contact[u"surname"], key)
+            for key, contact in self.contacts.contacts_data.iteritems())
+
+    def riak_data(self, contact):
+        data = dict(
+            (key, value) for key, value in contact.iteritems()
+            if key not in (u"key", u"extra", u"subscription"))
+        for name, value in contact[u"extra"].iteritems():
+            data[u"extras-%s" % (name,)] = value
+        for name, value in contact[u"subscription"].iteritems():
+            data[u"subscription-%s" % (name,)] = value
+        return data
+
+    def assert_matches_search(self, query):
+        matcher = compile_query(query)
+        expected = set(
+            key for key, contact in self.contacts.contacts_data.iteritems()
+            if matcher(self.riak_data(contact)))
+        self.assertEqual(
+            self.contacts.search_keys(query), expected,
+            "Fake results differ for %r" % (query,))
+
+    def assert_search_keys(self, query, names):
+        self.assertEqual(
+            self.contacts.search_keys(query),
+            set(self.by_name[name] for name in names),
+            "Unexpected results for %r" % (query,))
+
+    def test_prohibited_and_required_clauses(self):
+        self.assert_search_keys(u"name:Jane -surname:Smith", [])
+        self.assert_search_keys(u"name:Jane && NOT surname:Smith", [])
+        self.assert_search_keys(u"name:Jane* -surname:Smith", [u"Jane Doe"])
+        self.assert_search_keys(
+            u"name:J* NOT surname:Smith", [u"Jane Doe", u"john"])
+        self.assert_search_keys(
+            u"+name:john surname:Smith", [u"John", u"john"])
+        self.assert_search_keys(u"+name:Jane +surname:Smith", [u"Jane"])
+        self.assert_search_keys(
+            u"-surname:Smith", [u"Jane Doe", u"john", u"Jones"])
+        self.assert_search_keys(
+            u"-surname:Smith -name:john", [u"Jane Doe", u"Jones"])
+
+    def test_matches_search(self):
+        for query in self.QUERIES:
+            self.assert_matches_search(query)
+
+    def test_matches_search_after_updates(self):
+        for contact in self.contacts.contacts_data.values():
+            if contact[u"name"] == u"John":
+                self.contacts.update_contact(contact[u"key"], {
+                    u"name": u"Jane", u"extra": {u"city": u"Cape Town"}})
+            if contact[u"surname"] == u"Jones":
+                self.contacts.delete_contact(contact[u"key"])
+        for query in self.QUERIES:
+            self.assert_matches_search(query)
+
+    def test_search(self):
+        contacts = self.contacts.search(u"extras-city:cape*")
+        keys = [contact[u"key"] for contact in contacts]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(
+            sorted(contact[u"extra"][u"city"] for contact in contacts),
+            [u"Cape Point", u"Cape Town"])
+
+    def test_invalid_queries(self):
+        for query in [u"", u"name:", u"(name:Jane", u"name:'Jane",
+                      u"name:Jane AND", u"name:Jane)"]:
+            err = self.assertRaises(
+                self.fake.FakeContactsError, self.contacts.search_keys, query)
+            self.assertEqual(err.code, 400)
+
+    def test_smart_group(self):
+        group = self.api.groups.create_group({
+            u"name": u"Capetonians",
+            u"query": u"extras-city:\"cape town\" OR extras-city:cape\\ p*",
+        })
+        self.api.groups.fake_contacts = self.contacts
+        stream = self.api.groups.get_contacts_for_group_stream(
+            None, group[u"key"])
+        self.assertEqual(
+            sorted(contact[u"name"] for contact in stream),
+            [u"Jane", u"john"])
+
+
+class TestSnapshots(VumiTestCase):
+    def setUp(self):
+        self.fake = import_fake()
+        self.api = self.fake.FakeContactsApi("", "token-1")
+
+    def keys(self, contacts):
+        return [contact[u"key"] for contact in contacts]
+
+    def test_round_trip(self):
+        group = self.api.groups.create_group({u"name": u"Friends"})
+        contact = self.api.contacts.create_contact(
+            {u"msisdn": u"+1", u"groups": [group[u"key"]]})
+        path = self.mktemp()
+        self.api.save_snapshot(path)
+
+        loaded = self.fake.FakeContactsApi("", "token-1")
+        loaded.load_snapshot(path)
+        self.assertEqual(loaded.contacts.contacts_data, {
+            contact[u"key"]: contact})
+        self.assertEqual(loaded.groups.groups_data, {group[u"key"]: group})
+        self.assertEqual(list(loaded.groups.sorted_keys), [group[u"key"]])
+        self.assertEqual(
+            self.keys(loaded.contacts.get_contacts_by_field("msisdn", u"+1")),
+            [contact[u"key"]])
+        self.assertEqual(
+            self.keys(loaded.contacts.get_contacts_in_group(group[u"key"])),
+            [contact[u"key"]])
+
+    def test_loaded_indexes_maintained(self):
+        contact = self.api.contacts.create_contact({u"msisdn": u"+1"})
+        path = self.mktemp()
+        self.api.save_snapshot(path)
+
+        loaded = self.fake.FakeContactsApi("", "token-1")
+        loaded.load_snapshot(path)
+        loaded.contacts.update_contact(contact[u"key"], {u"msisdn": u"+2"})
+        new_contact = loaded.contacts.create_contact({u"msisdn": u"+2"})
+        self.assertEqual(
+            self.keys(loaded.contacts.get_contacts_by_field("msisdn", u"+2")),
+            sorted([contact[u"key"], new_contact[u"key"]]))
+        self.assertEqual(
+            list(loaded.contacts.sorted_keys),
+            sorted([contact[u"key"], new_contact[u"key"]]))
+        self.assertEqual(
+            self.keys(self.api.contacts.get_contacts_by_field(
+                "msisdn", u"+1")),
+            [contact[u"key"]])
+
+    def test_unsupported_version(self):
+        path = self.mktemp()
+        self.patch(self.fake, "SNAPSHOT_VERSION", 0)
+        self.api.save_snapshot(path)
+        self.patch(self.fake, "SNAPSHOT_VERSION", 1)
+        self.assertRaises(ValueError, self.api.load_snapshot, path)
+
+
+class TestSortedKeys(VumiTestCase):
+    def setUp(self):
+        self.fake = import_fake()
+
+    def test_add_and_discard(self):
+        keys = self.fake.SortedKeys([u"b", u"a"])
+        keys.add(u"c")
+        keys.add(u"a")
+        keys.discard(u"b")
+        keys.discard(u"d")
+        self.assertEqual(list(keys), [u"a", u"c"])
+        self.assertTrue(u"c" in keys)
+        self.assertFalse(u"b" in keys)
+        self.assertEqual(len(keys), 2)
+
+    def test_page_after(self):
+        keys = self.fake.SortedKeys([u"a", u"b", u"c", u"d"])
+        self.assertEqual(keys.page_after(None, 2), [u"a", u"b"])
+        self.assertEqual(keys.page_after(u"b", 2), [u"c", u"d"])
+        self.assertEqual(keys.page_after(u"bb", 5), [u"c", u"d"])
+        self.assertEqual(keys.page_after(u"d", 2), [])
+        self.assertEqual(keys.page_after(u"b", None), [u"c", u"d"])
+
+
+class TestFakePagination(VumiTestCase):
+    def setUp(self):
+        self.fake = import_fake()
+        self.api = self.fake.FakeContactsApi("", "token-1")
+
+    def get_all_pages(self, get_page):
+        items = []
+        cursor = None
+        while True:
+            page = get_page(cursor)
+            items.extend(item[u"key"] for item in page[u"data"])
+            cursor = page[u"cursor"]
+            if cursor is None:
+                return items
+
+    def test_contacts(self):
+        keys = [self.api.contacts.create_contact({})[u"key"]
+                for _ in range(25)]
+        self.api.contacts.delete_contact(keys.pop())
+        paged = self.get_all_pages(
+            lambda cursor: self.api.contacts.get_page_contacts(
+                None, cursor, 10))
+        self.assertEqual(paged, sorted(keys))
+
+    def test_cursor_is_last_key(self):
+        contacts = self.api.contacts
+        keys = sorted(contacts.create_contact({})[u"key"] for _ in range(3))
+        page = contacts.get_page_contacts(None, None, 2)
+        self.assertEqual(page[u"cursor"], keys[1].encode('rot13'))
+
+    def test_groups(self):
+        keys = [self.api.groups.create_group({})[u"key"] for _ in range(25)]
+        paged = self.get_all_pages(
+            lambda cursor: self.api.groups.get_page_groups(None, cursor, 10))
+        self.assertEqual(paged, sorted(keys))
+
+    def test_contacts_for_group(self):
+        groups = self.api.groups
+        groups.fake_contacts = self.api.contacts
+        group = groups.create_group({u"query": u"msisdn:+1"})
+        static_keys = [
+            self.api.contacts.create_contact(
+                {u"groups": [group[u"key"]]})[u"key"]
+            for _ in range(15)]
+        smart_keys = [
+            self.api.contacts.create_contact({u"msisdn": u"+1"})[u"key"]
+            for _ in range(15)]
+        self.api.contacts.create_contact({})
+        paged = self.get_all_pages(
+            lambda cursor: groups.get_contacts_for_group_page(
+                None, group[u"key"], cursor, 10))
+        self.assertEqual(paged, sorted(static_keys) + sorted(smart_keys))
+
+
+class TestFakeStreams(VumiTestCase):
+    def setUp(self):
+        self.fake = import_fake()
+        self.api = self.fake.FakeContactsApi("", "token-1")
+        self.api.groups.fake_contacts = self.api.contacts
+
+    def stream(self, path):
+        return self.api.handle_request(self.fake.Request(
+            "GET", path, headers={"Authorization": "Bearer token-1"}))
+
+    def create_contacts(self, count, **fields):
+        return sorted(
+            self.api.contacts.create_contact(fields)[u"key"]
+            for _ in range(count))
+
+    def test_contacts_streamed(self):
+        keys = self.create_contacts(250)
+        response = self.stream("/contacts/?stream=true")
+        self.assertTrue(response.streaming)
+        contacts = response.iter_data()
+        self.assertEqual(next(contacts)[u"key"], keys[0])
+        self.api.contacts.delete_contact(keys[1])
+        self.api.contacts.delete_contact(keys[200])
+        self.assertEqual(
+            [contact[u"key"] for contact in contacts],
+            keys[2:200] + keys[201:])
+
+    def test_groups_streamed(self):
+        keys = sorted(
+            self.api.groups.create_group({})[u"key"] for _ in range(3))
+        response = self.stream("/groups/?stream=true")
+        self.assertTrue(response.streaming)
+        self.assertEqual([group[u"key"] for group in response.data], keys)
+
+    def test_contacts_for_group_streamed(self):
+        group = self.api.groups.create_group({u"query": u"name:Smart"})
+        smart_keys = self.create_contacts(3, name=u"Smart")
+        static_keys = self.create_contacts(3, groups=[group[u"key"]])
+        response = self.stream("/groups/%s/contacts?stream=true" % (
+            group[u"key"],))
+        contacts = response.iter_data()
+        self.assertEqual(next(contacts)[u"key"], static_keys[0])
+        # The query is only run once the static contacts have been read.
+        smart_keys.extend(self.create_contacts(1, name=u"Smart"))
+        self.assertEqual(
+            [contact[u"key"] for contact in contacts],
+            static_keys[1:] + sorted(smart_keys))
+
+    def test_invalid_smart_query(self):
+        group = self.api.groups.create_group({u"query": u"name:("})
+        response = self.stream("/groups/%s/contacts?stream=true" % (
+            group[u"key"],))
+        self.assertEqual(response.code, 400)
+        self.assertFalse(response.streaming)
+
+    def test_data(self):
+        keys = self.create_contacts(3)
+        response = self.stream("/contacts/?stream=true")
+        self.assertEqual(
+            [contact[u"key"] for contact in response.data], keys)
+        self.assertEqual(json.loads(response.body), response.data)
+        self.assertEqual(list(response.iter_data()), response.data)
+
+    def test_pages_not_streamed(self):
+        response = self.stream("/contacts/")
+        self.assertFalse(response.streaming)
+        self.assertRaises(TypeError, response.iter_data)
+
+
+class TestCursorRegistry(VumiTestCase):
+    def setUp(self):
+        self.fake = import_fake()
+
+    def test_add(self):
+        cursors = self.fake.CursorRegistry()
+        cursors.add("a")
+        cursors.add(None)
+        self.assertTrue("a" in cursors)
+        self.assertFalse("b" in cursors)
+        self.assertFalse(None in cursors)
+        self.assertEqual(len(cursors), 1)
+
+    def test_bounded(self):
+        cursors = self.fake.CursorRegistry(max_cursors=2)
+        for cursor in ["a", "b", "c"]:
+            cursors.add(cursor)
+        self.assertEqual(len(cursors), 2)
+        self.assertFalse("a" in cursors)
+        self.assertTrue("b" in cursors)
+
+    def test_used_cursors_kept(self):
+        cursors = self.fake.CursorRegistry(max_cursors=2)
+        cursors.add("a")
+        cursors.add("b")
+        self.assertTrue("a" in cursors)
+        cursors.add("c")
+        self.assertTrue("a" in cursors)
+        self.assertFalse("b" in cursors)
+
+    def assert_invalid_cursor(self, api, cursor):
+        err = self.assertRaises(
+            self.fake.FakeContactsError,
+            api.contacts.get_page_contacts, None, cursor, 1)
+        self.assertEqual(err.code, 400)
+
+    def test_cursors_per_api(self):
+        api = self.fake.FakeContactsApi("", "token-1")
+        other_api = self.fake.FakeContactsApi("", "token-1")
+        for contacts in [api.contacts, other_api.contacts]:
+            for _ in range(2):
+                contacts.create_contact({})
+        cursor = api.contacts.get_page_contacts(None, None, 1)[u"cursor"]
+        self.assert_invalid_cursor(other_api, cursor)
+        self.assertEqual(len(other_api.cursors), 0)
+        self.assertIdentical(api.groups.cursors, api.cursors)
+
+    def test_no_page_limit(self):
+        api = self.fake.FakeContactsApi(
+            "", "token-1", group_limit=None, contacts_limit=None)
+        contacts = [api.contacts.create_contact({}) for _ in range(15)]
+        for _ in range(15):
+            api.groups.create_group({})
+        page = api.contacts.get_page_contacts(None, None, None)
+        self.assertEqual(page[u"cursor"], None)
+        self.assertEqual(
+            page[u"data"], sorted(contacts, key=lambda c: c[u"key"]))
+        page = api.groups.get_page_groups(None, None, None)
+        self.assertEqual(page[u"cursor"], None)
+        self.assertEqual(len(page[u"data"]), 15)
+        page = api.contacts.get_page_contacts(None, None, 5)
+        self.assertEqual(len(page[u"data"]), 5)
+        self.assertNotEqual(page[u"cursor"], None)
+
+    def test_old_cursors_rejected(self):
+        api = self.fake.FakeContactsApi("", "token-1", max_cursors=1)
+        for _ in range(3):
+            api.contacts.create_contact({})
+        page = api.contacts.get_page_contacts(None, None, 1)
+        api.contacts.get_page_contacts(None, page[u"cursor"], 1)
+        self.assert_invalid_cursor(api, page[u"cursor"])
+
+
+class TestFakeContactsServer(VumiTestCase):
+    def setUp(self):
+        import_fake()
+        import fake_go_contacts_server
+        self.server = fake_go_contacts_server
+        self.api = self.server.FakeContactsApi("", "token-1")
+        self.port = reactor.listenTCP(
+            0, self.server.make_site(self.api, stream_batch_size=2),
+            interface="127.0.0.1")
+        self.add_cleanup(self.port.stopListening)
+        self.agent = Agent(reactor)
+
+    @inlineCallbacks
+    def request(self, method, path, data=None, auth_token="token-1"):
+        headers = Headers({"Authorization": ["Bearer %s" % (auth_token,)]})
+        body = None
+        if data is not None:
+            body = FileBodyProducer(StringIO(json.dumps(data)))
+        url = "http://127.0.0.1:%d%s" % (self.port.getHost().port, path)
+        response = yield self.agent.request(method, url, headers, body)
+        content = yield readBody(response)
+        self.assertEqual(
+            response.headers.getRawHeaders("Content-Type"),
+            ["application/json; charset=utf-8"])
+        response.content = content
+        returnValue(response)
+
+    @inlineCallbacks
+    def test_page(self):
+        contact = self.api.contacts.create_contact({u"msisdn": u"+1"})
+        response = yield self.request("GET", "/contacts/")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            json.loads(response.content),
+            {u"cursor": None, u"data": [contact]})
+
+    @inlineCallbacks
+    def test_stream(self):
+        contacts = sorted(
+            [self.api.contacts.create_contact({}) for _ in range(5)],
+            key=lambda contact: contact[u"key"])
+        response = yield self.request("GET", "/contacts/?stream=true")
+        self.assertEqual(response.code, 200)
+        lines = response.content.splitlines()
+        self.assertEqual(
+            sorted(map(json.loads, lines), key=lambda c: c[u"key"]),
+            contacts)
+
+    @inlineCallbacks
+    def test_stream_error(self):
+        for _ in range(5):
+            self.api.contacts.create_contact({})
+        handle_request = self.api.handle_request
+
+        def handle_failing_request(req):
+            response = handle_request(req)
+            iter_data = response.iter_data
+
+            def failing_iter_data():
+                for i, obj in enumerate(iter_data()):
+                    if i == 3:
+                        raise ValueError("Stream broke")
+                    yield obj
+            response.iter_data = failing_iter_data
+            return response
+        self.patch(self.api, 'handle_request', handle_failing_request)
+
+        url = "http://127.0.0.1:%d/contacts/?stream=true" % (
+            self.port.getHost().port,)
+        response = yield self.agent.request(
+            "GET", url, Headers({"Authorization": ["Bearer token-1"]}))
+        self.assertEqual(response.code, 200)
+        yield self.assertFailure(readBody(response), ResponseFailed)
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(err.getErrorMessage(), "Stream broke")
+
+    @inlineCallbacks
+    def test_create(self):
+        response = yield self.request(
+            "POST", "/contacts/", {u"msisdn": u"+1"})
+        self.assertEqual(response.code, 200)
+        contact = json.loads(response.content)
+        self.assertEqual(
+            self.api.contacts.contacts_data[contact[u"key"]], contact)
+
+    @inlineCallbacks
+    def test_errors(self):
+        response = yield self.request("GET", "/contacts/", auth_token="bad")
+        self.assertEqual(response.code, 403)
+        response = yield self.request("GET", "/foo/")
+        self.assertEqual(response.code, 404)
+        response = yield self.request("GET", "/contacts/missing")
+        self.assertEqual(response.code, 404)
+        self.assertEqual(json.loads(response.content)[u"status_code"], 404)
+
+    def test_read_ndjson(self):
+        path = self.mktemp()
+        with open(path, "w") as f:
+            f.write('{"key": "c1"}\n\n{"key": "c2"}\n')
+        self.assertEqual(
+            list(self.server.read_ndjson(path)),
+            [{u"key": u"c1"}, {u"key": u"c2"}])
@@ -0,0 +1,300 @@
+"""
+Lightweight span-based tracing of requests.
+
+Each traced request gets a :class:`Trace` with a root span covering the
+whole request. The collection method the handler calls (``page``,
+``stream`` and so on) and each Riak call made for the request are recorded
+as child spans. Once the root span finishes, all of the trace's spans are
+handed to an exporter together.
+
+Trace ids are taken from the ``X-Trace-Id`` request header if there is one,
+so that traces can be joined up with the caller's, and returned in the
+``X-Trace-Id`` response header.
+"""
+
+import json
+import random
+import time
+import uuid
+
+from twisted.internet.defer import maybeDeferred
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.reflect import namedAny
+
+
+def new_id(length=32):
+    return uuid.uuid4().hex[:length]
+
+
+class Span(object):
+    """
+    A timed operation within a trace.
+
+    :param Trace trace:
+        The trace the span belongs to.
+    :param str name:
+        The name of the operation.
+    :param str parent_id:
+        The id of the parent span, or ``None`` for a root span without a
+        remote parent.
+    :param dict attributes:
+        Details of the operation.
+    """
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = new_id(16)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = trace.clock()
+        self.duration = None
+
+    @property
+    def finished(self):
+        return self.duration is not None
+
+    def child(self, name, **attributes):
+        """
+        Start a span for an operation within this one.
+        """
+        return Span(self.trace, name, self.span_id, attributes)
+
+    def finish(self, **attributes):
+        """
+        Finish the span, adding any extra attributes. Does nothing if the span
+        has already finished.
+        """
+        if self.finished:
+            return
+        self.attributes.update(attributes)
+        self.duration = self.trace.clock() - self.start
+        self.trace._span_finished(self)
+
+    def finish_with(self, result):
+        """
+        Finish the span with the result of a deferred, recording an ``error``
+        attribute if it is a failure, and return the result.
+        """
+        if isinstance(result, Failure):
+            self.finish(error=result.getErrorMessage())
+        else:
+            self.finish()
+        return result
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+
+
+class Trace(object):
+    """
+    The spans recorded for a single request.
+
+    ``current`` is the span that Riak calls made for the request belong to.
+    It is the root span unless a collection method is running.
+
+    :param str trace_id:
+        The id of the trace.
+    :param int max_spans:
+        The maximum number of spans to keep, including the root span. Further
+        spans are counted in the root span's ``dropped_spans`` attribute.
+    """
+
+    def __init__(self, exporter, trace_id, max_spans, clock):
+        self.exporter = exporter
+        self.trace_id = trace_id
+        self.max_spans = max_spans
+        self.clock = clock
+        self.spans = []
+        self.dropped = 0
+        self.root = None
+        self.current = None
+
+    def start_root(self, name, parent_id=None, **attributes):
+        self.root = self.current = Span(self, name, parent_id, attributes)
+        return self.root
+
+    def _span_finished(self, span):
+        if span is self.root:
+            self.spans.append(span)
+            if self.dropped:
+                span.attributes['dropped_spans'] = self.dropped
+            try:
+                self.exporter.export([s.as_dict() for s in self.spans])
+            except Exception:
+                log.err(None, "Failed to export trace %s" % (self.trace_id,))
+        elif len(self.spans) < self.max_spans - 1:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+
+class Tracer(object):
+    """
+    Starts traces and hands finished traces to an exporter.
+
+    :param exporter:
+        An object with an ``export(spans)`` method, which is called with a
+        list of span dicts (see :meth:`Span.as_dict`) for each finished trace.
+    :param float sample_rate:
+        The fraction of requests without an incoming trace id that are
+        traced. Requests with an incoming trace id are always traced.
+    :param int max_spans:
+        The maximum number of spans kept for a single trace.
+    """
+
+    def __init__(self, exporter, sample_rate=1.0, max_spans=1000,
+                 clock=time.time, random=random.random):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.clock = clock
+        self.random = random
+
+    def start_trace(self, name, trace_id=None, parent_id=None,
+                    **attributes):
+        """
+        Start a trace and return its root span, or ``None`` if the trace
+        isn't sampled.
+
+        :param str trace_id:
+            The incoming trace id, if there is one.
+        :param str parent_id:
+            The incoming parent span id, if there is one.
+        """
+        if trace_id is None:
+            if self.random() >= self.sample_rate:
+                return None
+            trace_id = new_id()
+        trace = Trace(self.exporter, trace_id, self.max_spans, self.clock)
+        return trace.start_root(name, parent_id, **attributes)
+
+
+class InMemoryExporter(object):
+    """
+    Keeps finished traces in memory, for tests.
+    """
+
+    def __init__(self):
+        self.traces = []
+
+    def export(self, spans):
+        self.traces.append(spans)
+
+
+class FileExporter(object):
+    """
+    Appends spans to a file, one JSON object per line.
+
+    :param str path:
+        The file to write to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def export(self, spans):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        for span in spans:
+            self._file.write(json.dumps(span, sort_keys=True) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+TRACE_EXPORTERS = {
+    'memory': InMemoryExporter,
+    'file': FileExporter,
+}
+
+
+def get_trace_exporter_class(name):
+    """
+    Return a trace exporter class.
+
+    :param str name:
+        Either ``memory``, ``file`` or the full dotted name of an exporter
+        class.
+    """
+    exporter_cls = TRACE_EXPORTERS.get(name)
+    if exporter_cls is None:
+        try:
+            exporter_cls = namedAny(name)
+        except (AttributeError, ImportError, ValueError):
+            raise ValueError(
+                "Unknown trace exporter %r, must be one of: %s or the dotted "
+                "name of an exporter class" % (
+                    name, ", ".join(sorted(TRACE_EXPORTERS))))
+    return exporter_cls
+
+
+def get_trace_exporter(name, **options):
+    """
+    Return a trace exporter.
+
+    :param str name:
+        See :func:`get_trace_exporter_class`.
+    :param options:
+        Keyword arguments for the exporter, e.g. ``path`` for the file
+        exporter.
+    """
+    return get_trace_exporter_class(name)(**options)
+
+
+# The collection and model methods that are traced.
+TRACED_METHODS = frozenset([
+    'all_keys', 'stream', 'page', 'get', 'create', 'update', 'delete'])
+
+
+class TracedModel(object):
+    """
+    Wraps a collection or model so that calls to its methods are recorded as
+    children of ``span``.
+
+    The span for ``stream`` lasts until the queue has been filled, rather than
+    until the queue is returned.
+    """
+
+    def __init__(self, model, span):
+        self._model = model
+        self._span = span
+
+    def __getattr__(self, name):
+        attr = getattr(self._model, name)
+        if name not in TRACED_METHODS:
+            return attr
+        return lambda *args, **kw: self._call(name, attr, args, kw)
+
+    def _call(self, name, method, args, kw):
+        trace = self._span.trace
+        span = self._span.child(name)
+        trace.current = span
+
+        def finished(result):
+            if trace.current is span:
+                trace.current = self._span
+            return span.finish_with(result)
+
+        def got_result(result):
+            fill_d = getattr(result, 'fill_d', None)
+            if fill_d is None:
+                return finished(result)
+            fill_d.addBoth(finished)
+            return result
+
+        d = maybeDeferred(method, *args, **kw)
+        return d.addCallbacks(got_result, finished)
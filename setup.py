@@ -18,6 +18,10 @@ setup(
         'vumi-go',
         'confmodel==0.2.0',
     ],
+    extras_require={
+        'msgpack': ['msgpack>=0.5.2'],
+        'ujson': ['ujson'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
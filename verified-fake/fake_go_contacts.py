@@ -6,13 +6,25 @@ is faking, to ensure that the behaviour is the same for both.
 """
 
 
+import cPickle
+import gc
 import json
+import re
+from contextlib import contextmanager
+from types import GeneratorType
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from uuid import uuid4
 from urlparse import urlparse, parse_qs
-import itertools
 import urllib
 
 
+# The version of the snapshot format written by
+# :meth:`FakeContactsApi.save_snapshot`. Snapshots of other versions can't be
+# loaded.
+SNAPSHOT_VERSION = 2
+
+
 class Request(object):
     """
     Representation of an HTTP request.
@@ -28,13 +40,39 @@ class Request(object):
 class Response(object):
     """
     Representation of an HTTP response.
+
+    The data of a streamed response is a generator, which is only run when
+    the response is read. :meth:`iter_data` yields its objects as they are
+    produced, while ``data`` and ``body`` collect them all first.
     """
 
     def __init__(self, code, headers, data):
         self.code = code
         self.headers = headers if headers is not None else {}
-        self.data = data
-        self.body = json.dumps(data)
+        self.streaming = isinstance(data, GeneratorType)
+        self._data = data
+
+    @property
+    def data(self):
+        if isinstance(self._data, GeneratorType):
+            self._data = list(self._data)
+        return self._data
+
+    @property
+    def body(self):
+        return json.dumps(self.data)
+
+    def iter_data(self):
+        """
+        Yield the objects of a streamed response one at a time. A response
+        that isn't streamed can't be iterated over.
+        """
+        if not self.streaming:
+            raise TypeError("Only streamed responses can be iterated over.")
+        if isinstance(self._data, GeneratorType):
+            data, self._data = self._data, []
+            return data
+        return iter(self._data)
 
 
 class FakeContactsError(Exception):
@@ -59,27 +97,144 @@ def _data_to_json(data):
         data = json.dumps(data)
     return json.loads(data)
 
-previous_cursors = []
+
+class CursorRegistry(object):
+    """
+    The cursors handed out by a fake, so that cursors the real API wouldn't
+    accept can be rejected.
+
+    Only the ``max_cursors`` most recently issued or used cursors are kept,
+    so that long-lived fakes don't hold on to every cursor they ever issued.
+    """
+
+    def __init__(self, max_cursors=10000):
+        self.max_cursors = max_cursors
+        self._cursors = OrderedDict()
+
+    def __len__(self):
+        return len(self._cursors)
+
+    def __contains__(self, cursor):
+        if cursor not in self._cursors:
+            return False
+        # Move the cursor to the end, so that the cursors of paginations in
+        # progress aren't the first to be dropped.
+        del self._cursors[cursor]
+        self._cursors[cursor] = None
+        return True
+
+    def add(self, cursor):
+        if cursor is None:
+            return
+        self._cursors.pop(cursor, None)
+        self._cursors[cursor] = None
+        while len(self._cursors) > self.max_cursors:
+            self._cursors.popitem(last=False)
+
+
+class SortedKeys(object):
+    """
+    A sorted set of keys that can be paged through without sorting them.
+    """
+
+    def __init__(self, keys=()):
+        self._keys = sorted(set(keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        i = bisect_left(self._keys, key)
+        return i < len(self._keys) and self._keys[i] == key
+
+    def add(self, key):
+        i = bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            self._keys.insert(i, key)
+
+    def discard(self, key):
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def page_after(self, after, limit):
+        """
+        Return up to ``limit`` keys after ``after``, or from the start if
+        ``after`` is ``None``. All of them are returned if ``limit`` is
+        ``None``.
+        """
+        start = 0 if after is None else bisect_right(self._keys, after)
+        if limit is None:
+            return self._keys[start:]
+        return self._keys[start:start + limit]
 
 
-def _paginate(contact_list, cursor, max_results):
-    contact_list.sort(key=lambda contact: contact['key'])
+def _paginate(keys, get_object, cursors, cursor, max_results):
+    """
+    Return a page of the objects for the :class:`SortedKeys` ``keys`` after
+    ``cursor``, and the cursor for the next page. ``cursor`` must have been
+    issued by the :class:`CursorRegistry` ``cursors``. There is no limit on
+    the size of the page if ``max_results`` is ``None`` or infinite.
+    """
     if cursor is not None:
-        if cursor not in previous_cursors:
+        if cursor not in cursors:
             raise FakeContactsError(
                 400,
                 u"Riak error, possible invalid cursor: %r" % (cursor,))
         # Encoding and decoding are the same operation
         cursor = _encode_cursor(cursor)
-        contact_list = list(itertools.dropwhile(
-            lambda contact: contact['key'] <= cursor, contact_list))
+    max_results = max_results or float('inf')
+    if max_results == float('inf'):
+        page_keys = keys.page_after(cursor, None)
+    else:
+        max_results = int(max_results)
+        page_keys = keys.page_after(cursor, max_results + 1)
     new_cursor = None
-    if len(contact_list) > max_results:
-        contact_list = contact_list[:max_results]
-        new_cursor = contact_list[-1]['key']
-        new_cursor = _encode_cursor(new_cursor)
-    previous_cursors.append(new_cursor)
-    return (contact_list, new_cursor)
+    if len(page_keys) > max_results:
+        page_keys = page_keys[:max_results]
+        new_cursor = _encode_cursor(page_keys[-1])
+    cursors.add(new_cursor)
+    return ([get_object(key) for key in page_keys], new_cursor)
+
+
+@contextmanager
+def _gc_paused():
+    """
+    Pause garbage collection while many objects that aren't garbage are
+    created, e.g. while contacts are indexed or a large snapshot is pickled
+    or unpickled. Otherwise every collection walks all of them, which makes
+    it several times slower.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _iter_objects(get_keys, get_object, batch_size=100):
+    """
+    Yield the objects for the keys in the :class:`SortedKeys` returned by
+    ``get_keys``, fetching ``batch_size`` keys at a time.
+
+    As in the real API, objects added or removed while the stream is read
+    may or may not be included, but no object is included twice.
+    """
+    after = None
+    while True:
+        keys = get_keys().page_after(after, batch_size)
+        if not keys:
+            return
+        for key in keys:
+            obj = get_object(key)
+            if obj is not None:
+                yield obj
+        after = keys[-1]
 
 
 def _encode_cursor(cursor):
@@ -88,16 +243,424 @@ def _encode_cursor(cursor):
     return cursor
 
 
+_QUERY_OPERATORS = {
+    u'AND': u'AND', u'&&': u'AND',
+    u'OR': u'OR', u'||': u'OR',
+}
+
+# How a clause occurs in a list of clauses.
+_MUST, _SHOULD, _MUST_NOT = 'MUST', 'SHOULD', 'MUST_NOT'
+
+_BARE_RE = re.compile(r'(?:\\.|[^\s():"\'\\])+', re.UNICODE | re.DOTALL)
+_QUOTED_RE = re.compile(
+    r'"((?:\\.|[^"\\])*)"|\'((?:\\.|[^\'\\])*)\'', re.UNICODE | re.DOTALL)
+_WORD_PART_RE = re.compile(r'\\(.)|([*?])|(.)', re.UNICODE | re.DOTALL)
+
+
+def _unescape(text):
+    return re.sub(r'\\(.)', r'\1', text, flags=re.DOTALL)
+
+
+def _bare_term(field, word):
+    """
+    Return a term for an unquoted word, which may contain ``*`` and ``?``
+    wildcards.
+    """
+    literal, pattern, wildcards = [], [], False
+    for escaped, wildcard, char in _WORD_PART_RE.findall(word):
+        if wildcard:
+            wildcards = True
+            pattern.append(u'.*' if wildcard == u'*' else u'.')
+        else:
+            char = escaped or char
+            literal.append(char)
+            pattern.append(re.escape(char))
+    if wildcards:
+        return ('term', (field, None, u''.join(pattern)))
+    return ('term', (field, u''.join(literal), None))
+
+
+def _evaluate_clauses(clauses):
+    """
+    Return a function that evaluates a list of ``(occur, evaluate)``
+    clauses against a :class:`ContactIndexes`.
+    """
+    if len(clauses) == 1 and clauses[0][0] == _SHOULD:
+        return clauses[0][1]
+    required = [e for occur, e in clauses if occur == _MUST]
+    optional = [e for occur, e in clauses if occur == _SHOULD]
+    prohibited = [e for occur, e in clauses if occur == _MUST_NOT]
+
+    def evaluate_clauses(indexes):
+        if required:
+            keys = set(required[0](indexes))
+            for evaluate in required[1:]:
+                if not keys:
+                    break
+                keys.intersection_update(evaluate(indexes))
+        elif optional:
+            keys = set().union(*[evaluate(indexes) for evaluate in optional])
+        else:
+            keys = set(indexes.all_keys)
+        for evaluate in prohibited:
+            if not keys:
+                break
+            keys.difference_update(evaluate(indexes))
+        return keys
+    return evaluate_clauses
+
+
+class SearchQuery(object):
+    """
+    A smart group query, in the subset of the Lucene syntax that the API
+    supports for them:
+
+    * ``field:value`` terms, where the value may be quoted with ``'`` or
+      ``"`` and unquoted values may contain ``*`` and ``?`` wildcards and
+      backslash-escaped characters,
+    * bare values, which match any field,
+    * ``AND`` (or ``&&``) and ``OR`` (or ``||``), with adjacent clauses
+      combined with ``OR`` and ``AND`` binding more tightly than ``OR``,
+    * required (``+``) and prohibited (``-`` or ``NOT``) clauses. A contact
+      matches a list of clauses if it matches every required clause, none
+      of the prohibited clauses and, if no clause is required, at least one
+      of the others. A list of only prohibited clauses matches every
+      contact that none of them match,
+    * parentheses for grouping.
+
+    Values match whole field values case-insensitively. Contact extras and
+    subscriptions are matched as ``extras-<name>`` and
+    ``subscription-<name>`` fields, as they are stored in Riak.
+
+    :raises FakeContactsError:
+        If the query isn't valid.
+    """
+
+    def __init__(self, query):
+        if isinstance(query, str):
+            query = query.decode('utf-8')
+        self.query = query
+        self.tokens = self._tokenize()
+        self.pos = 0
+        if not self.tokens:
+            self._error("empty query")
+        self.evaluate = self._parse_clauses()
+        if self.pos < len(self.tokens):
+            self._error("unexpected %r" % (self.tokens[self.pos][0],))
+
+    def _error(self, message):
+        raise FakeContactsError(
+            400, u"Invalid search query %r: %s" % (self.query, message))
+
+    def _tokenize(self):
+        query, pos, tokens = self.query, 0, []
+        while True:
+            while pos < len(query) and query[pos].isspace():
+                pos += 1
+            if pos >= len(query):
+                return tokens
+            char = query[pos]
+            if char in u'()':
+                tokens.append((char, None))
+                pos += 1
+            elif char in u'-+':
+                tokens.append(('mod', _MUST_NOT if char == u'-' else _MUST))
+                pos += 1
+            elif char in u'\'"':
+                value, pos = self._read_quoted(pos)
+                tokens.append(('term', (None, value, None)))
+            else:
+                match = _BARE_RE.match(query, pos)
+                if match is None:
+                    self._error("unexpected %r" % (char,))
+                word, pos = match.group(), match.end()
+                if query[pos:pos + 1] == u':':
+                    token, pos = self._read_value(_unescape(word), pos + 1)
+                    tokens.append(token)
+                elif word in _QUERY_OPERATORS:
+                    tokens.append(('op', _QUERY_OPERATORS[word]))
+                elif word == u'NOT':
+                    tokens.append(('mod', _MUST_NOT))
+                else:
+                    tokens.append(_bare_term(None, word))
+
+    def _read_quoted(self, pos):
+        match = _QUOTED_RE.match(self.query, pos)
+        if match is None:
+            self._error("unterminated quote")
+        text = match.group(1)
+        if text is None:
+            text = match.group(2)
+        return _unescape(text), match.end()
+
+    def _read_value(self, field, pos):
+        if self.query[pos:pos + 1] in (u'"', u"'"):
+            value, pos = self._read_quoted(pos)
+            return ('term', (field, value, None)), pos
+        match = _BARE_RE.match(self.query, pos)
+        if match is None:
+            self._error("missing value for field %r" % (field,))
+        return _bare_term(field, match.group()), match.end()
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _parse_clauses(self):
+        clauses = [self._parse_and()]
+        while True:
+            kind, value = self._peek()
+            if kind == 'op' and value == u'OR':
+                self._next()
+            elif kind not in ('term', '(', 'mod'):
+                break
+            clauses.append(self._parse_and())
+        return _evaluate_clauses(clauses)
+
+    def _parse_and(self):
+        clauses = [self._parse_modified()]
+        while self._peek() == ('op', u'AND'):
+            self._next()
+            clauses.append(self._parse_modified())
+        if len(clauses) == 1:
+            return clauses[0]
+        return (_SHOULD, _evaluate_clauses(
+            [(_MUST_NOT if occur == _MUST_NOT else _MUST, evaluate)
+             for occur, evaluate in clauses]))
+
+    def _parse_modified(self):
+        kind, value = self._peek()
+        if kind == 'mod':
+            self._next()
+            return (value, self._parse_primary())
+        return (_SHOULD, self._parse_primary())
+
+    def _parse_primary(self):
+        kind, value = self._next()
+        if kind == '(':
+            evaluate = self._parse_clauses()
+            if self._next()[0] != ')':
+                self._error("missing ')'")
+            return evaluate
+        if kind == 'term':
+            field, literal, pattern = value
+            if pattern is not None:
+                regex = re.compile(
+                    u'%s$' % (pattern,), re.IGNORECASE | re.UNICODE)
+                return lambda indexes: indexes.keys_matching(field, regex)
+            return lambda indexes: indexes.keys_equal(field, literal)
+        if kind is None:
+            self._error("unexpected end of query")
+        if kind == 'mod':
+            self._error("unexpected second modifier")
+        self._error("unexpected %r" % (value or kind,))
+
+    def keys(self, indexes):
+        """
+        Return the set of keys of the contacts in the
+        :class:`ContactIndexes` ``indexes`` that match the query.
+        """
+        return self.evaluate(indexes)
+
+
+class ContactIndexes(object):
+    """
+    Hash indexes of contact keys by field value and by group, so that
+    contacts can be looked up without scanning them all. The keys of the
+    contacts in each group are kept sorted, for paging through them.
+
+    Every field is also indexed by its case-folded value for
+    :class:`SearchQuery`, with extras and subscriptions indexed as
+    ``extras-<name>`` and ``subscription-<name>`` fields and list fields
+    indexed by each of their items.
+
+    Contacts must be removed from the indexes before they are changed and
+    added again afterwards.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.by_field = dict((field, {}) for field in fields)
+        self.by_group = {}
+        self.by_search_field = {}
+        self.all_keys = set()
+
+    @staticmethod
+    def _add_key(index, value, key, keys_class=set):
+        keys = index.get(value)
+        if keys is None:
+            keys = index[value] = keys_class()
+        keys.add(key)
+
+    @staticmethod
+    def _discard_key(index, value, key):
+        keys = index.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[value]
+
+    @staticmethod
+    def _search_values(contact):
+        """
+        Yield the ``(field, value)`` pairs a contact is found by in
+        searches, with the values case-folded. The key isn't searchable, as
+        it isn't part of the data stored in Riak.
+        """
+        for field, value in contact.iteritems():
+            if field == u'key':
+                continue
+            if field in (u'extra', u'subscription'):
+                prefix = u'extras' if field == u'extra' else field
+                for name, item in (value or {}).iteritems():
+                    if item is not None:
+                        yield u'%s-%s' % (prefix, name), unicode(item).lower()
+                continue
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for item in value:
+                if item is not None:
+                    yield field, unicode(item).lower()
+
+    def add(self, contact):
+        key = contact[u'key']
+        for field in self.fields:
+            value = contact.get(field)
+            if value is not None:
+                self._add_key(self.by_field[field], value, key)
+        for group_key in contact.get(u'groups') or []:
+            self._add_key(self.by_group, group_key, key, SortedKeys)
+        for field, value in self._search_values(contact):
+            self._add_key(
+                self.by_search_field.setdefault(field, {}), value, key)
+        self.all_keys.add(key)
+
+    def remove(self, contact):
+        key = contact[u'key']
+        for field in self.fields:
+            value = contact.get(field)
+            if value is not None:
+                self._discard_key(self.by_field[field], value, key)
+        for group_key in contact.get(u'groups') or []:
+            self._discard_key(self.by_group, group_key, key)
+        for field, value in self._search_values(contact):
+            index = self.by_search_field.get(field)
+            if index is not None:
+                self._discard_key(index, value, key)
+                if not index:
+                    del self.by_search_field[field]
+        self.all_keys.discard(key)
+
+    def keys_with_value(self, field, value):
+        """
+        Return the set of keys of contacts with ``field`` set to ``value``.
+        """
+        return self.by_field[field].get(value, set())
+
+    def keys_in_group(self, group_key):
+        """
+        Return the :class:`SortedKeys` of contacts in the static group
+        ``group_key``.
+        """
+        return self.by_group.get(group_key, SortedKeys())
+
+    def _search_indexes(self, field):
+        if field is None:
+            return self.by_search_field.values()
+        return [self.by_search_field.get(field, {})]
+
+    def keys_equal(self, field, value):
+        """
+        Return the set of keys of contacts with ``field``, or any field if
+        ``field`` is ``None``, equal to ``value`` ignoring case.
+        """
+        value = value.lower()
+        return set().union(*[
+            index.get(value, ()) for index in self._search_indexes(field)])
+
+    def keys_matching(self, field, regex):
+        """
+        Return the set of keys of contacts with ``field``, or any field if
+        ``field`` is ``None``, matching the compiled regex ``regex``. Only
+        the distinct values of the field are matched, not every contact.
+        """
+        keys = set()
+        for index in self._search_indexes(field):
+            for value, value_keys in index.iteritems():
+                if regex.match(value) is not None:
+                    keys.update(value_keys)
+        return keys
+
+
 class FakeContacts(object):
     """
     Fake implementation of the Contacts part of the Contacts API
+
+    Contacts are indexed by key, by address field and by group. The indexes
+    are kept
+    up to date by :meth:`create_contact`, :meth:`update_contact` and
+    :meth:`delete_contact`, so contacts in ``contacts_data`` that are
+    changed in any other way must be reindexed with :meth:`reindex`.
     """
-    def __init__(self, contacts_data={}, max_contacts_per_page=10):
+    def __init__(self, contacts_data=None, max_contacts_per_page=10,
+                 cursors=None):
+        if contacts_data is None:
+            contacts_data = {}
+        if cursors is None:
+            cursors = CursorRegistry()
         self.contacts_data = contacts_data
         self.max_contacts_per_page = max_contacts_per_page
+        self.cursors = cursors
         self.valid_search_keys = [
             'bbm_pin', 'facebook_id', 'gtalk_id', 'msisdn', 'mxit_id',
             'twitter_handle', 'wechat_id']
+        self.reindex()
+
+    def add_contacts(self, contacts):
+        """
+        Add many contacts at once, e.g. from a fixture file. The contacts
+        are dicts of fields like those returned by the API, and are stored
+        with their keys if they have them.
+        """
+        for contact_data in contacts:
+            contact = self.make_contact_dict(contact_data)
+            self.contacts_data[contact[u"key"]] = contact
+        self.reindex()
+
+    def get_state(self):
+        """
+        Return the contacts and their indexes, for a snapshot.
+        """
+        return {
+            'contacts_data': self.contacts_data,
+            'sorted_keys': self.sorted_keys,
+            'indexes': self.indexes,
+        }
+
+    def set_state(self, state):
+        """
+        Replace the contacts and their indexes with those from
+        :meth:`get_state`.
+        """
+        self.contacts_data = state['contacts_data']
+        self.sorted_keys = state['sorted_keys']
+        self.indexes = state['indexes']
+
+    def reindex(self):
+        """
+        Rebuild the indexes from ``contacts_data``.
+        """
+        self.sorted_keys = SortedKeys(self.contacts_data)
+        self.indexes = ContactIndexes(self.valid_search_keys)
+        with _gc_paused():
+            for contact in self.contacts_data.itervalues():
+                self.indexes.add(contact)
 
     @staticmethod
     def make_contact_dict(fields):
@@ -145,6 +708,8 @@ class FakeContacts(object):
 
         contact = self.make_contact_dict(contact_data)
         self.contacts_data[contact[u"key"]] = contact
+        self.sorted_keys.add(contact[u"key"])
+        self.indexes.add(contact)
         return contact
 
     def get_contact(self, contact_key):
@@ -172,19 +737,65 @@ class FakeContacts(object):
                 400, "Query field must be one of: %s"
                 % sorted(self.valid_search_keys))
         value = self._normalize_addr(field, value)
-        contacts = [
-            contact for key, contact in self.contacts_data.iteritems() if
-            contact[field] == value]
+        contacts = self.get_contacts_by_field(field, value)
         if not contacts:
             raise FakeContactsError(
                 400,
                 "Object u'Contact with %s %s' not found." % (field, value))
         return contacts
 
+    def _get_contacts_by_keys(self, keys):
+        return [self.contacts_data[key] for key in sorted(keys)]
+
+    def get_contacts_by_field(self, field, value):
+        """
+        Return the contacts with ``field`` set to ``value``, sorted by key.
+        Address fields are looked up in the indexes and other fields are
+        checked on every contact.
+
+        :raises KeyError:
+            If a contact doesn't have the field.
+        """
+        if field in self.indexes.by_field:
+            return self._get_contacts_by_keys(
+                self.indexes.keys_with_value(field, value))
+        return sorted(
+            (contact for contact in self.contacts_data.itervalues()
+             if contact[field] == value),
+            key=lambda contact: contact[u'key'])
+
+    def get_contacts_in_group(self, group_key):
+        """
+        Return the contacts in the static group ``group_key``, sorted by key.
+        """
+        return self._get_contacts_by_keys(
+            self.indexes.keys_in_group(group_key))
+
+    def search_keys(self, query):
+        """
+        Return the set of keys of the contacts matching the smart group
+        query ``query``. See :class:`SearchQuery` for the syntax.
+
+        :raises FakeContactsError:
+            If the query isn't valid.
+        """
+        return SearchQuery(query).keys(self.indexes)
+
+    def search(self, query):
+        """
+        Return the contacts matching the smart group query ``query``,
+        sorted by key.
+        """
+        return self._get_contacts_by_keys(self.search_keys(query))
+
     def get_all_contacts(self, query):
+        """
+        Return a generator of all the contacts, sorted by key.
+        """
         if query is not None:
             raise FakeContactsError(400, "query parameter not supported")
-        return self.contacts_data.values()
+        return _iter_objects(
+            lambda: self.sorted_keys, self.contacts_data.get)
 
     def get_all(self, query):
         stream = query.get('stream', None)
@@ -204,12 +815,13 @@ class FakeContacts(object):
         if query is not None:
             return {
                 u'cursor': None, u'data': self._get_contacts_from_query(query)}
-        contacts = self.get_all_contacts(query)
-
         max_results = (max_results and int(max_results)) or float('inf')
-        max_results = min(max_results, self.max_contacts_per_page)
+        max_results = min(
+            max_results, self.max_contacts_per_page or float('inf'))
 
-        contacts, cursor = _paginate(contacts, cursor, max_results)
+        contacts, cursor = _paginate(
+            self.sorted_keys, self.contacts_data.__getitem__, self.cursors,
+            cursor, max_results)
 
         return {u'cursor': cursor, u'data': contacts}
 
@@ -217,13 +829,17 @@ class FakeContacts(object):
         contact = self.get_contact(contact_key)
         contact_data = _data_to_json(contact_data)
         self._check_fields(contact_data)
+        self.indexes.remove(contact)
         for k, v in contact_data.iteritems():
             contact[k] = v
+        self.indexes.add(contact)
         return contact
 
     def delete_contact(self, contact_key):
         contact = self.get_contact(contact_key)
         self.contacts_data.pop(contact_key)
+        self.sorted_keys.discard(contact_key)
+        self.indexes.remove(contact)
         return contact
 
     def request(self, request, contact_key, query, contact_store):
@@ -254,8 +870,15 @@ class FakeGroups(object):
     dynamic_cursor_keyword = 'dynamicgroup'
     static_cursor_keyword = 'staticgroup'
 
-    def __init__(self, groups_data={}, max_groups_per_page=10):
+    def __init__(self, groups_data=None, max_groups_per_page=10,
+                 cursors=None):
+        if groups_data is None:
+            groups_data = {}
+        if cursors is None:
+            cursors = CursorRegistry()
         self.groups_data = groups_data
+        self.cursors = cursors
+        self.sorted_keys = SortedKeys(groups_data)
         self.max_groups_per_page = max_groups_per_page
 
     @staticmethod
@@ -286,11 +909,40 @@ class FakeGroups(object):
                 400, "Invalid group fields: %s" % ", ".join(
                     sorted(bad_fields)))
 
+    def add_groups(self, groups):
+        """
+        Add many groups at once, e.g. from a fixture file. The groups are
+        dicts of fields like those returned by the API, and are stored with
+        their keys if they have them.
+        """
+        for group_data in groups:
+            group = self.make_group_dict(group_data)
+            self.groups_data[group[u"key"]] = group
+        self.sorted_keys = SortedKeys(self.groups_data)
+
+    def get_state(self):
+        """
+        Return the groups and their index, for a snapshot.
+        """
+        return {
+            'groups_data': self.groups_data,
+            'sorted_keys': self.sorted_keys,
+        }
+
+    def set_state(self, state):
+        """
+        Replace the groups and their index with those from
+        :meth:`get_state`.
+        """
+        self.groups_data = state['groups_data']
+        self.sorted_keys = state['sorted_keys']
+
     def create_group(self, group_data):
         group_data = _data_to_json(group_data)
         self._check_fields(group_data)
         group = self.make_group_dict(group_data)
         self.groups_data[group[u"key"]] = group
+        self.sorted_keys.add(group[u"key"])
         return group
 
     def get_group(self, group_key):
@@ -301,17 +953,24 @@ class FakeGroups(object):
         return group
 
     def get_all_groups(self, query):
+        """
+        Return a generator of all the groups, sorted by key.
+        """
         if query is not None:
             raise FakeContactsError(400, "query parameter not supported")
-        return self.groups_data.values()
+        return _iter_objects(lambda: self.sorted_keys, self.groups_data.get)
 
     def get_page_groups(self, query, cursor, max_results):
-        groups = self.get_all_groups(query)
+        if query is not None:
+            raise FakeContactsError(400, "query parameter not supported")
 
         max_results = (max_results and int(max_results)) or float('inf')
-        max_results = min(max_results, self.max_groups_per_page)
+        max_results = min(
+            max_results, self.max_groups_per_page or float('inf'))
 
-        groups, cursor = _paginate(groups, cursor, max_results)
+        groups, cursor = _paginate(
+            self.sorted_keys, self.groups_data.__getitem__, self.cursors,
+            cursor, max_results)
 
         return {u'cursor': cursor, u'data': groups}
 
@@ -330,44 +989,42 @@ class FakeGroups(object):
             return self.get_contacts_for_group_page(
                 q, key, cursor, max_results)
 
-    def _filter_contacts(self, contacts, group_key):
-        filtered = []
-        for contact in contacts:
-            if group_key in contact.get('groups'):
-                filtered.append(contact)
-        return filtered
-
-    def _query_contacts(self, contacts, query):
-        try:
-            field, _, value = query.partition(':')
-            results = []
-            for contact in contacts:
-                if contact[field] == value:
-                    results.append(contact)
-            return results
-        except KeyError:
-            raise FakeContactsError(
-                400, "Invalid query, FakeContacts only supports queries of " +
-                "the form 'field:value'")
-
     def get_contacts_for_group_stream(self, query, key):
+        """
+        Return a generator of the contacts in the static group, sorted by
+        key, followed by those matching its query if it is a smart group.
+
+        The query is checked immediately, but it is only run once the
+        static contacts have been streamed, as it is by the real API.
+        """
         if query is not None:
             raise FakeContactsError(400, "query parameter not supported")
-        all_contacts = self.fake_contacts.get_all_contacts(None)
-        contacts = self._filter_contacts(all_contacts, key)
         group = self.groups_data.get(key)
+        search_query = None
         if group and group['query'] is not None:
-            contacts.extend(self._query_contacts(all_contacts, group['query']))
-        return contacts
+            search_query = SearchQuery(group['query'])
+        return self._iter_contacts_for_group(key, search_query)
+
+    def _iter_contacts_for_group(self, key, search_query):
+        contacts = self.fake_contacts
+        for contact in _iter_objects(
+                lambda: contacts.indexes.keys_in_group(key),
+                contacts.contacts_data.get):
+            yield contact
+        if search_query is not None:
+            keys = SortedKeys(search_query.keys(contacts.indexes))
+            for contact in _iter_objects(
+                    lambda: keys, contacts.contacts_data.get):
+                yield contact
 
     def get_contacts_for_group_page(self, query, key, cursor, max_results):
         if query is not None:
             raise FakeContactsError(400, "query parameter not supported")
 
-        all_contacts = self.fake_contacts.get_all_contacts(None)
         max_results = (max_results and int(max_results)) or float('inf')
         max_results = min(
-            max_results, self.fake_contacts.max_contacts_per_page)
+            max_results,
+            self.fake_contacts.max_contacts_per_page or float('inf'))
 
         if cursor is not None:
             decoded_cursor = cursor.decode('rot13')
@@ -379,16 +1036,20 @@ class FakeGroups(object):
             decoded_cursor = decoded_cursor[len(self.dynamic_cursor_keyword):]
             if decoded_cursor == '':
                 decoded_cursor = None
-            contacts = self._query_contacts(all_contacts, group['query'])
+            keys = SortedKeys(
+                self.fake_contacts.search_keys(group['query']))
             contacts, cursor = _paginate(
-                contacts, decoded_cursor, max_results)
+                keys, self.fake_contacts.contacts_data.__getitem__,
+                self.cursors, decoded_cursor, max_results)
             if cursor is not None:
                 cursor = (self.dynamic_cursor_keyword + cursor).encode('rot13')
         elif decoded_cursor.startswith(self.static_cursor_keyword):
             decoded_cursor = decoded_cursor[len(self.static_cursor_keyword):]
             decoded_cursor = None if decoded_cursor == '' else decoded_cursor
-            contacts = self._filter_contacts(all_contacts, key)
-            contacts, cursor = _paginate(contacts, decoded_cursor, max_results)
+            contacts, cursor = _paginate(
+                self.fake_contacts.indexes.keys_in_group(key),
+                self.fake_contacts.contacts_data.__getitem__,
+                self.cursors, decoded_cursor, max_results)
 
             if cursor is None:
                 group = self.groups_data.get(key)
@@ -411,6 +1072,7 @@ class FakeGroups(object):
     def delete_group(self, group_key):
         group = self.get_group(group_key)
         self.groups_data.pop(group_key)
+        self.sorted_keys.discard(group_key)
         return group
 
     def get_all(self, query):
@@ -455,17 +1117,61 @@ class FakeGroups(object):
 class FakeContactsApi(object):
     """
     Fake implementation of the Vumi Go contacts API.
+
+    The last ``max_cursors`` cursors issued are accepted by the fake. Older
+    cursors are rejected as invalid.
     """
-    def __init__(self, url_path_prefix, auth_token, contacts_data={},
-                 groups_data={}, group_limit=10, contacts_limit=10):
+    def __init__(self, url_path_prefix, auth_token, contacts_data=None,
+                 groups_data=None, group_limit=10, contacts_limit=10,
+                 max_cursors=10000):
         self.url_path_prefix = url_path_prefix
         self.auth_token = auth_token
-        self.contacts = FakeContacts(contacts_data, contacts_limit)
-        self.groups = FakeGroups(groups_data, group_limit)
+        self.cursors = CursorRegistry(max_cursors)
+        self.contacts = FakeContacts(
+            contacts_data, contacts_limit, self.cursors)
+        self.groups = FakeGroups(groups_data, group_limit, self.cursors)
 
     make_contact_dict = staticmethod(FakeContacts.make_contact_dict)
     make_group_dict = staticmethod(FakeGroups.make_group_dict)
 
+    def save_snapshot(self, path):
+        """
+        Write the fake's contacts and groups, along with their indexes, to
+        the file ``path``, so that they can be loaded by
+        :meth:`load_snapshot` without building them again.
+
+        Cursors aren't saved, so cursors issued before a snapshot is loaded
+        are still accepted afterwards.
+        """
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'contacts': self.contacts.get_state(),
+            'groups': self.groups.get_state(),
+        }
+        with _gc_paused():
+            data = cPickle.dumps(snapshot, cPickle.HIGHEST_PROTOCOL)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def load_snapshot(self, path):
+        """
+        Replace the fake's contacts and groups with those in a snapshot
+        written by :meth:`save_snapshot`.
+
+        Snapshots are pickles, so they should only be loaded from trusted
+        files.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        with _gc_paused():
+            snapshot = cPickle.loads(data)
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(
+                "Unsupported snapshot version %r, expected %r." % (
+                    snapshot.get('version'), SNAPSHOT_VERSION))
+        self.contacts.set_state(snapshot['contacts'])
+        self.groups.set_state(snapshot['groups'])
+
     # The methods below are part of the external API.
 
     def handle_request(self, request):
@@ -486,7 +1192,7 @@ class FakeContactsApi(object):
         }.get(request_type, None)
 
         if handler is None:
-            self.build_response("", 404)
+            return self.build_response("", 404)
 
         try:
             query_string = parse_qs(url.query.decode('utf8'))
@@ -0,0 +1,165 @@
+"""
+An HTTP server for the verified fake of go-contacts.
+
+This serves a :class:`fake_go_contacts.FakeContactsApi` over HTTP so that it
+can be used as a stand-in for the real API, e.g. as a load test target::
+
+    fake-go-contacts --port 8080 --auth-token secret \\
+        --contacts contacts.ndjson --groups groups.ndjson
+
+Fixture files have one JSON object per line, with the fields of a contact or
+group as returned by the API. Large fixtures load faster from a snapshot
+written by :meth:`fake_go_contacts.FakeContactsApi.save_snapshot`, given
+with ``--snapshot``. Streamed responses are written a batch of
+objects at a time with chunked transfer encoding, one JSON object per line,
+as they are by the real API.
+
+Twisted is required to run the server.
+"""
+
+import argparse
+import json
+import sys
+
+from twisted.internet import task
+from twisted.python import log
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+from fake_go_contacts import FakeContactsApi, Request
+
+
+def read_ndjson(path):
+    """
+    Yield the JSON objects in a file with one object per line. Blank lines
+    are skipped.
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class FakeContactsResource(Resource):
+    """
+    Serves every request with a :class:`fake_go_contacts.FakeContactsApi`.
+
+    :param api:
+        The fake API.
+    :param int stream_batch_size:
+        The number of objects written at a time when streaming a response.
+        Other requests are handled between batches.
+    """
+    isLeaf = True
+
+    def __init__(self, api, stream_batch_size=100):
+        Resource.__init__(self)
+        self.api = api
+        self.stream_batch_size = stream_batch_size
+
+    def render(self, request):
+        headers = dict(
+            (name, values[0])
+            for name, values in request.requestHeaders.getAllRawHeaders())
+        response = self.api.handle_request(Request(
+            request.method, request.uri, body=request.content.read(),
+            headers=headers))
+        request.setResponseCode(response.code)
+        for name, value in response.headers.iteritems():
+            request.setHeader(name, value)
+        request.setHeader("Content-Type", "application/json; charset=utf-8")
+        if response.streaming:
+            self.write_stream(request, response.iter_data())
+            return NOT_DONE_YET
+        return response.body
+
+    def write_stream(self, request, objects):
+        """
+        Write ``objects`` one per line, a batch at a time, and finish the
+        request. Objects are only taken from ``objects`` as they are
+        written, and writing stops if the client disconnects. If writing
+        fails part of the way through, the failure is logged and the
+        connection is closed without finishing the response, so that the
+        client can tell the stream is incomplete.
+        """
+        def write_batches():
+            batch = []
+            for obj in objects:
+                batch.append(json.dumps(obj))
+                if len(batch) >= self.stream_batch_size:
+                    request.write("\n".join(batch) + "\n")
+                    batch = []
+                    yield
+            if batch:
+                request.write("\n".join(batch) + "\n")
+
+        cooperative_task = task.cooperate(write_batches())
+        d = cooperative_task.whenDone()
+
+        def disconnected(_):
+            if not d.called:
+                cooperative_task.stop()
+
+        request.notifyFinish().addErrback(disconnected)
+
+        def failed(f):
+            if f.check(task.TaskStopped):
+                # The client disconnected.
+                return
+            log.err(f, "Failed to write stream for %s" % (request.uri,))
+            request.loseConnection()
+
+        d.addCallbacks(lambda _: request.finish(), failed)
+
+
+def make_site(api, stream_batch_size=100):
+    return Site(FakeContactsResource(api, stream_batch_size))
+
+
+def main(argv=None, reactor=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--interface", default="127.0.0.1")
+    parser.add_argument(
+        "--path-prefix", default="",
+        help="The path the API is served under, e.g. /api/v1/go.")
+    parser.add_argument(
+        "--auth-token", required=True,
+        help="The bearer token clients must send.")
+    parser.add_argument("--contacts-limit", type=int, default=100)
+    parser.add_argument("--groups-limit", type=int, default=100)
+    parser.add_argument(
+        "--snapshot",
+        help="A snapshot saved by FakeContactsApi.save_snapshot to load.")
+    parser.add_argument(
+        "--contacts", help="A file of contacts to load, one JSON per line.")
+    parser.add_argument(
+        "--groups", help="A file of groups to load, one JSON per line.")
+    parser.add_argument("--stream-batch-size", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    if reactor is None:
+        from twisted.internet import reactor
+    log.startLogging(sys.stdout)
+
+    api = FakeContactsApi(
+        args.path_prefix, args.auth_token, group_limit=args.groups_limit,
+        contacts_limit=args.contacts_limit)
+    if args.snapshot:
+        api.load_snapshot(args.snapshot)
+    if args.contacts:
+        api.contacts.add_contacts(read_ndjson(args.contacts))
+    if args.groups:
+        api.groups.add_groups(read_ndjson(args.groups))
+    log.msg("Loaded %d contacts and %d groups." % (
+        len(api.contacts.contacts_data), len(api.groups.groups_data)))
+
+    reactor.listenTCP(
+        args.port, make_site(api, args.stream_batch_size),
+        interface=args.interface)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,8 +9,16 @@ setup(
     long_description=open('README.rst', 'r').read(),
     author='Praekelt Foundation',
     author_email='dev@praekeltfoundation.org',
-    py_modules=['fake_go_contacts'],
+    py_modules=['fake_go_contacts', 'fake_go_contacts_server'],
     install_requires=[],
+    extras_require={
+        'server': ['Twisted'],
+    },
+    entry_points={
+        'console_scripts': [
+            'fake-go-contacts = fake_go_contacts_server:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',